@@ -1,258 +1,2479 @@
 # pip install Flask requests beautifulsoup4
-from flask import Flask, request, render_template_string
+import calendar
+import contextlib
+import contextvars
+import cProfile
+import csv
+import gzip
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
+import math
+import mmap
+import os
+import pstats
+import random
+import re
+import secrets
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from html import unescape
+from urllib.parse import urlsplit
+
+from flask import Flask, Response, g, request, render_template, abort, jsonify, make_response, stream_template, stream_with_context, url_for
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError: # 未安裝 orjson 時改用標準函式庫
+    orjson = None
+
+try:
+    import fcntl
+except ImportError: # Windows 沒有 fcntl，歷史檔只在單一行程內加鎖
+    fcntl = None
+
+try:
+    import brotli
+except ImportError: # 未安裝 brotli 時只提供 gzip 壓縮
+    brotli = None
+
+# 初始化 Flask 應用程式
+app = Flask(__name__)
+# 靜態檔網址帶有內容雜湊，可放心讓瀏覽器與 CDN 長期快取
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 365 * 24 * 3600
+
+_static_versions = {}
+
+
+def json_dumps(payload):
+    """序列化為精簡的 UTF-8 JSON bytes（有安裝 orjson 時使用 orjson）。"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def make_soup(markup, parser):
+    """
+    建立 BeautifulSoup 物件；bs4 延遲到第一次解析時才匯入，首頁等不需解析的請求不必負擔匯入時間。
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markup, parser)
+
+
+@app.context_processor
+def inject_static_url():
+    return {'static_url': static_url}
+
+
+def static_url(filename):
+    """回傳帶有內容雜湊版本參數的靜態檔網址，檔案內容改變時網址隨之改變。"""
+    version = _static_versions.get(filename)
+    if version is None:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = _static_versions[filename] = hashlib.md5(f.read()).hexdigest()[:10]
+    return url_for('static', filename=filename, v=version)
+
+
+def precompile_templates():
+    """啟動時先編譯所有頁面模板並放進 Jinja 快取，請求時不再編譯。"""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+precompile_templates()
+
+# --- 輔助工具：快取與請求合併 ---
+class TTLCache:
+    """
+    具存活時間 (TTL) 與 LRU 淘汰的執行緒安全快取。
+    """
+
+    def __init__(self, maxsize=1024, ttl=3.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (寫入時間, 值)；過期項目保留到被 LRU 淘汰，供 get_stale 使用
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self.get_stale(key)
+        if item is None or item[1] >= self.ttl:
+            return None
+        return item[0]
+
+    def get_stale(self, key):
+        """回傳 (值, 已存放秒數)，即使已超過 TTL；不存在時回傳 None。"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+        stored_at, value = item
+        return value, time.monotonic() - stored_at
+
+    def set(self, key, value, age=0.0):
+        """存入值；age 為資料已經過的秒數（例如取自共用快取時）。"""
+        with self._lock:
+            self._data[key] = (time.monotonic() - age, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    合併同一個 key 的並行呼叫：第一個呼叫者實際執行，其餘等待並共用結果（或例外）。
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return future.result()
+
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='refresh')
+_refresh_pending = set()
+_refresh_lock = threading.Lock()
+
+
+def refresh_in_background(key, fn):
+    """
+    在背景執行緒重新抓取資料（stale-while-revalidate），請求本身不等待上游。
+    同一個 key 已在背景更新中時不會重複排入；失敗只記錄日誌，保留舊資料。
+    """
+    with _refresh_lock:
+        if key in _refresh_pending:
+            return
+        _refresh_pending.add(key)
+
+    def run():
+        try:
+            fn()
+        except (UpstreamUnavailable, UpstreamBusy):
+            pass  # 斷路器開啟或速率受限時不逐筆寫日誌（另有監控指標）
+        except Exception as e:
+            app.logger.warning("背景更新 %s 失敗，繼續使用舊資料: %s", key, e)
+        finally:
+            with _refresh_lock:
+                _refresh_pending.discard(key)
+
+    _refresh_executor.submit(run)
+
+# --- 輔助工具：監控指標 (Prometheus) ---
+class Metric:
+    """
+    Prometheus 指標的共同基底：依標籤值分別累計，輸出為文字格式。
+    每次更新只有一次字典查詢與一個短暫的鎖，對熱路徑的負擔可忽略。
+    """
+    kind = ''
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics_registry.append(self)
+
+    def _label_text(self, labels, extra=''):
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{self._label_text(labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS, phase=None):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        self.phase = phase # 同時計入目前請求 Server-Timing 標頭的階段名稱
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+        if self.phase is not None:
+            timing = _request_timing.get()
+            if timing is not None:
+                timing.add(self.phase, value)
+
+    def time(self, *labels):
+        """以 with 區塊計時並記錄到此直方圖。"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._label_text(labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_text(labels)} {total}')
+            lines.append(f'{self.name}_count{self._label_text(labels)} {count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+_metrics_registry = []
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', '各路由的請求處理時間', ('route', 'method'))
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', '處理中的請求數', ('route',))
+UPSTREAM_SECONDS = Histogram('upstream_fetch_duration_seconds', '上游網站的抓取時間', ('upstream',), phase='fetch')
+UPSTREAM_ERRORS = Counter('upstream_fetch_errors_total', '上游抓取失敗次數（含 HTTP 錯誤狀態）', ('upstream', 'kind'))
+UPSTREAM_TIMEOUTS = Counter('upstream_fetch_timeouts_total', '上游抓取逾時次數', ('upstream',))
+PARSE_SECONDS = Histogram('parse_duration_seconds', 'HTML / CSV 解析時間', ('parser',),
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1), phase='parse')
+RENDER_SECONDS = Histogram('template_render_duration_seconds', '頁面模板渲染時間', ('template',),
+                           buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1), phase='render')
+PARSE_ERRORS = Counter('parse_errors_total', '解析時略過的錯誤資料筆數', ('parser',))
+CACHE_LOOKUPS = Counter('cache_lookups_total', '快取查詢次數（依命中與否）', ('cache', 'result'))
+UPSTREAM_CIRCUIT_OPEN = Gauge('upstream_circuit_open', '上游斷路器狀態（0 關閉、1 開啟、0.5 半開試探）', ('upstream',))
+UPSTREAM_SHED = Counter('upstream_shed_total', '超過上游速率上限或同時連線名額而直接放棄的請求數', ('upstream', 'reason'))
+UPSTREAM_QUEUE_SECONDS = Histogram('upstream_queue_wait_seconds', '等待上游速率配額的時間', ('upstream',), phase='queue')
+UPSTREAM_SHORT_CIRCUITS = Counter('upstream_short_circuits_total', '斷路器開啟期間直接拒絕的上游請求數', ('upstream',))
+STOCK_DEADLINE_MISSES = Counter('stock_deadline_exceeded_total', '股票查詢超過時限而放棄等待的次數')
+
+
+def render_metrics():
+    """輸出所有指標的 Prometheus 文字格式。"""
+    lines = []
+    for metric in _metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTiming:
+    """
+    單一請求各階段（抓取、解析、渲染等）累計的秒數，輸出為 Server-Timing 標頭。
+    並行查詢多支股票時各執行緒的時間會加總，因此階段合計可能超過 total。
+    """
+
+    def __init__(self):
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    def header(self, total):
+        with self._lock:
+            phases = list(self._phases.items())
+        phases.append(('total', total))
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in phases)
+
+
+# 目前請求的 RequestTiming；送進執行緒池的工作以 submit_in_context 帶入，背景更新則不計入
+_request_timing = contextvars.ContextVar('request_timing', default=None)
+
+
+def submit_in_context(executor, fn, *args):
+    """將工作連同目前的 contextvars（例如請求計時）一起送進執行緒池。"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+@app.before_request
+def _metrics_before_request():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(g.metrics_route)
+    _request_timing.set(RequestTiming())
+
+
+@app.after_request
+def _server_timing_after_request(response):
+    # 串流回應的標頭先送出，只含開始串流前的階段
+    timing = _request_timing.get()
+    if timing is not None and 'metrics_start' in g:
+        response.headers['Server-Timing'] = timing.header(time.perf_counter() - g.metrics_start)
+    return response
+
+
+@app.teardown_request
+def _metrics_teardown_request(exc=None):
+    _request_timing.set(None)
+    route = g.pop('metrics_route', None)
+    if route is not None:
+        REQUESTS_IN_FLIGHT.dec(route)
+        REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_start, route, request.method)
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- 輔助工具：共用 HTTP 連線 ---
+# 連線 / 讀取逾時（秒）
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+# 暫時性錯誤（連線失敗、逾時、429/5xx）的重試次數與退避基準（秒）
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.3))
+# 每個主機保留的 keep-alive 連線數，以及同時進行中的請求上限
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_HOST_CONCURRENCY = int(os.environ.get('HTTP_HOST_CONCURRENCY', 8))
+# 斷路器：同一上游連續失敗幾次後開啟，開啟多久（秒）後放行一次試探請求
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+# 各上游的請求速率上限「每秒請求數:瞬間容量」，可用 UPSTREAM_RATE_LIMIT_<名稱>（例如 UPSTREAM_RATE_LIMIT_YAHOO=10:20）覆寫，
+# 設為 0 表示不限制；限制以行程為單位，多個 worker 時實際上限為 worker 數倍
+UPSTREAM_RATE_LIMITS = {'invoice': '2:5', 'yahoo': '20:40', 'bot': '2:5'}
+# 等待速率配額的請求數上限與最長等待時間（秒），超過即直接回應忙碌
+UPSTREAM_QUEUE_SIZE = int(os.environ.get('UPSTREAM_QUEUE_SIZE', 64))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 2))
+# 設定後三個上游都改向離線替身 (bench/stub_server.py) 抓取，供效能測試使用
+UPSTREAM_STUB_URL = os.environ.get('UPSTREAM_STUB_URL', '').rstrip('/')
+
+
+def upstream_url(official, stub_path):
+    """回傳上游網址：有設定 UPSTREAM_STUB_URL 時改用替身上對應的路徑。"""
+    return UPSTREAM_STUB_URL + stub_path if UPSTREAM_STUB_URL else official
+
+
+def build_http_session():
+    """
+    建立共用的 requests.Session：每個主機一組連線池並保持連線，
+    暫時性錯誤以指數退避加隨機抖動重試。
+    """
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        backoff_jitter=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_http_session = build_http_session()
+_http_host_slots = {}
+_http_host_lock = threading.Lock()
+
+
+def _host_slot(host):
+    with _http_host_lock:
+        slot = _http_host_slots.get(host)
+        if slot is None:
+            slot = _http_host_slots[host] = threading.BoundedSemaphore(HTTP_HOST_CONCURRENCY)
+        return slot
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """斷路器開啟中，未實際連線即拒絕的上游請求。"""
+
+
+class UpstreamBusy(requests.exceptions.RequestException):
+    """超過上游速率上限且等待佇列已滿（或需等待過久）而放棄的請求；retry_after 為建議的重試秒數。"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    單一上游的權杖桶速率限制，附有上限的等待佇列。
+    權杖以預約方式扣除（可暫時為負），每個請求依序睡到輪到自己為止，不需條件變數；
+    等待中的請求已達 max_waiters，或預計等待超過 max_wait 秒時立即拋出 UpstreamBusy。
+    """
+
+    def __init__(self, name, rate, burst, max_waiters=64, max_wait=2.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_waiters = max_waiters
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.waiters = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait_seconds = (1 - self.tokens) / self.rate
+            if self.waiters >= self.max_waiters or wait_seconds > self.max_wait:
+                reason = 'queue_full' if self.waiters >= self.max_waiters else 'wait_too_long'
+                UPSTREAM_SHED.inc(self.name, reason)
+                raise UpstreamBusy(f'{self.name} 查詢量過大，請稍後再試', retry_after=math.ceil(wait_seconds))
+            self.tokens -= 1
+            self.waiters += 1
+        try:
+            UPSTREAM_QUEUE_SECONDS.observe(wait_seconds, self.name)
+            time.sleep(wait_seconds)
+        finally:
+            with self._lock:
+                self.waiters -= 1
+
+
+def _parse_rate_limit(text):
+    """將「每秒請求數:瞬間容量」轉為 (rate, burst)；0 或空字串表示不限制。"""
+    rate, _, burst = text.partition(':')
+    rate = float(rate or 0)
+    return (rate, float(burst or max(1.0, rate))) if rate > 0 else None
+
+
+def build_rate_limiters():
+    """依 UPSTREAM_RATE_LIMITS 與環境變數建立各上游的權杖桶。"""
+    limiters = {}
+    for name, default in UPSTREAM_RATE_LIMITS.items():
+        limit = _parse_rate_limit(os.environ.get(f'UPSTREAM_RATE_LIMIT_{name.upper()}', default))
+        if limit:
+            limiters[name] = TokenBucket(name, *limit, max_waiters=UPSTREAM_QUEUE_SIZE, max_wait=UPSTREAM_QUEUE_TIMEOUT)
+    return limiters
+
+
+_rate_limiters = build_rate_limiters()
+
+
+class CircuitBreaker:
+    """
+    單一上游的斷路器：連續失敗達門檻即開啟，期間所有請求立即失敗而不佔用連線與 worker；
+    經過 reset_seconds 後進入半開狀態，只放行一個試探請求，成功才恢復關閉。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False
+                self._set_state('half_open')
+            if self.state == 'half_open':
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def rejecting(self):
+        """是否開啟中且尚未到試探時間；不加鎖，只供取得速率配額前提早拒絕使用。"""
+        return self.state == 'open' and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != 'closed':
+                self._set_state('closed')
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != 'open':
+                    app.logger.warning("上游 %s 連續失敗 %d 次，斷路器開啟 %.0f 秒", self.name, self.failures, self.reset_seconds)
+                self._set_state('open')
+
+    def _set_state(self, state):
+        self.state = state
+        UPSTREAM_CIRCUIT_OPEN.set(self.name, value={'closed': 0, 'half_open': 0.5, 'open': 1}[state])
+
+
+_circuit_breakers = {}
+
+
+def _circuit_breaker(upstream):
+    with _http_host_lock:
+        breaker = _circuit_breakers.get(upstream)
+        if breaker is None:
+            breaker = _circuit_breakers[upstream] = CircuitBreaker(
+                upstream, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        return breaker
+
+
+def http_get(url, timeout=None, upstream=None, **kwargs):
+    """
+    所有爬蟲共用的 GET：重用連線池、套用預設逾時與重試，並限制每個主機的同時請求數。
+    timeout 只指定一個數字時視為讀取逾時；upstream 為監控指標與斷路器使用的上游名稱（預設為主機名稱）。
+    該上游超過速率上限且排隊已滿、或等待主機連線名額超過連線逾時時拋出 UpstreamBusy；
+    斷路器開啟時直接拋出 UpstreamUnavailable。
+    """
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+    host = urlsplit(url).hostname
+    upstream = upstream or host
+    breaker = _circuit_breaker(upstream)
+    # 斷路器開啟中直接失敗，不必先排隊等速率配額
+    if breaker.rejecting():
+        _short_circuit(upstream)
+    # 即將半開試探時先取得速率配額再問斷路器，避免試探的名額被排隊逾時的請求佔住
+    limiter = _rate_limiters.get(upstream)
+    if limiter is not None:
+        limiter.acquire()
+    # 主機的同時連線名額也只等一個連線逾時，上游卡住時後來的請求直接放棄而不是無限排隊
+    slot = _host_slot(host)
+    if not slot.acquire(timeout=timeout[0]):
+        UPSTREAM_SHED.inc(upstream, 'host_slots')
+        raise UpstreamBusy(f'{upstream} 同時連線數已滿，請稍後再試')
+    try:
+        return _http_get_with_breaker(url, timeout, upstream, breaker, **kwargs)
+    finally:
+        slot.release()
+
+
+def _short_circuit(upstream):
+    UPSTREAM_SHORT_CIRCUITS.inc(upstream)
+    raise UpstreamUnavailable(f'{upstream} 暫時無法連線，稍後將自動重試')
+
+
+def _http_get_with_breaker(url, timeout, upstream, breaker, **kwargs):
+    if not breaker.allow():
+        _short_circuit(upstream)
+
+    start = time.perf_counter()
+    try:
+        response = _http_session.get(url, timeout=timeout, **kwargs)
+    except requests.exceptions.Timeout:
+        UPSTREAM_TIMEOUTS.inc(upstream)
+        breaker.record_failure()
+        raise
+    except requests.exceptions.RequestException as e:
+        UPSTREAM_ERRORS.inc(upstream, type(e).__name__)
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.record_failure()
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, upstream)
+    if response.status_code >= 400:
+        UPSTREAM_ERRORS.inc(upstream, f'http_{response.status_code}')
+    # 4xx（例如查無此股票代碼）代表上游仍正常回應，只有 5xx 計入斷路器
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+# --- 輔助工具：本機資料庫 (SQLite) ---
+# 歷期中獎號碼、觀察清單等需要跨重新啟動保存的資料
+DATABASE_PATH = os.environ.get('DATABASE_PATH') or os.path.join(app.instance_path, 'app.db')
+# 寫入鎖被其他 worker 佔住時最多等待的秒數；與共用快取相同只等很短的時間，
+# 開啟 WAL 後讀取不會被寫入擋住，只有同時寫入才需要等待
+DATABASE_BUSY_TIMEOUT = float(os.environ.get('DATABASE_BUSY_TIMEOUT', 0.05))
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS invoice_periods (
+    period TEXT PRIMARY KEY,
+    numbers TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoice_suffixes (
+    period TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    PRIMARY KEY (period, suffix)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS invoice_suffixes_by_suffix ON invoice_suffixes (suffix);
+CREATE TABLE IF NOT EXISTS watchlists (
+    name TEXT NOT NULL,
+    code TEXT NOT NULL,
+    PRIMARY KEY (name, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS watchlist_owners (
+    name TEXT PRIMARY KEY,
+    token_hash TEXT NOT NULL
+);
+'''
+_db = {'pid': None, 'conn': None}
+_db_lock = threading.Lock()
+
+
+def _db_connection():
+    if _db['pid'] != os.getpid():
+        os.makedirs(os.path.dirname(DATABASE_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(DATABASE_PATH, timeout=DATABASE_BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(DB_SCHEMA)
+        _db.update(pid=os.getpid(), conn=conn)
+    return _db['conn']
+
+
+def db_execute(sql, params=(), many=False):
+    """
+    在本機資料庫執行 SQL 並回傳所有結果列。
+    每個行程共用一條連線（gunicorn fork 後各 worker 重新連線），以鎖保護；寫入都很少且很快。
+    """
+    with _db_lock:
+        conn = _db_connection()
+        with conn:
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            return cursor.fetchall()
+
+
+def db_transaction(statements):
+    """在同一筆交易中依序執行多個 (sql, params, many)；任一失敗時全部復原。"""
+    with _db_lock:
+        conn = _db_connection()
+        with conn:
+            for sql, params, many in statements:
+                if many:
+                    conn.executemany(sql, params)
+                else:
+                    conn.execute(sql, params)
+
+# --- 輔助工具：跨 worker 共用快取 (SQLite WAL) ---
+# 同一台機器上的 gunicorn worker 共用解析後的報價、匯率表；SHARED_CACHE=0 時停用
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH') or os.path.join(app.instance_path, 'cache.db')
+SHARED_CACHE_ENABLED = os.environ.get('SHARED_CACHE', '1') != '0'
+# 拿不到租約（其他 worker 正在抓取同一份資料）時，等待對方寫入的最長時間（秒）
+SHARED_LEASE_WAIT = float(os.environ.get('SHARED_LEASE_WAIT', 1.0))
+# 過期超過多久的項目才真正刪除（秒）；在此之前仍可作為舊資料使用
+SHARED_CACHE_KEEP = float(os.environ.get('SHARED_CACHE_KEEP', 86400))
+# 資料庫被其他 worker 鎖住時最多等待的秒數；SQLite 在 C 層忙等，gevent worker 等待期間整個行程都會停住，
+# 因此只等很短的時間，逾時視為未命中（租約視為取得）
+SHARED_CACHE_BUSY_TIMEOUT = float(os.environ.get('SHARED_CACHE_BUSY_TIMEOUT', 0.05))
+
+
+class SharedCache:
+    """
+    以 WAL 模式的 SQLite 檔案作為跨行程快取：讀取不會被寫入擋住，值以 JSON 保存。
+    另提供租約 (lease)：同一份資料只由拿到租約的 worker 向上游抓取，其他 worker 等待或讀取結果。
+    資料庫發生錯誤時一律視為未命中（租約視為取得），不影響請求本身。
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS shared_cache (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        stored_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner INTEGER NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    '''
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self._pid = None
+        self._conn = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=SHARED_CACHE_BUSY_TIMEOUT, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._connection().execute(sql, params)
+            return cursor.fetchall() if cursor.description else cursor.rowcount
+
+    def _execute_in_transaction(self, statements):
+        """在同一筆寫入交易中依序執行多個 (sql, params)，只取得一次寫入鎖。"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def get(self, key):
+        """回傳 (值, 已存放秒數)，過期的也會回傳，由呼叫端依自己的 TTL 判斷；不存在時回傳 None。"""
+        if not self.enabled:
+            return None
+        try:
+            rows = self._execute('SELECT value, stored_at FROM shared_cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            app.logger.warning("讀取共用快取失敗: %s", e)
+            return None
+        if not rows:
+            return None
+        value, stored_at = rows[0]
+        return json.loads(value), time.time() - stored_at
+
+    def get_many(self, keys):
+        """一次讀取多個 key，回傳 {key: (值, 已存放秒數)}。"""
+        if not self.enabled or not keys:
+            return {}
+        try:
+            rows = self._execute(
+                f'SELECT key, value, stored_at FROM shared_cache WHERE key IN ({",".join("?" * len(keys))})', tuple(keys))
+        except sqlite3.Error as e:
+            app.logger.warning("讀取共用快取失敗: %s", e)
+            return {}
+        now = time.time()
+        return {key: (json.loads(value), now - stored_at) for key, value, stored_at in rows}
+
+    def set(self, key, value, ttl, stored_at=None, release=None):
+        """寫入值；release 為同時釋放的租約名稱，與寫入在同一筆交易完成。"""
+        if not self.enabled:
+            return
+        stored_at = stored_at or time.time()
+        statements = [('INSERT OR REPLACE INTO shared_cache (key, value, stored_at, expires_at) VALUES (?, ?, ?, ?)',
+                       (key, json_dumps(value), stored_at, stored_at + ttl))]
+        if release is not None:
+            statements.append(('UPDATE leases SET expires_at = 0 WHERE name = ? AND owner = ?', (release, os.getpid())))
+        try:
+            self._execute_in_transaction(statements)
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._execute('DELETE FROM shared_cache WHERE expires_at < ?', (time.time() - SHARED_CACHE_KEEP,))
+        except sqlite3.Error as e:
+            app.logger.warning("寫入共用快取失敗: %s", e)
+
+    def wait_for(self, key, max_age, timeout):
+        """等待其他 worker 寫入 max_age 秒內的新值，最多 timeout 秒；等不到時回傳 None。"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            item = self.get(key)
+            if item is not None and item[1] < max_age:
+                return item[0]
+        return None
+
+    def acquire_lease(self, name, seconds):
+        """
+        取得（或續約）名為 name 的租約 seconds 秒；其他行程持有且未到期時回傳 False。
+        租約以行程為單位，同一行程內的重複抓取另由 SingleFlight 合併。
+        """
+        if not self.enabled:
+            return True
+        now = time.time()
+        pid = os.getpid()
+        try:
+            # 單一 UPSERT：沒有租約時建立，已到期或本來就是自己的才接手
+            return self._execute(
+                'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.expires_at < ? OR leases.owner = ?',
+                (name, pid, now + seconds, now, pid)) == 1
+        except sqlite3.Error as e:
+            app.logger.warning("取得共用快取租約失敗: %s", e)
+            return True
+
+    def release_lease(self, name):
+        if not self.enabled:
+            return
+        try:
+            self._execute('UPDATE leases SET expires_at = 0 WHERE name = ? AND owner = ?', (name, os.getpid()))
+        except sqlite3.Error as e:
+            app.logger.warning("釋放共用快取租約失敗: %s", e)
+
+
+_shared_cache = SharedCache(SHARED_CACHE_PATH, enabled=SHARED_CACHE_ENABLED)
+
+# --- 輔助函式：電子發票兌獎邏輯 ---
+INVOICE_URL = os.environ.get('INVOICE_URL') or upstream_url('https://invoice.etax.nat.gov.tw/index.html', '/invoice/index.html')
+# 官網的上一期中獎號碼頁（官網只公布最近兩期）
+INVOICE_LAST_URL = os.environ.get('INVOICE_LAST_URL') or upstream_url('https://invoice.etax.nat.gov.tw/lastNumber.html', '/invoice/lastNumber.html')
+# 新期別已到期但官網尚未更新時，間隔多久重新抓取一次（秒）
+INVOICE_RECHECK_SECONDS = int(os.environ.get('INVOICE_RECHECK_SECONDS', 1800))
+# 管理用 API 的權杖，未設定時停用所有 /admin 路由
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# 台灣時區（開獎期別以台灣時間計算）
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
+# 獎別與獎金（元）
+INVOICE_PRIZES = {
+    'special': ('特別獎', 10000000),
+    'grand': ('特獎', 2000000),
+    'first': ('頭獎', 200000),
+    'second': ('二獎', 40000),
+    'third': ('三獎', 10000),
+    'fourth': ('四獎', 4000),
+    'fifth': ('五獎', 1000),
+    'sixth': ('六獎', 200),
+}
+# 頭獎號碼末 N 碼相同對應的獎別，由長到短比對
+INVOICE_SUFFIX_TIERS = ((8, 'first'), (7, 'second'), (6, 'third'), (5, 'fourth'), (4, 'fifth'), (3, 'sixth'))
+INVOICE_NUMBER_RE = re.compile(r'\d{8}')
+# 批次兌獎的一個欄位：恰好 8 位數字，前面可帶兩個英文字母的字軌（例如 AB12345678、AB-12345678）
+BULK_INVOICE_FIELD_RE = re.compile(r'(?:([A-Za-z]{2})[- ]?)?([0-9]{8})')
+INVOICE_PERIOD_RE = re.compile(r'(\d{2,3})(0[2468]|1[02])')
+INVOICE_DATE_RE = re.compile(r'(\d{2,4})[-/.](\d{1,2})[-/.](\d{1,2})')
+
+# 中獎號碼快取：以期別為鍵，每兩個月才需要重新抓取一次
+_invoice_cache = {'period': None, 'numbers': None, 'index': None, 'fetched_at': 0.0}
+_invoice_lock = threading.Lock()
+_invoice_flight = SingleFlight()
+# 各期別的末碼索引（由資料庫載入後常駐記憶體，兌獎時只做字典查詢）
+_invoice_indexes = {}
+
+# --- 輔助工具：歷期中獎號碼資料庫 ---
+def save_invoice_period(period, numbers, fetched_at=None):
+    """
+    將一期中獎號碼與展開後的末碼（每個末碼一列）寫入資料庫。
+    三個寫入在同一筆交易完成：其他 worker 不會讀到只有號碼、末碼表卻是空的期別。
+    """
+    exact, suffixes = build_invoice_index(numbers)
+    rows = [(period, suffix, tier) for suffix, tier in {**suffixes, **exact}.items()]
+    db_transaction([
+        ('INSERT OR REPLACE INTO invoice_periods (period, numbers, fetched_at) VALUES (?, ?, ?)',
+         (period, json.dumps(numbers), fetched_at or time.time()), False),
+        ('DELETE FROM invoice_suffixes WHERE period = ?', (period,), False),
+        ('INSERT INTO invoice_suffixes (period, suffix, tier) VALUES (?, ?, ?)', rows, True),
+    ])
+
+
+def load_invoice_index(period):
+    """由資料庫的末碼表組回該期的查詢表；資料庫沒有該期時回傳 None。"""
+    rows = db_execute('SELECT suffix, tier FROM invoice_suffixes WHERE period = ?', (period,))
+    if not rows:
+        return None
+    exact, suffixes = {}, {}
+    for suffix, tier in rows:
+        (exact if tier in ('special', 'grand') else suffixes)[suffix] = tier
+    return exact, suffixes
+
+
+def load_latest_invoice_period():
+    """回傳資料庫中最新一期的 (期別, 號碼, 抓取時間)；資料庫為空時回傳 None。"""
+    rows = db_execute(
+        'SELECT period, numbers, fetched_at FROM invoice_periods ORDER BY CAST(period AS INTEGER) DESC LIMIT 1')
+    if not rows:
+        return None
+    period, numbers, fetched_at = rows[0]
+    return period, json.loads(numbers), fetched_at
+
+
+
+def current_invoice_period(now=None):
+    """
+    回傳目前官網應公布的最新開獎期別，例如 '11402' 代表 114 年 1-2 月。
+    每逢單數月 25 日開出前兩個月的號碼。
+    """
+    now = now or datetime.now(TAIPEI_TZ)
+    year, month = now.year, now.month
+    if month % 2 == 1:
+        end_month = month - 1 if now.day >= 25 else month - 3
+    else:
+        end_month = month - 2
+    if end_month <= 0:
+        end_month += 12
+        year -= 1
+    return f'{year - 1911}{end_month:02d}'
+
+
+def previous_invoice_period(period):
+    """回傳前一期的期別，例如 '11402' → '11312'。"""
+    year, end_month = int(period[:-2]), int(period[-2:]) - 2
+    if end_month <= 0:
+        end_month += 12
+        year -= 1
+    return f'{year}{end_month:02d}'
+
+
+def invoice_period_for_date(day):
+    """回傳發票開立日期所屬的期別，例如 2025-01-15 → '11402'。"""
+    return f'{day.year - 1911}{day.month + day.month % 2:02d}'
+
+
+def parse_invoice_period(period=None, day=None):
+    """
+    由期別（例如 '11402'）或發票日期（'2025-01-15'、民國 '114/01/15'）決定兌獎期別。
+    兩者皆未提供時回傳 None（代表最新一期）；格式錯誤時拋出 ValueError。
+    """
+    if period:
+        if not INVOICE_PERIOD_RE.fullmatch(period):
+            raise ValueError(f'期別格式錯誤：{period}')
+        return period
+    if day:
+        m = INVOICE_DATE_RE.fullmatch(day)
+        if not m:
+            raise ValueError(f'發票日期格式錯誤：{day}')
+        year, month, dom = (int(x) for x in m.groups())
+        if year < 1911:
+            year += 1911 # 民國年
+        return invoice_period_for_date(date(year, month, dom))
+    return None
+
+
+def format_invoice_period(period):
+    """將期別代碼轉為顯示用文字，例如 '11402' → '114年01-02月'。"""
+    year, end_month = int(period[:-2]), int(period[-2:])
+    return f'{year}年{end_month - 1:02d}-{end_month:02d}月'
+
+
+def fetch_invoice_numbers(url=None):
+    """
+    從財政部網站抓取並解析中獎號碼（預設為最新一期的首頁）。
+    回傳 (期別, 號碼) ；期別無法從網頁判讀時為 None。
+    """
+    web = http_get(url or INVOICE_URL, upstream='invoice')
+    web.raise_for_status()
+    web.encoding = 'utf-8'
+    with PARSE_SECONDS.time('invoice_html'):
+        return parse_invoice_page(web.text)
+
+
+def parse_invoice_page(page):
+    """
+    解析財政部兌獎首頁，回傳 (期別, 號碼)。
+    """
+    soup = make_soup(page, 'html.parser')
+    td = soup.select('.container-fluid')[0].select('.etw-tbiggest')
+
+    numbers = {
+        'special': td[0].getText(), # 特別獎
+        'grand': td[1].getText(), # 特獎
+        'first': [td[2].getText()[-8:], td[3].getText()[-8:], td[4].getText()[-8:]], # 頭獎
+    }
+
+    # 網頁上的期別標題，例如「114年 01-02月」
+    period = None
+    m = re.search(r'(\d{2,3})\s*年\s*(\d{1,2})\s*-\s*(\d{1,2})\s*月', page)
+    if m:
+        period = f'{int(m.group(1))}{int(m.group(3)):02d}'
+    return period, numbers
+
+
+def _refresh_invoice_numbers(force=False):
+    """
+    向官網抓取中獎號碼並更新快取與資料庫；抓取時不持有鎖，避免其他請求跟著等待上游。
+    資料庫還沒有上一期時，順便抓取官網的上一期頁面。
+    資料庫由所有 worker 共用：其他 worker 已抓到較新的資料，或正持有租約抓取中時，直接採用資料庫中的號碼。
+    """
+    if not force:
+        latest = load_latest_invoice_period()
+        if latest is not None and latest[2] > _invoice_cache['fetched_at'] and (
+                latest[0] == current_invoice_period() or time.time() - latest[2] < INVOICE_RECHECK_SECONDS):
+            return _adopt_invoice_period(*latest)
+        if not _shared_cache.acquire_lease('invoice', HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT):
+            deadline = time.monotonic() + SHARED_LEASE_WAIT
+            while latest is None and time.monotonic() < deadline:
+                time.sleep(0.05) # 首次啟動：等持有租約的 worker 寫入資料庫
+                latest = load_latest_invoice_period()
+            if latest is not None:
+                return _adopt_invoice_period(*latest)
+    try:
+        period, numbers = fetch_invoice_numbers()
+    finally:
+        _shared_cache.release_lease('invoice')
+    now = time.time()
+    with _invoice_lock:
+        cache = _invoice_cache
+        if period is None:
+            # 網頁未標示期別：號碼有變動（或首次抓取）才視為新一期
+            if cache['numbers'] is None or numbers != cache['numbers']:
+                period = current_invoice_period()
+            else:
+                period = cache['period']
+    try:
+        save_invoice_period(period, numbers, now)
+    except sqlite3.Error as e:
+        # 資料庫忙碌時仍採用剛抓到的號碼（只留在記憶體中）
+        app.logger.warning("儲存中獎號碼失敗: %s", e)
+    _adopt_invoice_period(period, numbers, now)
+
+    previous = previous_invoice_period(period)
+    if previous not in _invoice_indexes and load_invoice_index(previous) is None:
+        try:
+            _fetch_previous_invoice_period(previous)
+        except Exception as e:
+            app.logger.warning("抓取上一期中獎號碼失敗: %s", e)
+    return numbers
+
+
+def _adopt_invoice_period(period, numbers, fetched_at):
+    """將一期中獎號碼設為目前期別的記憶體快取，回傳號碼。"""
+    index = build_invoice_index(numbers)
+    with _invoice_lock:
+        _invoice_cache.update(period=period, numbers=numbers, index=index, fetched_at=fetched_at)
+    _invoice_indexes[period] = index
+    return numbers
+
+
+def _fetch_previous_invoice_period(previous):
+    """抓取官網的上一期頁面並存入資料庫；頁面上的期別不符時不存。"""
+    period, numbers = fetch_invoice_numbers(INVOICE_LAST_URL)
+    if period != previous:
+        return None
+    save_invoice_period(period, numbers)
+    index = _invoice_indexes[period] = build_invoice_index(numbers)
+    return index
+
+
+def _restore_invoice_cache():
+    """由資料庫載入最新一期到記憶體快取（例如重新啟動後），不需連網。"""
+    latest = load_latest_invoice_period()
+    if latest is not None and _invoice_cache['numbers'] is None:
+        _adopt_invoice_period(*latest)
+
+
+def get_invoice_numbers(force=False):
+    """
+    取得目前期別的中獎號碼（優先使用快取，其次為本機資料庫）。
+    只有在新期別到期、官網尚未更新需重試，或 force=True 時才會重新抓取；
+    已有舊號碼時改在背景更新並先回傳舊號碼，請求不會卡在故障的上游。
+    """
+    cache = _invoice_cache
+    if force:
+        return _invoice_flight.do('invoice', lambda: _refresh_invoice_numbers(force=True))
+    if cache['numbers'] is None:
+        _restore_invoice_cache()
+    if cache['numbers'] is not None:
+        if cache['period'] == current_invoice_period() or time.time() - cache['fetched_at'] < INVOICE_RECHECK_SECONDS:
+            CACHE_LOOKUPS.inc('invoice', 'hit')
+        else:
+            CACHE_LOOKUPS.inc('invoice', 'stale')
+            refresh_in_background('invoice', lambda: _invoice_flight.do('invoice', _refresh_invoice_numbers))
+        return cache['numbers']
+    CACHE_LOOKUPS.inc('invoice', 'miss')
+    return _invoice_flight.do('invoice', _refresh_invoice_numbers)
+
+
+def get_invoice_index(force=False, period=None):
+    """
+    取得末碼索引：未指定期別時為目前期別（與中獎號碼一同快取）。
+    指定期別時依序查記憶體、本機資料庫，最後才向官網抓取（官網只有最近兩期）；查無資料時回傳 None。
+    """
+    if period is None:
+        get_invoice_numbers(force=force)
+        return _invoice_cache['index']
+
+    index = _invoice_indexes.get(period)
+    if index is not None:
+        CACHE_LOOKUPS.inc('invoice_period', 'hit')
+        return index
+    index = load_invoice_index(period)
+    if index is not None:
+        CACHE_LOOKUPS.inc('invoice_period', 'store')
+        _invoice_indexes[period] = index
+        return index
+    CACHE_LOOKUPS.inc('invoice_period', 'miss')
+
+    latest = _invoice_cache['period'] or current_invoice_period()
+    if period == latest or int(period) > int(latest):
+        # 還沒開獎，或最新一期尚未出現在官網上
+        get_invoice_numbers()
+        return _invoice_indexes.get(period)
+    if period == previous_invoice_period(latest):
+        return _invoice_flight.do(('invoice', period), lambda: _fetch_previous_invoice_period(period))
+    return None
+
+
+def build_invoice_index(numbers):
+    """
+    建立「號碼 / 末碼 → 獎別」的查詢表，每期只需建立一次。
+    特別獎、特獎需 8 碼全中；頭獎號碼則展開為 8 到 3 碼的末碼。
+    """
+    exact = {numbers['special']: 'special', numbers['grand']: 'grand'}
+    suffixes = {}
+    for n in numbers['first']:
+        for length, tier in INVOICE_SUFFIX_TIERS:
+            suffixes.setdefault(n[-length:], tier)
+    return exact, suffixes
+
+
+def classify_invoice_number(num, index):
+    """以查詢表判定獎別，回傳獎別代碼或 None（常數次字典查詢）。"""
+    exact, suffixes = index
+    tier = exact.get(num)
+    if tier:
+        return tier
+    # 絕大多數號碼連末 3 碼都不符，先用最短末碼篩掉
+    if num[-3:] not in suffixes:
+        return None
+    for length, _ in INVOICE_SUFFIX_TIERS:
+        tier = suffixes.get(num[-length:])
+        if tier:
+            return tier
+    return None
+
+
+def format_prize_amount(amount):
+    """將獎金格式化為「1000 萬元」、「4000 元」等文字。"""
+    if amount >= 10000:
+        return f"{amount // 10000} 萬元"
+    return f"{amount} 元"
+
+
+def match_invoice_number(num, index):
+    """
+    將發票號碼與中獎號碼比對，回傳兌獎結果文字（純記憶體運算）。
+    """
+    tier = classify_invoice_number(num, index)
+    if tier is None:
+        return "😢 很抱歉，沒中獎"
+    return f"🎉 恭喜中獎 {format_prize_amount(INVOICE_PRIZES[tier][1])}"
+
+
+def check_invoice_number(num, period=None):
+    """
+    檢查輸入的發票號碼是否中獎；period 為兌獎期別，未指定時使用最新一期。
+    中獎號碼依期別存於本機資料庫，只有新一期開獎後才會重新向財政部網站抓取；
+    最新一期尚未取得時仍以上一期號碼兌獎，並註明所用的期別。
+    """
+    try:
+        if period is None:
+            result = match_invoice_number(num, get_invoice_index())
+            period = _invoice_cache['period']
+            if period != current_invoice_period():
+                result += f"（依 {format_invoice_period(period)} 中獎號碼，最新一期尚未取得）"
+            return result
+
+        label = format_invoice_period(period)
+        if int(period) > int(current_invoice_period()):
+            return f"{label} 尚未開獎"
+        index = get_invoice_index(period=period)
+        if index is None:
+            return f"查無 {label} 的中獎號碼（官網只提供最近兩期）"
+        return f"{match_invoice_number(num, index)}（{label}）"
+    except UpstreamBusy:
+        return "目前兌獎查詢量過大，請稍後再試。"
+    except requests.exceptions.RequestException as e:
+        return f"無法連接至電子發票網站，請檢查網路連線或稍後再試。詳細錯誤: {e}"
+    except Exception as e:
+        return f"處理發票兌獎時發生錯誤：{e}"
+
+# --- 輔助函式：股票查詢邏輯 ---
+STOCK_QUOTE_URL = os.environ.get('STOCK_QUOTE_URL') or upstream_url('https://tw.stock.yahoo.com/quote/{code}', '/quote/{code}')
+# 並行查詢的執行緒數上限
+STOCK_MAX_WORKERS = int(os.environ.get('STOCK_MAX_WORKERS', 8))
+# 單一代碼自開始查詢起的時限（秒）
+STOCK_CODE_TIMEOUT = float(os.environ.get('STOCK_CODE_TIMEOUT', 8))
+# 整個 /stock 請求的總時間預算（秒）
+STOCK_REQUEST_BUDGET = float(os.environ.get('STOCK_REQUEST_BUDGET', 12))
+
+# 報價快取的存活時間（秒）與最多保留的代碼數
+STOCK_QUOTE_TTL = float(os.environ.get('STOCK_QUOTE_TTL', 3))
+STOCK_QUOTE_CACHE_SIZE = int(os.environ.get('STOCK_QUOTE_CACHE_SIZE', 1024))
+# 超過 TTL 的報價最多再沿用多久（秒，期間於背景更新）；超過多少秒才在畫面上標示資料時間
+STOCK_QUOTE_MAX_STALE = float(os.environ.get('STOCK_QUOTE_MAX_STALE', 6 * 3600))
+STOCK_STALE_NOTICE_SECONDS = float(os.environ.get('STOCK_STALE_NOTICE_SECONDS', 30))
+
+# 快速解析失敗時的 BeautifulSoup 解析器：有安裝 lxml 就用較快的 lxml
+STOCK_HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+STOCK_TITLE_RE = re.compile(r'<title[^>]*>([^<]*)</title>', re.IGNORECASE)
+
+_stock_executor = ThreadPoolExecutor(max_workers=STOCK_MAX_WORKERS, thread_name_prefix='stock')
+_quote_cache = TTLCache(maxsize=STOCK_QUOTE_CACHE_SIZE, ttl=STOCK_QUOTE_TTL)
+_quote_flight = SingleFlight()
+
+
+def _find_class_tag(page, token, start=0, end=None):
+    """
+    在 page[start:end] 中尋找第一個 class 屬性含有 token 的開始標籤，
+    回傳該標籤結尾 '>' 的位置；找不到時回傳 -1。
+    """
+    end = len(page) if end is None else end
+    pos = page.find(token, start, end)
+    while pos != -1:
+        after = pos + len(token)
+        if after >= len(page):
+            return -1  # token 位於頁尾，之後不可能再有完整的標籤
+        tag_start = page.rfind('<', 0, pos)
+        tag_end = page.find('>', pos)
+        # token 必須是完整的 class 名稱，且位於同一個開始標籤的 class 屬性中
+        if (tag_start != -1 and tag_end != -1
+                and page[pos - 1] in '" ' and page[after] in '" '
+                and page.find('>', tag_start, pos) == -1
+                and 'class="' in page[tag_start:pos]):
+            return tag_end
+        pos = page.find(token, pos + 1, end)
+    return -1
+
+
+def _find_class_text(page, token):
+    """取得第一個 class 含 token 的元素文字；元素內還有子標籤時回傳 None。"""
+    tag_end = _find_class_tag(page, token)
+    if tag_end == -1:
+        return None
+    text_end = page.find('<', tag_end)
+    text = page[tag_end + 1:text_end]
+    if not text.strip():
+        return None
+    return unescape(text)
+
+
+def parse_stock_quote_fast(page, code):
+    """
+    只擷取標題、股價、漲跌與漲跌方向等片段的快速解析，不建立完整的 DOM。
+    任何片段無法確定時回傳 None，交由 parse_stock_quote_soup 處理。
+    """
+    m = STOCK_TITLE_RE.search(page)
+    if not m:
+        return None
+    # 範例格式: "公司名稱 (股票代碼) - Yahoo奇摩股市"
+    title = unescape(m.group(1)).strip().split(' - Yahoo')[0].strip()
+    if not title:
+        return None
+    if f'({code})' not in title:
+        title = f'{title} ({code})'
+
+    price = _find_class_text(page, 'Fz(32px)')
+    change_value = _find_class_text(page, 'Fz(20px)')
+    if price is None or change_value is None:
+        return None
+
+    # 漲跌方向只在報價標頭區塊 (#main-0-QuoteHeader-Proxy) 內判斷
+    s = ''
+    header_start = page.find('id="main-0-QuoteHeader-Proxy"')
+    if header_start != -1:
+        header_end = page.find('id="main-1-', header_start)
+        if header_end == -1:
+            header_end = len(page)
+        if _find_class_tag(page, 'C($c-trend-up)', header_start, header_end) != -1:
+            s = '+'
+        elif _find_class_tag(page, 'C($c-trend-down)', header_start, header_end) != -1:
+            s = '-'
+
+    return {'code': code, 'title': title, 'price': price, 'change': change_value, 'sign': s}
+
+
+def parse_stock_quote(page, code):
+    """
+    從 Yahoo 股市報價頁解析股票名稱、價格與漲跌，回傳結構化的報價資料。
+    優先使用快速片段解析，失敗時才退回完整的 BeautifulSoup 解析。
+    """
+    with PARSE_SECONDS.time('yahoo_fast'):
+        quote = parse_stock_quote_fast(page, code)
+    if quote is None:
+        with PARSE_SECONDS.time('yahoo_soup'):
+            quote = parse_stock_quote_soup(page, code)
+    return quote
+
+
+def parse_stock_quote_soup(page, code):
+    """
+    以 BeautifulSoup 建立完整 DOM 解析報價頁（相容性最高，但較慢）。
+    """
+    soup = make_soup(page, STOCK_HTML_PARSER)
+
+    # --- 提取股票名稱（公司名稱 + 股票代碼） ---
+    title = code # 預設值，以防所有提取失敗
+
+    # 優先從 HTML 的 <title> 標籤中提取完整名稱，這通常最穩定
+    html_title_tag = soup.find('title')
+    if html_title_tag:
+        full_title_text = html_title_tag.get_text().strip()
+        # 範例格式: "公司名稱 (股票代碼) - Yahoo奇摩股市"
+        parts = full_title_text.split(' - Yahoo')
+        if len(parts) > 0:
+            extracted_name_from_title = parts[0].strip()
+            if f'({code})' in extracted_name_from_title:
+                title = extracted_name_from_title
+            else:
+                title = f'{extracted_name_from_title} ({code})'
+
+    # 如果從 <title> 標籤未能得到理想結果，則嘗試從 <h1> 標籤獲取
+    if title == code:
+        h1_title_tag = soup.select_one('h1.C($c-link-text).Fz(24px).Mend(8px)')
+        if not h1_title_tag:
+            h1_title_tag = soup.select_one('div.D\\(ib\\).Mend\\(8px\\) > h1')
+
+        if h1_title_tag:
+            raw_h1_text = h1_title_tag.get_text().strip()
+            if raw_h1_text:
+                if f'({code})' in raw_h1_text or code in raw_h1_text:
+                    title = raw_h1_text
+                else:
+                    title = f'{raw_h1_text} ({code})'
+
+    # 提取股價與漲跌
+    price_tag = soup.select_one('.Fz\\(32px\\)')
+    change_tag = soup.select_one('.Fz\\(20px\\)')
+
+    price = price_tag.get_text() if price_tag else 'N/A'
+    change_value = change_tag.get_text() if change_tag else 'N/A'
+
+    # 判斷漲跌符號（根據 CSS Class）
+    s = ''
+    if soup.select_one('#main-0-QuoteHeader-Proxy .C\\(\\$c-trend-up\\)'):
+        s = '+'
+    elif soup.select_one('#main-0-QuoteHeader-Proxy .C\\(\\$c-trend-down\\)'):
+        s = '-'
+
+    return {'code': code, 'title': title, 'price': price, 'change': change_value, 'sign': s}
+
+
+def fetch_stock_quote(code, timeout=None):
+    """向 Yahoo 股市下載並解析單一股票報價（不經快取）。"""
+    url = STOCK_QUOTE_URL.format(code=code)
+    web = http_get(url, timeout=timeout, upstream='yahoo')
+    web.raise_for_status()
+    return parse_stock_quote(web.text, code)
+
+
+def get_stock_quote(code, timeout=None):
+    """
+    取得單一股票報價：STOCK_QUOTE_TTL 秒內直接使用快取；
+    同一代碼同時有多個請求未命中時，只會發出一次上游請求，其餘共用結果；
+    其他 gunicorn worker 剛抓過（共用快取）或正在抓取（租約）時也不重複抓取。
+    觀察清單中的代碼直接使用背景輪詢的快照。快取已過期時照常同步抓取；只有 Yahoo 斷路器開啟、或抓取失敗／逾時，
+    且舊報價未超過 STOCK_QUOTE_MAX_STALE 時，才改回傳舊報價（附 stale_age 秒數），斷路器開啟時並於背景更新。
+    """
+    def load():
+        key = f'quote:{code}'
+        shared = _shared_cache.get(key)
+        if shared is not None and shared[1] < _quote_cache.ttl:
+            # 其他 worker 剛抓過
+            _quote_cache.set(code, shared[0], age=shared[1])
+            return shared[0]
+        if not _shared_cache.acquire_lease(key, STOCK_CODE_TIMEOUT):
+            # 其他 worker 正在抓同一支股票，等它寫入；等不到才自己抓
+            quote = _shared_cache.wait_for(key, _quote_cache.ttl, SHARED_LEASE_WAIT)
+            if quote is not None:
+                _quote_cache.set(code, quote)
+                return quote
+        try:
+            quote = fetch_stock_quote(code, timeout=timeout)
+        except BaseException:
+            _shared_cache.release_lease(key)
+            raise
+        _quote_cache.set(code, quote)
+        # 寫入報價與釋放租約合成一筆交易：未命中時只有取得租約與這裡兩次寫入
+        _shared_cache.set(key, quote, STOCK_QUOTE_TTL, release=key)
+        _quote_publisher.publish(code, quote)
+        return quote
+
+    quote = get_snapshot_quote(code)
+    if quote is not None:
+        CACHE_LOOKUPS.inc('quote', 'snapshot')
+        return quote
+
+    cached = _quote_cache.get_stale(code)
+    if cached is not None:
+        quote, age = cached
+        if age < _quote_cache.ttl:
+            CACHE_LOOKUPS.inc('quote', 'hit')
+            return quote
+        if age < STOCK_QUOTE_MAX_STALE:
+            if _circuit_breaker('yahoo').state == 'open':
+                # 上游故障中：不等待，先回傳舊報價；背景更新在斷路器半開時負責試探
+                CACHE_LOOKUPS.inc('quote', 'stale')
+                refresh_in_background(('quote', code), lambda: _quote_flight.do(code, load))
+                return dict(quote, stale_age=age)
+            started = time.monotonic()
+            try:
+                fresh = _quote_flight.do(code, load)
+            except requests.exceptions.RequestException:
+                CACHE_LOOKUPS.inc('quote', 'stale')
+                return dict(quote, stale_age=age + time.monotonic() - started)
+            CACHE_LOOKUPS.inc('quote', 'miss')
+            return fresh
+    CACHE_LOOKUPS.inc('quote', 'miss')
+    return _quote_flight.do(code, load)
+
+
+def format_data_age(seconds):
+    """將資料經過的秒數轉為「N 秒／分鐘／小時前」。"""
+    if seconds < 60:
+        return f'{int(seconds)} 秒前'
+    if seconds < 3600:
+        return f'{int(seconds // 60)} 分鐘前'
+    return f'{int(seconds // 3600)} 小時前'
+
+
+def format_stock_quote(quote):
+    """將報價資料格式化為顯示用文字；沿用較舊的報價時附上資料時間。"""
+    text = f"【{quote['title']}】：{quote['price']} ({quote['sign']}{quote['change']})"
+    age = quote.get('stale_age', 0)
+    if age >= STOCK_STALE_NOTICE_SECONDS:
+        text += f"（{format_data_age(age)}的報價，暫時無法更新）"
+    return text
+
+
+def get_stock_details(code, timeout=None):
+    """
+    查詢單一股票的即時資訊 (名稱、價格、漲跌)。
+    """
+    try:
+        return format_stock_quote(get_stock_quote(code, timeout=timeout))
+    except UpstreamBusy:
+        return f'【{code}】查詢失敗：目前查詢量過大，請稍後再試。'
+    except requests.exceptions.RequestException as e:
+        return f'【{code}】查詢失敗：無法連接或網路錯誤。詳細錯誤: {e}'
+    except AttributeError: # 處理 select_one 可能返回 None 的情況
+        return f'【{code}】查詢失敗：找不到股價資料或網頁結構已改變。'
+    except IndexError: # 處理 select 返回空列表的情況
+        return f'【{code}】查詢失敗：找不到股價資料或網頁結構已改變。'
+    except Exception as e:
+        return f'【{code}】查詢失敗：發生未預期錯誤。詳細錯誤: {e}'
+
+
+def iter_stock_fan_out(codes, fetch, on_timeout, window=None, budget=None):
+    """
+    以執行緒池並行對多支股票呼叫 fetch(code, timeout)，依完成順序產生 (索引, 結果)。
+    同時進行中的工作最多 window 個（預設全部送出），因此很長的代碼清單也只佔用固定記憶體。
+    每個代碼自開始查詢起有 STOCK_CODE_TIMEOUT 秒，整批另可指定 budget 秒的總預算；
+    超過時限的代碼以 on_timeout(code) 的結果代替，不再等待。
+    """
+    started = {}
+
+    def run(i, code):
+        started[i] = time.monotonic()
+        return fetch(code, STOCK_CODE_TIMEOUT)
+
+    budget_deadline = time.monotonic() + budget if budget is not None else float('inf')
+    queued = iter(enumerate(codes))
+    pending = {}
+
+    def top_up():
+        while window is None or len(pending) < window:
+            item = next(queued, None)
+            if item is None:
+                return
+            pending[submit_in_context(_stock_executor, run, *item)] = item[0]
+
+    top_up()
+    while pending:
+        now = time.monotonic()
+        deadlines = {}
+        for future, i in list(pending.items()):
+            deadline = budget_deadline
+            if i in started:
+                deadline = min(deadline, started[i] + STOCK_CODE_TIMEOUT)
+            if deadline <= now:
+                # 尚未開始的工作直接取消，已在執行的則放棄等待
+                future.cancel()
+                del pending[future]
+                STOCK_DEADLINE_MISSES.inc()
+                yield i, on_timeout(codes[i])
+            else:
+                deadlines[future] = deadline
+        top_up()
+        if not pending:
+            break
+
+        # 排隊中的工作開始後才有自己的期限，因此最多每 0.5 秒重新檢查一次
+        timeout = min(min(deadlines.values(), default=now), now + 0.5) - now
+        done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future.result()
+        top_up()
+
+
+def fan_out_stock_codes(codes, fetch, on_timeout):
+    """
+    並行查詢多支股票，結果依輸入順序回傳；整批受 STOCK_REQUEST_BUDGET 秒的總預算限制。
+    每個請求同時最多 STOCK_MAX_WORKERS 支在查詢中，其餘排隊，不會一次把整份清單塞進共用的執行緒池。
+    """
+    results = [None] * len(codes)
+    for i, result in iter_stock_fan_out(codes, fetch, on_timeout, window=STOCK_MAX_WORKERS, budget=STOCK_REQUEST_BUDGET):
+        results[i] = result
+    return results
+
+
+def _stock_details_with_timeout(code, timeout):
+    return get_stock_details(code, timeout=timeout)
+
+
+def _stock_timeout_message(code):
+    return f'【{code}】查詢逾時，請稍後再試。'
+
+
+def _too_many_codes_message():
+    return f'每次最多查詢 {WATCHLIST_MAX_CODES} 支股票，請分批查詢。'
+
+
+def get_multiple_stock_details(codes):
+    """並行查詢多支股票，回傳依輸入順序排列的顯示文字。"""
+    return fan_out_stock_codes(codes, _stock_details_with_timeout, _stock_timeout_message)
+
+
+def iter_stock_details(codes):
+    """
+    逐筆產生查詢結果（依完成順序），供串流頁面一有結果就送出。
+    同時最多 STOCK_MAX_WORKERS 支股票在查詢中，不受清單長度影響。
+    """
+    for _, line in iter_stock_fan_out(codes, _stock_details_with_timeout, _stock_timeout_message,
+                                      window=STOCK_MAX_WORKERS):
+        yield line
+
+# --- 輔助工具：觀察清單與共用報價輪詢 ---
+# 開盤時段與收盤後的輪詢間隔（秒）；STOCK_POLLER=0 時停用背景輪詢
+STOCK_POLL_INTERVAL = float(os.environ.get('STOCK_POLL_INTERVAL', 5))
+STOCK_POLL_CLOSED_INTERVAL = float(os.environ.get('STOCK_POLL_CLOSED_INTERVAL', 600))
+STOCK_POLLER_ENABLED = os.environ.get('STOCK_POLLER', '1') != '0'
+# 每份觀察清單最多的代碼數、最多的清單數
+WATCHLIST_MAX_CODES = int(os.environ.get('WATCHLIST_MAX_CODES', 50))
+WATCHLIST_MAX_LISTS = int(os.environ.get('WATCHLIST_MAX_LISTS', 200))
+# 所有觀察清單合計最多的相異代碼數，也是每輪輪詢的上限；預設每 5 秒 50 支，約佔 Yahoo 速率上限的一半
+STOCK_POLL_MAX_CODES = int(os.environ.get('STOCK_POLL_MAX_CODES', 50))
+# 輪詢專用的執行緒數；與使用者查詢的執行緒池分開，觀察清單再多也不會排擠 /stock
+STOCK_POLL_MAX_WORKERS = int(os.environ.get('STOCK_POLL_MAX_WORKERS', 4))
+WATCHLIST_NAME_RE = re.compile(r'[\w-]{1,32}')
+STOCK_CODE_RE = re.compile(r'[0-9A-Za-z.]{1,12}')
+# 即時推播 (SSE) 沒有新報價時送出保活註解的間隔（秒），也是偵測連線中斷的最長時間
+STOCK_EVENTS_HEARTBEAT = float(os.environ.get('STOCK_EVENTS_HEARTBEAT', 15))
+# 輪詢代碼已滿、拒絕即時推播訂閱時建議用戶端幾秒後再試
+STOCK_EVENTS_RETRY_AFTER = int(os.environ.get('STOCK_EVENTS_RETRY_AFTER', 60))
+
+# 台股一般交易時段（週一至週五 09:00–13:30，未計國定假日）
+MARKET_OPEN = (9, 0)
+MARKET_CLOSE = (13, 30)
+
+# 輪詢結果：代碼 -> (報價, 抓取時間)；由輪詢執行緒整份替換，讀取不需加鎖
+_quote_snapshot = {}
+_stock_poller = {'pid': None, 'thread': None}
+_stock_poller_lock = threading.Lock()
+_poll_executor = ThreadPoolExecutor(max_workers=STOCK_POLL_MAX_WORKERS, thread_name_prefix='stock-poll')
+
+STOCK_WATCHED_CODES = Gauge('stock_watched_codes', '背景輪詢中的相異股票代碼數')
+STOCK_POLL_SECONDS = Histogram('stock_poll_duration_seconds', '每輪觀察清單報價輪詢的時間')
+
+
+class QuotePublisher:
+    """
+    行程內共用的報價發布者：每次報價變動就遞增版本號並喚醒等待中的訂閱者。
+    訂閱者只需記住自己看過的版本號，不各自保留佇列，閒置連線幾乎不佔記憶體。
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._latest = {}   # 代碼 -> (版本號, 報價, (價格, 漲跌, 符號))
+        self._interest = {} # 代碼 -> 訂閱者數
+        self._cond = threading.Condition()
+
+    def publish(self, code, quote):
+        """發布報價；價格與漲跌都沒變時不通知。"""
+        self.publish_many([(code, quote)])
+
+    def publish_many(self, quotes):
+        """
+        一次發布多支股票的 (代碼, 報價)；整批最多只喚醒訂閱者一次，
+        輪詢一輪有多支股票變動時，每個訂閱者也只需重新檢查一次。
+        """
+        with self._cond:
+            notify = False
+            for code, quote in quotes:
+                key = (quote['price'], quote['change'], quote['sign'])
+                item = self._latest.get(code)
+                if item is not None and item[2] == key:
+                    continue
+                self.version += 1
+                self._latest[code] = (self.version, quote, key)
+                notify = notify or code in self._interest
+            if notify:
+                self._cond.notify_all()
+
+    def subscribe(self, codes, limit=None, watched=()):
+        """
+        訂閱 codes，回傳是否成功。指定 limit 時，訂閱後與 watched 合計的相異代碼數超過 limit 就不訂閱，
+        檢查與登記在同一個鎖內完成，同時到達的連線不會一起超過上限。
+        """
+        with self._cond:
+            if limit is not None and len(set(watched).union(self._interest, codes)) > limit:
+                return False
+            for code in codes:
+                self._interest[code] = self._interest.get(code, 0) + 1
+            return True
+
+    def unsubscribe(self, codes):
+        with self._cond:
+            for code in codes:
+                count = self._interest.get(code, 0) - 1
+                if count > 0:
+                    self._interest[code] = count
+                else:
+                    self._interest.pop(code, None)
+
+    def subscribed_codes(self):
+        with self._cond:
+            return list(self._interest)
+
+    def wait(self, codes, since, timeout):
+        """
+        等待 codes 中任一代碼出現比 since 新的報價，最多 timeout 秒。
+        回傳 (目前版本號, [變動的報價])；逾時則列表為空。
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                changed = [item[1] for item in map(self._latest.get, codes) if item is not None and item[0] > since]
+                remaining = deadline - time.monotonic()
+                if changed or remaining <= 0:
+                    return self.version, changed
+                self._cond.wait(remaining)
+
+
+_quote_publisher = QuotePublisher()
 
-# 初始化 Flask 應用程式
-app = Flask(__name__)
 
-# --- 輔助函式：電子發票兌獎邏輯 ---
-def check_invoice_number(num):
+def taiwan_market_open(now=None):
+    """判斷目前是否為台股交易時段。"""
+    now = now or datetime.now(TAIPEI_TZ)
+    return now.weekday() < 5 and MARKET_OPEN <= (now.hour, now.minute) < MARKET_CLOSE
+
+
+def stock_poll_interval(now=None):
+    """依是否開盤回傳目前的輪詢間隔（秒）。"""
+    return STOCK_POLL_INTERVAL if taiwan_market_open(now) else STOCK_POLL_CLOSED_INTERVAL
+
+
+def seconds_until_market_open(now=None):
+    """距離下一次開盤（週一至週五 09:00）的秒數；目前已開盤時回傳 0。"""
+    now = now or datetime.now(TAIPEI_TZ)
+    if taiwan_market_open(now):
+        return 0.0
+    opening = now.replace(hour=MARKET_OPEN[0], minute=MARKET_OPEN[1], second=0, microsecond=0)
+    while opening <= now or opening.weekday() >= 5:
+        opening += timedelta(days=1)
+    return (opening - now).total_seconds()
+
+
+def get_watchlist(name):
+    """回傳觀察清單中的代碼（依代碼排序）。"""
+    return [code for code, in db_execute('SELECT code FROM watchlists WHERE name = ? ORDER BY code', (name,))]
+
+
+def _watchlist_token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _check_watchlist_owner(name, token):
     """
-    檢查輸入的發票號碼是否中獎。
-    此函式會從財政部網站抓取最新中獎號碼。
+    清單已有擁有者時檢查權杖，不符時拋出 PermissionError；回傳清單是否已有擁有者。
     """
-    try:
-        url = 'https://invoice.etax.nat.gov.tw/index.html'
-        web = requests.get(url, timeout=10)
-        web.raise_for_status()
-        web.encoding = 'utf-8'
-
-        soup = BeautifulSoup(web.text, 'html.parser')
-        td = soup.select('.container-fluid')[0].select('.etw-tbiggest')
-
-        ns = td[0].getText() # 特別獎
-        n1 = td[1].getText() # 特獎
-        n2 = [td[2].getText()[-8:], td[3].getText()[-8:], td[4].getText()[-8:]] # 頭獎
-
-        if num == ns:
-            return "🎉 恭喜中獎 1000 萬元"
-        elif num == n1:
-            return "🎉 恭喜中獎 200 萬元"
-        else:
-            matched = False
-            for i in n2:
-                if num == i:
-                    return "🎉 恭喜中獎 20 萬元"
-                    matched = True
-                    break
-                elif num[-7:] == i[-7:]:
-                    return "🎉 恭喜中獎 4 萬元"
-                    matched = True
-                    break
-                elif num[-6:] == i[-6:]:
-                    return "🎉 恭喜中獎 1 萬元"
-                    matched = True
-                    break
-                elif num[-5:] == i[-5:]:
-                    return "🎉 恭喜中獎 4000 元"
-                    matched = True
-                    break
-                elif num[-4:] == i[-4:]:
-                    return "🎉 恭喜中獎 1000 元"
-                    matched = True
-                    break
-                elif num[-3:] == i[-3:]:
-                    return "🎉 恭喜中獎 200 元"
-                    matched = True
-                    break
-            if not matched:
-                return "😢 很抱歉，沒中獎"
-    except requests.exceptions.RequestException as e:
-        return f"無法連接至電子發票網站，請檢查網路連線或稍後再試。詳細錯誤: {e}"
-    except Exception as e:
-        return f"處理發票兌獎時發生錯誤：{e}"
+    rows = db_execute('SELECT token_hash FROM watchlist_owners WHERE name = ?', (name,))
+    if not rows:
+        return False
+    if not token or not hmac.compare_digest(rows[0][0], _watchlist_token_hash(token)):
+        raise PermissionError(f'觀察清單「{name}」已由他人建立，修改或刪除時需提供建立時取得的權杖')
+    return True
 
-# --- 輔助函式：股票查詢邏輯 ---
-def get_stock_details(code):
+
+def save_watchlist(name, codes, token=None):
     """
-    查詢單一股票的即時資訊 (名稱、價格、漲跌)。
+    以新的代碼取代整份觀察清單；codes 為空時刪除清單。回傳 (代碼, 新權杖)。
+    新建清單時發給一組權杖（只回傳這一次），之後修改或刪除都需附上；權杖不符時拋出 PermissionError。
+    格式不符或超過清單數、代碼總數上限時拋出 ValueError。
     """
-    try:
-        url = f'https://tw.stock.yahoo.com/quote/{code}'
-        web = requests.get(url, timeout=10)
-        web.raise_for_status()
-        soup = BeautifulSoup(web.text, 'html.parser')
-
-        # --- 提取股票名稱（公司名稱 + 股票代碼） ---
-        formatted_title = f'【{code}】' # 預設值，以防所有提取失敗
-
-        # 優先從 HTML 的 <title> 標籤中提取完整名稱，這通常最穩定
-        html_title_tag = soup.find('title')
-        if html_title_tag:
-            full_title_text = html_title_tag.get_text().strip()
-            # 範例格式: "公司名稱 (股票代碼) - Yahoo奇摩股市"
-            parts = full_title_text.split(' - Yahoo')
-            if len(parts) > 0:
-                extracted_name_from_title = parts[0].strip()
-                if f'({code})' in extracted_name_from_title:
-                    formatted_title = f'【{extracted_name_from_title}】'
-                else:
-                    formatted_title = f'【{extracted_name_from_title} ({code})】'
-
-        # 如果從 <title> 標籤未能得到理想結果，則嘗試從 <h1> 標籤獲取
-        if formatted_title == f'【{code}】':
-            h1_title_tag = soup.select_one('h1.C($c-link-text).Fz(24px).Mend(8px)')
-            if not h1_title_tag:
-                h1_title_tag = soup.select_one('div.D\\(ib\\).Mend\\(8px\\) > h1')
-
-            if h1_title_tag:
-                raw_h1_text = h1_title_tag.get_text().strip()
-                if raw_h1_text:
-                    if f'({code})' in raw_h1_text or code in raw_h1_text:
-                        formatted_title = f'【{raw_h1_text}】'
-                    else:
-                        formatted_title = f'【{raw_h1_text} ({code})】'
-
-        # 提取股價與漲跌
-        price_tag = soup.select_one('.Fz\\(32px\\)')
-        change_tag = soup.select_one('.Fz\\(20px\\)')
-
-        price = price_tag.get_text() if price_tag else 'N/A'
-        change_value = change_tag.get_text() if change_tag else 'N/A'
-
-        # 判斷漲跌符號（根據 CSS Class）
-        s = ''
-        if soup.select_one('#main-0-QuoteHeader-Proxy .C\\(\\$c-trend-up\\)'):
-            s = '+'
-        elif soup.select_one('#main-0-QuoteHeader-Proxy .C\\(\\$c-trend-down\\)'):
-            s = '-'
+    if not WATCHLIST_NAME_RE.fullmatch(name):
+        raise ValueError(f'觀察清單名稱格式錯誤：{name}')
+    codes = list(dict.fromkeys(codes))
+    bad = [code for code in codes if not STOCK_CODE_RE.fullmatch(code)]
+    if bad:
+        raise ValueError(f'股票代碼格式錯誤：{", ".join(bad)}')
+    if len(codes) > WATCHLIST_MAX_CODES:
+        raise ValueError(f'每份觀察清單最多 {WATCHLIST_MAX_CODES} 支股票')
+    owned = _check_watchlist_owner(name, token)
+    if not codes:
+        db_execute('DELETE FROM watchlists WHERE name = ?', (name,))
+        db_execute('DELETE FROM watchlist_owners WHERE name = ?', (name,))
+        return [], None
 
-        return f'{formatted_title}：{price} ({s}{change_value})'
+    others = {code for code, in db_execute('SELECT DISTINCT code FROM watchlists WHERE name != ?', (name,))}
+    # 即時推播訂閱中的代碼也在輪詢範圍內，一併計入
+    if len(others.union(codes, _quote_publisher.subscribed_codes())) > STOCK_POLL_MAX_CODES:
+        raise ValueError(f'所有觀察清單合計最多 {STOCK_POLL_MAX_CODES} 支股票，目前已無空間')
+    new_token = None
+    if not owned:
+        (lists,), = db_execute('SELECT COUNT(*) FROM watchlist_owners')
+        if lists >= WATCHLIST_MAX_LISTS:
+            raise ValueError(f'觀察清單已達 {WATCHLIST_MAX_LISTS} 份上限')
+        # 同時建立同名清單時只有一方寫入成功，另一方再檢查一次權杖就會被拒絕
+        new_token = secrets.token_urlsafe(16)
+        db_execute('INSERT OR IGNORE INTO watchlist_owners (name, token_hash) VALUES (?, ?)',
+                   (name, _watchlist_token_hash(new_token)))
+        _check_watchlist_owner(name, new_token)
+    db_execute('DELETE FROM watchlists WHERE name = ?', (name,))
+    db_execute('INSERT INTO watchlists (name, code) VALUES (?, ?)', [(name, code) for code in codes], many=True)
+    ensure_stock_poller()
+    return codes, new_token
+
+
+def watched_stock_codes():
+    """所有觀察清單的代碼聯集（已去除重複）。"""
+    return [code for code, in db_execute('SELECT DISTINCT code FROM watchlists')]
+
+
+def get_snapshot_quote(code):
+    """
+    回傳輪詢快照中仍在有效期間內的報價（兩個輪詢間隔內），否則回傳 None。
+    收盤後輪詢間隔較長，但價格不再變動，快照仍然正確。
+    """
+    item = _quote_snapshot.get(code)
+    if item is None or time.time() - item[1] > 2 * stock_poll_interval():
+        return None
+    return item[0]
+
+
+def poll_watched_quotes():
+    """
+    抓取所有觀察中（含即時推播訂閱中）代碼的最新報價並替換快照；上游負載只與相異代碼數有關，與使用者人數無關。
+    多個 worker 時只有持有輪詢租約的 worker 向上游抓取，其他 worker 由共用快取讀取同一份快照。
+    個別代碼失敗時保留上一次的報價。
+    """
+    global _quote_snapshot
+    watched = set(watched_stock_codes())
+    # 觀察清單的代碼優先；即時推播訂閱時已檢查過上限（見 stock_events），這裡截斷只是保險
+    extra = sorted(set(_quote_publisher.subscribed_codes()) - watched)
+    codes = (sorted(watched) + extra)[:STOCK_POLL_MAX_CODES]
+    STOCK_WATCHED_CODES.set(value=len(codes))
+    snapshot = {}
+    published = []
+    if not _shared_cache.acquire_lease('stock-poller', 3 * stock_poll_interval()):
+        now = time.time()
+        shared = _shared_cache.get_many([f'quote:{code}' for code in codes])
+        for code in codes:
+            item = shared.get(f'quote:{code}')
+            if item is not None:
+                snapshot[code] = (item[0], now - item[1])
+                published.append((code, item[0]))
+            elif code in _quote_snapshot:
+                snapshot[code] = _quote_snapshot[code]
+        _quote_snapshot = snapshot
+        _quote_publisher.publish_many(published)
+        return
+
+    futures = {code: _poll_executor.submit(fetch_stock_quote, code, STOCK_CODE_TIMEOUT) for code in codes}
+    for code, future in futures.items():
+        try:
+            quote = future.result()
+        except Exception as e:
+            app.logger.debug("輪詢 %s 報價失敗: %s", code, e)
+            if code in _quote_snapshot:
+                snapshot[code] = _quote_snapshot[code]
+            continue
+        snapshot[code] = (quote, time.time())
+        _quote_cache.set(code, quote)
+        _shared_cache.set(f'quote:{code}', quote, STOCK_QUOTE_TTL)
+        published.append((code, quote))
+    _quote_snapshot = snapshot
+    _quote_publisher.publish_many(published)
+
+
+def _stock_poller_loop():
+    while True:
+        started = time.monotonic()
+        try:
+            with STOCK_POLL_SECONDS.time():
+                poll_watched_quotes()
+        except Exception as e:
+            app.logger.warning("背景輪詢報價時發生錯誤: %s", e)
+        # 收盤後的長間隔不跨過開盤時間，開盤後第一輪就能輪詢
+        interval = min(stock_poll_interval(), seconds_until_market_open() or STOCK_POLL_INTERVAL)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
 
-    except requests.exceptions.RequestException as e:
-        return f'【{code}】查詢失敗：無法連接或網路錯誤。詳細錯誤: {e}'
-    except AttributeError: # 處理 select_one 可能返回 None 的情況
-        return f'【{code}】查詢失敗：找不到股價資料或網頁結構已改變。'
-    except IndexError: # 處理 select 返回空列表的情況
-        return f'【{code}】查詢失敗：找不到股價資料或網頁結構已改變。'
-    except Exception as e:
-        return f'【{code}】查詢失敗：發生未預期錯誤。詳細錯誤: {e}'
+
+def ensure_stock_poller():
+    """
+    啟動背景報價輪詢執行緒（每個行程一條；gunicorn fork 出的 worker 會各自啟動）。
+    """
+    if not STOCK_POLLER_ENABLED or _stock_poller['pid'] == os.getpid():
+        return
+    with _stock_poller_lock:
+        if _stock_poller['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=_stock_poller_loop, name='stock-poller', daemon=True)
+        _stock_poller.update(pid=os.getpid(), thread=thread)
+    thread.start()
 
 # --- 輔助函式：即時匯率查詢邏輯 ---
-def get_exchange_rates():
+RATE_URL = os.environ.get('RATE_URL') or upstream_url('https://rate.bot.com.tw/xrt/flcsv/0/day', '/rates/flcsv')  # 台灣銀行即時匯率CSV檔案網址
+# 背景更新匯率的間隔（秒）；RATE_REFRESHER=0 時停用定時更新，改為由請求觸發
+RATE_REFRESH_INTERVAL = float(os.environ.get('RATE_REFRESH_INTERVAL', 300))
+RATE_REFRESHER_ENABLED = os.environ.get('RATE_REFRESHER', '1') != '0'
+# 匯率表超過多少秒未能確認時，在頁面上標示資料時間
+RATE_STALE_NOTICE_SECONDS = float(os.environ.get('RATE_STALE_NOTICE_SECONDS', 2 * RATE_REFRESH_INTERVAL))
+
+# 記憶體中的匯率表，由背景執行緒定期更新
+# verified_at：最近一次成功向台灣銀行確認（200 或 304）的時間，用來計算資料新舊
+_rate_state = {'rates': None, 'etag': None, 'last_modified': None, 'fetched_at': 0.0, 'checked_at': 0.0, 'verified_at': 0.0,
+               'sampled_at': 0.0}
+_rate_lock = threading.Lock()
+_rate_refresher = {'pid': None, 'thread': None}
+_rate_flight = SingleFlight()
+
+# 單一貨幣的牌告匯率（台幣計價）；None 表示台灣銀行未提供該項匯率
+ExchangeRate = namedtuple('ExchangeRate', 'currency cash_buy cash_sell spot_buy spot_sell')
+
+
+def _rate_value(text):
+    """將 CSV 欄位轉為匯率數值；台灣銀行以 0 表示不提供該匯率，轉為 None。"""
+    value = float(text)
+    return value if value > 0 else None
+
+
+def parse_exchange_rates_csv(rt_text):
+    """
+    解析台灣銀行匯率 CSV，回傳以貨幣代碼為鍵的 ExchangeRate 表（保持 CSV 順序）。
+    欄位：0 幣別、2/3 本行買入現金/即期、12/13 本行賣出現金/即期。
+    """
+    rts_lines = rt_text.split('\n')                 # 以換行符號分割成列表
+
+    table = {}
+    # 從第二行開始讀取，因為第一行通常是標頭
+    for line in rts_lines[1:]: # 跳過CSV標題行
+        try:
+            if not line.strip(): # 跳過空行
+                continue
+            a = line.split(',')                     # 以逗號分割成列表
+            # 確保a的長度足夠，避免IndexError
+            if len(a) > 13:
+                currency_name = a[0].strip() # 貨幣名稱
+                table[currency_name] = ExchangeRate(
+                    currency_name,
+                    _rate_value(a[2]), _rate_value(a[12]),
+                    _rate_value(a[3]), _rate_value(a[13]),
+                )
+        except (IndexError, ValueError):
+            # 處理行內數據不完整的錯誤
+            PARSE_ERRORS.inc('bot_csv')
+            continue
+        except Exception as e:
+            # 處理其他行內處理錯誤
+            PARSE_ERRORS.inc('bot_csv')
+            app.logger.warning("處理匯率數據時發生錯誤: %s", e)
+            continue # 繼續處理下一行
+    return table
+
+
+def convert_currency(table, amount, from_currency, to_currency, kind='spot'):
+    """
+    依台灣銀行牌告匯率換算金額，kind 為 'cash' 或 'spot'。
+    外幣換台幣以本行買入價計算，台幣換外幣以本行賣出價計算，外幣互換則經由台幣。
+    回傳 (換算後金額, 實際使用的匯率)；查無匯率時拋出 KeyError。
     """
-    從台灣銀行CSV檔案抓取即時匯率資訊。
-    回傳一個包含各貨幣名稱和現金賣出匯率的列表。
+    rate = 1.0
+    if from_currency != 'TWD':
+        buy = getattr(table[from_currency], f'{kind}_buy')
+        if buy is None:
+            raise KeyError(from_currency)
+        rate *= buy
+    if to_currency != 'TWD':
+        sell = getattr(table[to_currency], f'{kind}_sell')
+        if sell is None:
+            raise KeyError(to_currency)
+        rate /= sell
+    return amount * rate, rate
+
+
+def refresh_exchange_rates():
+    """
+    更新匯率表，回傳是否有新資料。
+    多個 worker 時先看共用快取：一個更新間隔內有 worker 確認過就不再連線（較新的直接採用）；
+    否則只有拿到租約的 worker 向台灣銀行抓取，其餘沿用手上的匯率表。
+    """
+    shared = _shared_cache.get('rates')
+    if shared is not None and time.time() - shared[0]['verified_at'] < RATE_REFRESH_INTERVAL:
+        if _adopt_shared_exchange_rates(shared[0]):
+            return True
+        # 手上的已是同一份：從對方確認的時間起算下一次檢查
+        _rate_state['checked_at'] = max(_rate_state['checked_at'], shared[0]['verified_at'])
+        return False
+    lease_seconds = HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT
+    if not _shared_cache.acquire_lease('rates', lease_seconds):
+        if _rate_state['rates'] is not None:
+            # 其他 worker 正在抓取：等它的租約時間過後再檢查一次（屆時共用快取已有新匯率表），
+            # 否則定時更新執行緒會不斷重試而空轉
+            _rate_state['checked_at'] = time.time() - RATE_REFRESH_INTERVAL + min(lease_seconds, RATE_REFRESH_INTERVAL)
+            return False
+        state = _shared_cache.wait_for('rates', RATE_REFRESH_INTERVAL, SHARED_LEASE_WAIT)
+        if state is not None and _adopt_shared_exchange_rates(state):
+            return True
+    try:
+        return _fetch_exchange_rates()
+    finally:
+        _shared_cache.release_lease('rates')
+
+
+def _share_exchange_rates():
+    """將目前的匯率表存入共用快取，供其他 worker 採用。"""
+    state = {key: _rate_state[key] for key in ('etag', 'last_modified', 'fetched_at', 'verified_at', 'sampled_at')}
+    state['rates'] = {currency: list(rate[1:]) for currency, rate in _rate_state['rates'].items()}
+    _shared_cache.set('rates', state, RATE_REFRESH_INTERVAL)
+
+
+def _adopt_shared_exchange_rates(state):
+    """採用共用快取中比手上新的匯率表；回傳是否採用。"""
+    if state['verified_at'] <= _rate_state['verified_at']:
+        return False
+    rates = {currency: ExchangeRate(currency, *values) for currency, values in state['rates'].items()}
+    if state['fetched_at'] > _rate_state['fetched_at']:
+        record_rate_history(rates, state['sampled_at'])
+    with _rate_lock:
+        _rate_state.update(
+            rates=rates,
+            etag=state['etag'],
+            last_modified=state['last_modified'],
+            fetched_at=state['fetched_at'],
+            checked_at=time.time(),
+            verified_at=state['verified_at'],
+            sampled_at=state['sampled_at'],
+        )
+    return True
+
+
+def _fetch_exchange_rates():
+    """
+    以條件式請求 (ETag / Last-Modified) 向台灣銀行更新匯率表，並存入共用快取。
+    資料未變動時伺服器回應 304，不需重新下載與解析。回傳是否有新資料。
     """
+    headers = {}
+    if _rate_state['etag']:
+        headers['If-None-Match'] = _rate_state['etag']
+    if _rate_state['last_modified']:
+        headers['If-Modified-Since'] = _rate_state['last_modified']
+
+    rate_response = http_get(RATE_URL, headers=headers, upstream='bot')   # 發送GET請求
+    now = time.time()
+    if rate_response.status_code == 304:
+        CACHE_LOOKUPS.inc('rates_conditional', 'hit')
+        _rate_state.update(checked_at=now, verified_at=now)
+        _share_exchange_rates()
+        return False
+    CACHE_LOOKUPS.inc('rates_conditional', 'miss')
+    rate_response.raise_for_status()                # 檢查 HTTP 請求是否成功
+    rate_response.encoding = 'utf-8'                # 設定編碼為UTF-8
+
+    with PARSE_SECONDS.time('bot_csv'):
+        rates = parse_exchange_rates_csv(rate_response.text)
+    # 以台灣銀行的 Last-Modified 作為樣本時間，多個 worker 抓到同一份資料時只記一筆
+    last_modified = rate_response.headers.get('Last-Modified')
     try:
-        url = 'https://rate.bot.com.tw/xrt/flcsv/0/day'  # 台灣銀行即時匯率CSV檔案網址
-        rate_response = requests.get(url, timeout=10)   # 發送GET請求
-        rate_response.raise_for_status()                # 檢查 HTTP 請求是否成功
-        rate_response.encoding = 'utf-8'                # 設定編碼為UTF-8
+        sampled_at = parsedate_to_datetime(last_modified).timestamp() if last_modified else now
+    except (TypeError, ValueError):
+        sampled_at = now
+    record_rate_history(rates, sampled_at)
+    with _rate_lock:
+        _rate_state.update(
+            rates=rates,
+            etag=rate_response.headers.get('ETag'),
+            last_modified=rate_response.headers.get('Last-Modified'),
+            fetched_at=now,
+            checked_at=now,
+            verified_at=now,
+            sampled_at=sampled_at,
+        )
+    _share_exchange_rates()
+    return True
+
+
+def _rate_refresher_loop():
+    while True:
+        # 距離上次檢查未滿一個間隔（例如剛由請求同步抓取過）就先等待
+        wait_seconds = _rate_state['checked_at'] + RATE_REFRESH_INTERVAL - time.time()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        try:
+            refresh_exchange_rates()
+        except Exception as e:
+            # 更新失敗時保留上一份匯率表，下次再試
+            app.logger.warning("背景更新匯率時發生錯誤: %s", e)
+            _rate_state['checked_at'] = time.time()
 
-        rt_text = rate_response.text                    # 取得回應的文字內容
-        rts_lines = rt_text.split('\n')                 # 以換行符號分割成列表
 
-        exchange_rate_list = []
-        # 從第二行開始讀取，因為第一行通常是標頭
-        for line in rts_lines[1:]: # 跳過CSV標題行
+def start_exchange_rate_refresher():
+    """
+    啟動背景匯率更新執行緒（每個行程一條；gunicorn fork 出的 worker 會各自啟動）。
+    """
+    with _rate_lock:
+        if _rate_refresher['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=_rate_refresher_loop, name='rate-refresher', daemon=True)
+        _rate_refresher.update(pid=os.getpid(), thread=thread)
+    thread.start()
+
+
+def ensure_exchange_rates():
+    """
+    確保記憶體中已有匯率表並回傳；尚無任何資料時網路錯誤會直接拋出。
+    """
+    if _rate_state['rates'] is None:
+        # 尚無資料（剛啟動）時才在請求中同步抓取，同時到達的請求共用一次抓取
+        _rate_flight.do('rates', refresh_exchange_rates)
+    elif not RATE_REFRESHER_ENABLED and time.time() - _rate_state['checked_at'] >= RATE_REFRESH_INTERVAL:
+        # 停用定時更新時由請求觸發更新：上游正常時同步更新；
+        # 台灣銀行斷路器開啟時改在背景更新，抓取失敗或逾時也先回傳手上的匯率表
+        if _circuit_breaker('bot').state == 'open':
+            refresh_in_background('rates', refresh_exchange_rates)
+        else:
             try:
-                if not line.strip(): # 跳過空行
-                    continue
-                a = line.split(',')                     # 以逗號分割成列表
-                # 確保a的長度足夠，避免IndexError
-                if len(a) > 12:
-                    currency_name = a[0].strip() # 貨幣名稱
-                    cash_selling_rate = a[12].strip() # 現金賣出匯率
-                    exchange_rate_list.append(f'{currency_name} : {cash_selling_rate}')
-            except IndexError:
-                # 處理行內數據不完整的錯誤
-                continue
-            except Exception as e:
-                # 處理其他行內處理錯誤
-                print(f"處理匯率數據時發生錯誤: {e}")
-                continue # 繼續處理下一行
-        return exchange_rate_list
+                _rate_flight.do('rates', refresh_exchange_rates)
+            except requests.exceptions.RequestException as e:
+                app.logger.warning("更新匯率失敗，繼續使用舊資料: %s", e)
+    if RATE_REFRESHER_ENABLED:
+        start_exchange_rate_refresher()
+    return _rate_state['rates']
+
+
+def exchange_rates_age():
+    """回傳匯率表距最近一次成功確認的秒數。"""
+    return time.time() - _rate_state['verified_at']
+
+
+# --- 輔助工具：匯率歷史（環狀緩衝區） ---
+# 每種貨幣保留的樣本數（固定記憶體；以每 5 分鐘一筆計約 8 週）；設定 RATE_HISTORY_DIR 時以 mmap 檔保存
+RATE_HISTORY_SIZE = int(os.environ.get('RATE_HISTORY_SIZE', 16384))
+RATE_HISTORY_DIR = os.environ.get('RATE_HISTORY_DIR', '')
+RATE_HISTORY_FIELDS = ('cash_buy', 'cash_sell', 'spot_buy', 'spot_sell')
+# 以 numpy 向量運算計算統計（列於 requirements.txt；匯入較慢，第一次查詢時才載入）。
+# 未安裝時退回 array 與內建函式，只供沒有 numpy 的開發環境使用，部署時不應走這條路徑
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+RATE_WINDOW_RE = re.compile(r'(\d+)([mhdw])')
+RATE_WINDOW_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+CURRENCY_RE = re.compile(r'[A-Z]{3}')
+
+_rate_histories = {}
+_rate_history_lock = threading.Lock()
+
+
+class RateHistory:
+    """
+    單一貨幣的匯率歷史：固定容量的環狀緩衝區。
+    時間與四種匯率各佔一段連續的 float64（缺值為 NaN），統計時可整段交給 numpy 或內建函式。
+    指定 path 時以記憶體映射檔保存：重新啟動後保留，同一台機器的 worker 共用同一份頁面快取。
+    """
+    HEADER = struct.Struct('=8sQQ') # 識別碼、容量、累計寫入筆數
+    MAGIC = b'RATEHIS1'
+    COLUMNS = ('time',) + RATE_HISTORY_FIELDS
+    VALUE = struct.Struct('=d')
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._fd = None
+        size = self.HEADER.size + capacity * len(self.COLUMNS) * 8
+        if path is None:
+            self._buf = bytearray(size)
+            self.HEADER.pack_into(self._buf, 0, self.MAGIC, capacity, 0)
+            return
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._buf = mmap.mmap(self._fd, size)
+            magic, stored_capacity, _ = self.HEADER.unpack_from(self._buf, 0)
+            if magic != self.MAGIC or stored_capacity != capacity:
+                # 新檔或容量改變：清空重來
+                self._buf[:] = bytes(size)
+                self.HEADER.pack_into(self._buf, 0, self.MAGIC, capacity, 0)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._fd is not None and fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self._fd is not None and fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, column, slot=0):
+        return self.HEADER.size + (column * self.capacity + slot) * 8
+
+    def append(self, timestamp, values):
+        """
+        新增一筆樣本；時間不晚於最後一筆時略過（多個 worker 寫入同一份檔案時不會重複）。
+        回傳是否有寫入。
+        """
+        with self._locked():
+            written = self.HEADER.unpack_from(self._buf, 0)[2]
+            if written:
+                last = self.VALUE.unpack_from(self._buf, self._offset(0, (written - 1) % self.capacity))[0]
+                if timestamp <= last:
+                    return False
+            slot = written % self.capacity
+            for column, value in enumerate((timestamp,) + tuple(values)):
+                self.VALUE.pack_into(self._buf, self._offset(column, slot), float('nan') if value is None else value)
+            self.HEADER.pack_into(self._buf, 0, self.MAGIC, self.capacity, written + 1)
+            return True
+
+    def columns(self):
+        """
+        依時間先後回傳各欄位的複本：有 numpy 時為 ndarray，否則為 array('d')。
+        """
+        with self._locked():
+            written = self.HEADER.unpack_from(self._buf, 0)[2]
+            count = min(written, self.capacity)
+            head = written % self.capacity if written > self.capacity else 0
+            if HAS_NUMPY:
+                import numpy
+            result = {}
+            for column, name in enumerate(self.COLUMNS):
+                start = self._offset(column)
+                if HAS_NUMPY:
+                    data = numpy.frombuffer(self._buf, dtype=numpy.float64, count=self.capacity, offset=start)
+                    result[name] = numpy.concatenate((data[head:count], data[:head]))
+                else:
+                    raw = memoryview(self._buf)[start:start + self.capacity * 8]
+                    data = array('d')
+                    data.frombytes(raw[head * 8:count * 8])
+                    data.frombytes(raw[:head * 8])
+                    raw.release()
+                    result[name] = data
+            return result
+
+
+def get_rate_history(currency, create=True):
+    """取得某貨幣的歷史緩衝區；create=False 時只開啟已存在的（記憶體中或檔案）。"""
+    with _rate_history_lock:
+        history = _rate_histories.get(currency)
+        if history is None:
+            path = os.path.join(RATE_HISTORY_DIR, f'{currency}.bin') if RATE_HISTORY_DIR else None
+            if not create and (path is None or not os.path.exists(path)):
+                return None
+            if path:
+                os.makedirs(RATE_HISTORY_DIR, exist_ok=True)
+            history = _rate_histories[currency] = RateHistory(RATE_HISTORY_SIZE, path)
+        return history
+
+
+def record_rate_history(rates, timestamp):
+    """將一份匯率表的每種貨幣各新增一筆樣本。"""
+    for currency, rate in rates.items():
+        if CURRENCY_RE.fullmatch(currency):
+            get_rate_history(currency).append(timestamp, [getattr(rate, field) for field in RATE_HISTORY_FIELDS])
+
+
+def parse_rate_window(text):
+    """將「30m」、「12h」、「7d」、「4w」轉為秒數；格式錯誤時拋出 ValueError。"""
+    m = RATE_WINDOW_RE.fullmatch(text)
+    if not m or int(m.group(1)) <= 0:
+        raise ValueError(f'時間區間格式錯誤：{text}')
+    return int(m.group(1)) * RATE_WINDOW_SECONDS[m.group(2)]
+
+
+def rate_window_stats(times, values, since):
+    """
+    計算 since 之後樣本的最小值、最大值、平均（即該區間的移動平均）與漲跌幅 (%)。
+    times 已依時間排序，以二分搜尋找出區間起點。
+    """
+    if HAS_NUMPY:
+        import numpy
+        window = values[numpy.searchsorted(times, since):]
+        window = window[~numpy.isnan(window)]
+        count = len(window)
+        if count:
+            low, high, avg = float(window.min()), float(window.max()), float(window.mean())
+    else:
+        window = [v for v in values[bisect_left(times, since):] if v == v] # 略過 NaN
+        count = len(window)
+        if count:
+            low, high, avg = min(window), max(window), sum(window) / count
+    if not count:
+        return {'samples': 0, 'min': None, 'max': None, 'avg': None, 'first': None, 'last': None, 'change_pct': None}
+
+    first, last = float(window[0]), float(window[-1])
+    return {
+        'samples': count,
+        'min': low,
+        'max': high,
+        'avg': round(avg, 6),
+        'first': first,
+        'last': last,
+        'change_pct': round((last - first) / first * 100, 4) if first else None,
+    }
+
+
+def get_exchange_rates(currencies=None):
+    """
+    取得台灣銀行即時匯率資訊（直接由記憶體中的匯率表提供）。
+    回傳一個包含各貨幣名稱和現金賣出匯率的列表；可用 currencies 只列出指定貨幣。
+    """
+    try:
+        table = ensure_exchange_rates()
+        if currencies:
+            rates = [table[c] for c in currencies if c in table]
+        else:
+            rates = table.values()
+        return [
+            f'{rate.currency} : {rate.cash_sell:.5f}' if rate.cash_sell is not None else f'{rate.currency} : -'
+            for rate in rates
+        ]
+    except UpstreamBusy:
+        return ["目前匯率查詢量過大，請稍後再試。"]
     except requests.exceptions.RequestException as e:
         return [f"無法連接至台灣銀行匯率網站，請檢查網路連線或稍後再試。詳細錯誤: {e}"]
     except Exception as e:
         return [f"處理匯率查詢時發生錯誤：{e}"]
 
+# --- 輔助工具：啟動預熱與就緒檢查 ---
+# WARM_PREFETCH=1（預設）時，worker 啟動後先抓好中獎號碼與匯率表，完成前 /readyz 回應 503
+WARM_PREFETCH = os.environ.get('WARM_PREFETCH', '1') != '0'
+# 預熱最多花多久（秒）；上游持續失敗時仍會在時限後宣告就緒（標示 degraded），避免部署卡住
+WARM_STARTUP_TIMEOUT = float(os.environ.get('WARM_STARTUP_TIMEOUT', 20))
+
+_warm_state = {'pid': None, 'ready': False, 'degraded': False, 'started_at': 0.0, 'ready_at': 0.0, 'steps': {}}
+_warm_lock = threading.Lock()
+
+
+def warm_imports():
+    """
+    匯入只有解析時才用到的函式庫。gunicorn preload 時由 master 在 fork 前呼叫，worker 直接共用已載入的模組。
+    """
+    import bs4 # noqa: F401
+    if STOCK_HTML_PARSER == 'lxml':
+        import lxml.etree # noqa: F401
+    if HAS_NUMPY:
+        import numpy # noqa: F401
+
+
+def _warm_up():
+    steps = _warm_state['steps']
+    tasks = {'imports': warm_imports}
+    if WARM_PREFETCH:
+        tasks.update(invoice=get_invoice_numbers, rates=ensure_exchange_rates)
+    deadline = time.monotonic() + WARM_STARTUP_TIMEOUT
+    delay = 0.5
+    while tasks:
+        for name, fn in list(tasks.items()):
+            start = time.perf_counter()
+            try:
+                fn()
+            except Exception as e:
+                steps[name] = f'error: {e}'
+                continue
+            steps[name] = round(time.perf_counter() - start, 3)
+            del tasks[name]
+        if not tasks or time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+    if tasks:
+        app.logger.warning("啟動預熱未完成（%s），仍宣告就緒", ', '.join(tasks))
+    _warm_state.update(ready=True, degraded=bool(tasks), ready_at=time.time())
+
+
+def start_warm_up():
+    """
+    在背景執行緒預熱目前的 worker（每個行程一次）；由 gunicorn 的 post_worker_init 或第一次 /readyz 觸發。
+    """
+    with _warm_lock:
+        if _warm_state['pid'] == os.getpid():
+            return
+        _warm_state.update(pid=os.getpid(), ready=False, degraded=False, started_at=time.time(), ready_at=0.0, steps={})
+    threading.Thread(target=_warm_up, name='warm-up', daemon=True).start()
+
+
+@app.route('/readyz')
+def readyz():
+    start_warm_up()
+    state = _warm_state
+    payload = {
+        'ready': state['ready'],
+        'degraded': state['degraded'],
+        'steps': state['steps'],
+        'warm_seconds': round(state['ready_at'] - state['started_at'], 3) if state['ready'] else None,
+    }
+    response = json_response(payload, status=200 if state['ready'] else 503)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# --- 輔助工具：頁面快取、HTTP 快取標頭與壓縮 ---
+# 首頁與空白表單頁讓瀏覽器 / CDN 快取的秒數；匯率頁面資料會變動，另用較短的時間
+PAGE_MAX_AGE = int(os.environ.get('PAGE_MAX_AGE', 300))
+RATE_PAGE_MAX_AGE = int(os.environ.get('RATE_PAGE_MAX_AGE', 60))
+# 小於此大小 (bytes) 的回應不壓縮：壓縮省下的位元組不值得花費的 CPU
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'text/csv', 'application/json'}
+# 依偏好順序排列；客戶端對兩者品質相同時優先使用 brotli
+COMPRESS_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+CachedPage = namedtuple('CachedPage', ['body', 'etag'])
+# 已渲染的頁面，key 含資料版本：版本改變後舊頁面不再被查到，由 LRU 淘汰
+_page_cache = TTLCache(maxsize=256, ttl=24 * 3600)
+# 依 (ETag, 編碼) 保存壓縮結果，同一份內容只壓縮一次
+_compressed_cache = TTLCache(maxsize=512, ttl=24 * 3600)
+
+
+def _site_last_modified():
+    """模板與靜態檔中最新的修改時間，作為不含資料的頁面的 Last-Modified。"""
+    folders = [os.path.join(app.root_path, app.template_folder), app.static_folder]
+    return max(os.path.getmtime(os.path.join(folder, name)) for folder in folders for name in os.listdir(folder))
+
+
+SITE_LAST_MODIFIED = _site_last_modified()
+
+
+def render_page(template, **context):
+    """渲染頁面模板並計時（計入監控指標與 Server-Timing 的 render 階段）。"""
+    with RENDER_SECONDS.time(template):
+        return render_template(template, **context)
+
+
+def cached_page(key, version, render, last_modified=None, max_age=PAGE_MAX_AGE):
+    """
+    回傳已渲染頁面的回應；同一個 key 且資料版本相同時沿用上次的 HTML，不再重新渲染模板。
+    附上 ETag、Last-Modified 與 Cache-Control，客戶端帶條件式請求且內容未變時回應 304。
+    """
+    cache_key = (key, version)
+    page = _page_cache.get(cache_key)
+    if page is None:
+        CACHE_LOOKUPS.inc('page', 'miss')
+        body = render().encode('utf-8')
+        page = CachedPage(body, hashlib.md5(body).hexdigest())
+        _page_cache.set(cache_key, page)
+    else:
+        CACHE_LOOKUPS.inc('page', 'hit')
+    response = Response(page.body, mimetype='text/html')
+    response.set_etag(page.etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def static_page(template, **context):
+    """不含任何即時資料的頁面（首頁、空白表單），部署後內容固定。"""
+    return cached_page(template, None, lambda: render_page(template, **context), SITE_LAST_MODIFIED)
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+@app.after_request
+def compress_response(response):
+    """
+    依 Accept-Encoding 以 brotli 或 gzip 壓縮較大的文字回應。
+    串流回應（逐筆股票、SSE、批次兌獎）與靜態檔維持原樣，以免緩衝住整個串流。
+    """
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+    if encoding is None:
+        return response
+
+    etag, _ = response.get_etag()
+    body = _compressed_cache.get((etag, encoding)) if etag else None
+    if body is None:
+        body = compress_body(data, encoding)
+        if etag:
+            _compressed_cache.set((etag, encoding), body)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # 壓縮後的位元組與原文不同，改為弱 ETag；條件式請求以弱比對仍可得到 304
+        response.set_etag(etag, weak=True)
+    return response
+
 # --- 首頁路由 ---
 @app.route('/')
 def home():
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="zh-Hant">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>功能選單</title>
-            <script src="https://cdn.tailwindcss.com"></script>
-            <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-            <style>
-                body {
-                    font-family: 'Inter', sans-serif;
-                    background-color: #f0f4f8;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    min-height: 100vh;
-                    padding: 20px;
-                    box-sizing: border-box;
-                }
-                .container {
-                    max-width: 400px;
-                    width: 100%;
-                    background-color: #ffffff;
-                    border-radius: 1rem;
-                    box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
-                    padding: 2.5rem;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: center;
-                    gap: 1.5rem;
-                }
-                .header {
-                    color: #4f46e5;
-                    text-align: center;
-                }
-                .nav-list {
-                    width: 100%;
-                    list-style: none;
-                    padding: 0;
-                    margin: 0;
-                    display: flex;
-                    flex-direction: column;
-                    gap: 1rem;
-                }
-                .nav-list li {
-                    width: 100%;
-                }
-                .nav-list a {
-                    display: block;
-                    padding: 1rem 1.5rem;
-                    background-color: #6366f1;
-                    color: white;
-                    text-align: center;
-                    border-radius: 0.75rem;
-                    font-size: 1.1rem;
-                    font-weight: 600;
-                    transition: background-color 0.2s, transform 0.1s;
-                    box-shadow: 0 4px 10px rgba(99, 102, 241, 0.3);
-                }
-                .nav-list a:hover {
-                    background-color: #4f46e5;
-                    transform: translateY(-2px);
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1 class="text-3xl font-bold">歡迎使用</h1>
-                    <p class="text-lg mt-2 text-gray-600">請選擇一個功能</p>
-                </div>
-                <ul class="nav-list">
-                    <li><a href="/invoice">電子發票兌獎</a></li>
-                    <li><a href="/stock">多支股票查詢</a></li>
-                    <li><a href="/exchange_rate">即時匯率查詢</a></li> <!-- 新增匯率查詢連結 -->
-                </ul>
-            </div>
-        </body>
-        </html>
-    ''')
+    return static_page('index.html')
 
 # --- 電子發票兌獎路由 ---
 @app.route('/invoice', methods=['GET', 'POST'])
@@ -260,358 +2481,547 @@ def invoice():
     result = ""
     if request.method == 'POST':
         num = request.form['num'].strip()
-        result = check_invoice_number(num) # 呼叫輔助函式
-
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="zh-Hant">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>電子發票兌獎</title>
-            <script src="https://cdn.tailwindcss.com"></script>
-            <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-            <style>
-                body {
-                    font-family: 'Inter', sans-serif;
-                    background-color: #f0f4f8;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    min-height: 100vh;
-                    padding: 20px;
-                    box-sizing: border-box;
-                }
-                .container {
-                    max-width: 600px;
-                    width: 100%;
-                    background-color: #ffffff;
-                    border-radius: 1rem;
-                    box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
-                    padding: 2.5rem;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: center;
-                    gap: 1.5rem;
-                }
-                .header {
-                    color: #4f46e5;
-                    text-align: center;
-                }
-                form {
-                    width: 100%;
-                    display: flex;
-                    flex-direction: column;
-                    gap: 1rem;
-                    align-items: center;
-                }
-                form input[type="text"] {
-                    padding: 0.75rem 1rem;
-                    border: 2px solid #cbd5e1;
-                    border-radius: 0.5rem;
-                    font-size: 1rem;
-                    width: 100%;
-                    max-width: 300px;
-                    transition: border-color 0.2s;
-                }
-                form input[type="text"]:focus {
-                    outline: none;
-                    border-color: #4f46e5;
-                    box-shadow: 0 0 0 3px rgba(79, 70, 229, 0.2);
-                }
-                form input[type="submit"] {
-                    background-color: #22c55e;
-                    color: white;
-                    padding: 0.8rem 1.5rem;
-                    border-radius: 0.75rem;
-                    font-size: 1.1rem;
-                    font-weight: 600;
-                    cursor: pointer;
-                    transition: background-color 0.2s, transform 0.1s;
-                    border: none;
-                    outline: none;
-                    box-shadow: 0 5px 15px rgba(34, 197, 94, 0.3);
-                }
-                form input[type="submit"]:hover {
-                    background-color: #16a34a;
-                    transform: translateY(-2px);
-                }
-                .result-display {
-                    margin-top: 1.5rem;
-                    padding: 1rem;
-                    border-radius: 0.75rem;
-                    font-size: 1.25rem;
-                    font-weight: 600;
-                    text-align: center;
-                    width: 100%;
-                    background-color: #e2e8f0;
-                    color: #334155;
-                }
-                .home-link {
-                    margin-top: 1.5rem;
-                    color: #4f46e5;
-                    text-decoration: none;
-                    font-weight: 600;
-                    transition: color 0.2s;
-                }
-                .home-link:hover {
-                    color: #3b82f6;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h2 class="text-2xl font-bold">電子發票兌獎</h2>
-                    <p class="text-gray-600 mt-1">請輸入您的發票號碼進行兌獎</p>
-                </div>
-                <form method="post">
-                    發票號碼：<input type="text" name="num" maxlength="8" placeholder="請輸入8位數字" pattern="\\d{8}" title="請輸入8位數字的發票號碼" required>
-                    <input type="submit" value="兌獎">
-                </form>
-                <p class="result-display">{{ result }}</p>
-                <a href="/" class="home-link">回首頁</a>
-            </div>
-        </body>
-        </html>
-    ''', result=result)
+        try:
+            # 可依發票日期或期別兌領上一期的發票
+            period = parse_invoice_period(request.form.get('period', '').strip(), request.form.get('date', '').strip())
+        except ValueError as e:
+            result = str(e)
+        else:
+            result = check_invoice_number(num, period) # 呼叫輔助函式
+    else:
+        # 空白表單不含任何資料，直接沿用已渲染的頁面
+        return static_page('invoice.html', result=result)
+
+    return render_page('invoice.html', result=result)
+
+# --- 大量發票兌獎路由 ---
+def find_bulk_invoice_number(fields):
+    """
+    從一行的各欄位中找出發票號碼：欄位必須恰好是 8 位數字（可帶字軌），較長的數字不會被截斷。
+    帶字軌的欄位優先；有多個純數字欄位時略過像日期 (YYYYMMDD) 的欄位。找不到時回傳 None。
+    """
+    candidates = []
+    for field in fields:
+        m = BULK_INVOICE_FIELD_RE.fullmatch(field.strip())
+        if m is None:
+            continue
+        if m.group(1):
+            return m.group(2)
+        candidates.append(m.group(2))
+    if len(candidates) > 1:
+        candidates = [c for c in candidates if not _looks_like_date(c)] or candidates
+    return candidates[0] if candidates else None
+
+
+def _looks_like_date(digits):
+    """8 位數字是否為 1911–2100 年間的有效日期 (YYYYMMDD)；大量兌獎每行都會呼叫，以整數比較代替 strptime。"""
+    n = int(digits)
+    year, month, day = n // 10000, n // 100 % 100, n % 100
+    return 1911 <= year <= 2100 and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]
+
+
+def csv_safe(text):
+    """避免試算表把使用者輸入當成公式執行（開頭為 = + - @ 等字元時加上單引號）。"""
+    return "'" + text if text[:1] in ('=', '+', '-', '@', '\t', '\r') else text
+
+
+def iter_bulk_invoice_lines(lines, index, chunk_lines=1000):
+    """
+    逐行兌獎並產生 CSV 結果，最後附上合計；不會一次把整個檔案讀進記憶體。
+    每行以 CSV 解析，取恰為 8 位數字的欄位為發票號碼（可接受「AB-12345678」或多欄的 CSV）。
+    結果每 chunk_lines 行合併送出一次，減少串流的分塊數量。
+    """
+    checked = winners = total = 0
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['發票號碼', '獎別', '獎金'])
+    rows = 1
+    try:
+        decoded = (raw.decode('utf-8-sig', 'replace') if isinstance(raw, bytes) else raw for raw in lines)
+        for fields in csv.reader(decoded):
+            num = find_bulk_invoice_number(fields)
+            if num is None:
+                line = ','.join(fields).strip()
+                if any(ch.isdigit() for ch in line):
+                    writer.writerow([csv_safe(line), '格式錯誤', 0])
+                    rows += 1
+                continue # 跳過空行與標題行
+
+            checked += 1
+            tier = classify_invoice_number(num, index)
+            if tier is None:
+                writer.writerow([num, '未中獎', 0])
+            else:
+                name, amount = INVOICE_PRIZES[tier]
+                winners += 1
+                total += amount
+                writer.writerow([num, name, amount])
+            rows += 1
+
+            if rows >= chunk_lines:
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+                rows = 0
+        writer.writerow(['合計', f'共 {checked} 張 中獎 {winners} 張', total])
+        yield out.getvalue()
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+
+
+@app.route('/invoice/bulk', methods=['POST'])
+def invoice_bulk():
+    upload = request.files.get('file')
+    if upload and upload.filename:
+        # 請求結束時 werkzeug 會關閉上傳檔，先複製到自己的暫存檔再串流處理
+        lines = tempfile.TemporaryFile()
+        shutil.copyfileobj(upload.stream, lines)
+        lines.seek(0)
+    else:
+        lines = request.form.get('nums', '').splitlines()
+
+    try:
+        period = parse_invoice_period(request.form.get('period', '').strip(), request.form.get('date', '').strip())
+        index = get_invoice_index(period=period)
+    except ValueError as e:
+        return str(e), 400
+    except UpstreamBusy as e:
+        return "目前兌獎查詢量過大，請稍後再試。", 503, {'Retry-After': str(e.retry_after)}
+    except requests.exceptions.RequestException as e:
+        return f"無法連接至電子發票網站，請檢查網路連線或稍後再試。詳細錯誤: {e}", 502
+    if index is None:
+        return f"查無 {format_invoice_period(period)} 的中獎號碼", 404
+
+    return Response(
+        stream_with_context(iter_bulk_invoice_lines(lines, index)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=invoice_results.csv'},
+    )
+
+# --- 管理用：強制更新中獎號碼 ---
+def require_admin():
+    """檢查 X-Admin-Token 標頭；未設定 ADMIN_TOKEN 時一律拒絕。"""
+    token = request.headers.get('X-Admin-Token', '')
+    # 以固定時間比較，避免從回應時間逐字元猜出權杖
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        abort(403)
+
+
+@app.route('/admin/invoice/refresh', methods=['POST'])
+def admin_invoice_refresh():
+    require_admin()
+    try:
+        get_invoice_numbers(force=True)
+    except Exception as e:
+        return jsonify(error=str(e)), 502
+    return jsonify(period=_invoice_cache['period'], fetched_at=_invoice_cache['fetched_at'])
+
+# --- 管理用：取樣效能分析 (cProfile) ---
+# 以 cProfile 分析的請求比例（0 為關閉）；可由 /admin/profile 在執行中調整，只影響收到請求的 worker
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_REPORT_LIMIT = 40
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+_profile_state = {'rate': PROFILE_SAMPLE_RATE, 'stats': None, 'requests': 0, 'routes': {}, 'since': time.time()}
+_profile_lock = threading.Lock()
+# 同一時間只分析一個請求：gevent 的協程共用同一條執行緒，同時啟動多個分析器會互相覆蓋
+_profile_active = threading.Lock()
+
+
+@app.before_request
+def _profile_before_request():
+    # 關閉時只多一次字典查詢與比較
+    rate = _profile_state['rate']
+    if rate <= 0 or random.random() >= rate or not _profile_active.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@app.teardown_request
+def _profile_teardown_request(exc=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profile_active.release()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    with _profile_lock:
+        if _profile_state['stats'] is None:
+            _profile_state['stats'] = pstats.Stats(profiler)
+        else:
+            _profile_state['stats'].add(profiler)
+        _profile_state['requests'] += 1
+        _profile_state['routes'][route] = _profile_state['routes'].get(route, 0) + 1
+
+
+def profile_report(sort='cumulative', limit=PROFILE_REPORT_LIMIT):
+    """
+    輸出目前 worker 累計的熱點報告（pstats 文字格式）。
+    只涵蓋處理請求的執行緒；並行查詢股票時執行緒池中的抓取與解析不在報告內，請看 Server-Timing。
+    """
+    out = io.StringIO()
+    with _profile_lock:
+        state = _profile_state
+        started = datetime.fromtimestamp(state['since']).isoformat(timespec='seconds')
+        out.write(f"worker {os.getpid()}：取樣比例 {state['rate']}，自 {started} 起已分析 {state['requests']} 個請求\n")
+        for route, count in sorted(state['routes'].items(), key=lambda item: -item[1]):
+            out.write(f'  {route}: {count}\n')
+        if state['stats'] is None:
+            out.write('尚無取樣資料。\n')
+        else:
+            state['stats'].stream = out
+            state['stats'].sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    GET 取得熱點報告（?sort=cumulative|tottime|calls&limit=N）；POST 以 rate（0～1）設定取樣比例，0 為關閉；
+    DELETE 清除已累計的結果。
+    """
+    require_admin()
+    if request.method == 'POST':
+        try:
+            rate = float(request.values['rate'])
+        except (KeyError, ValueError):
+            rate = -1
+        if not 0 <= rate <= 1:
+            return json_response({'error': 'invalid_rate'}, status=400)
+        _profile_state['rate'] = rate
+    elif request.method == 'DELETE':
+        with _profile_lock:
+            _profile_state.update(stats=None, requests=0, routes={}, since=time.time())
+    else:
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in PROFILE_SORT_KEYS:
+            return json_response({'error': 'invalid_sort', 'choices': PROFILE_SORT_KEYS}, status=400)
+        limit = request.args.get('limit', PROFILE_REPORT_LIMIT, type=int)
+        response = Response(profile_report(sort, limit), mimetype='text/plain')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = json_response({'rate': _profile_state['rate'], 'requests': _profile_state['requests']})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 # --- 多支股票查詢路由 ---
 @app.route('/stock', methods=['GET', 'POST'])
 def stock():
     results = []
-    if request.method == 'POST':
-        codes = request.form['codes'].split(',')
-        codes = [c.strip() for c in codes if c.strip()]
+    message = ''
+    ensure_stock_poller()
+    # 指定觀察清單名稱時：有輸入代碼就存成該清單，否則查詢清單中已存的代碼
+    watchlist = request.values.get('watchlist', '').strip()
+    codes = request.form.get('codes', '').split(',') if request.method == 'POST' else []
+    codes = [c.strip() for c in codes if c.strip()]
+    if len(codes) > WATCHLIST_MAX_CODES:
+        # 單次查詢的代碼數上限與觀察清單相同
+        message = _too_many_codes_message()
+        codes = []
+    elif watchlist:
+        try:
+            if codes:
+                codes, token = save_watchlist(watchlist, codes, request.form.get('token', '').strip())
+                message = f'已儲存觀察清單「{watchlist}」，報價將由伺服器定時更新。'
+                if token:
+                    message += f'日後修改此清單時請填寫權杖：{token}'
+            else:
+                codes = get_watchlist(watchlist)
+                if not codes:
+                    message = f'找不到觀察清單「{watchlist}」。'
+        except (ValueError, PermissionError) as e:
+            message = str(e)
+    elif request.method == 'GET':
+        # 未指定觀察清單的 GET 只是空白表單
+        return static_page('stock.html', results=results, message=message, watchlist=watchlist)
+
+    if codes:
+        # 呼叫輔助函式（並行查詢）
+        results = get_multiple_stock_details(codes)
+
+    return render_page('stock.html', results=results, message=message, watchlist=watchlist)
+
+
+# --- 多支股票串流查詢路由 ---
+@app.route('/stock/stream')
+def stock_stream():
+    codes = [c.strip() for c in request.args.get('codes', '').split(',') if c.strip()]
+    ensure_stock_poller()
+    lines = iter_stock_details(codes) if len(codes) <= WATCHLIST_MAX_CODES else [_too_many_codes_message()]
+    # 先送出頁面外框，之後每完成一支股票就送出一行
+    return Response(stream_template('stock_stream.html', lines=lines),
+                    headers={'X-Accel-Buffering': 'no'})
+
+# --- 股票報價即時推播路由 (Server-Sent Events) ---
+def iter_quote_events(codes):
+    """
+    產生 SSE 事件：先送出目前已知的報價，之後只在價格或漲跌變動時送出該支股票。
+    每個連線只保留代碼列表與最後看過的版本號；股票名稱只在第一次送出時附上。
+    訂閱與取消訂閱由呼叫端負責（見 stock_events）。
+    """
+    for code in codes:
+        if get_snapshot_quote(code) is None:
+            # 尚未有人查過的代碼先在背景抓一次，不必等下一輪輪詢
+            refresh_in_background(('quote', code), lambda code=code: get_stock_quote(code))
+    yield b'retry: 5000\n\n'
+    named = set()
+    since = 0
+    while True:
+        since, changed = _quote_publisher.wait(codes, since, STOCK_EVENTS_HEARTBEAT)
+        if not changed:
+            yield b': keep-alive\n\n'
+            continue
+        for quote in changed:
+            payload = quote_json(quote)
+            del payload['stale_age']
+            if quote['code'] in named:
+                del payload['name']
+            named.add(quote['code'])
+            yield b'event: quote\ndata: ' + json_dumps(payload) + b'\n\n'
 
-        for code in codes:
-            # 呼叫輔助函式
-            stock_info = get_stock_details(code)
-            results.append(stock_info)
-
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="zh-Hant">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>多支股票即時查詢</title>
-            <script src="https://cdn.tailwindcss.com"></script>
-            <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-            <style>
-                body {
-                    font-family: 'Inter', sans-serif;
-                    background-color: #f0f4f8;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    min-height: 100vh;
-                    padding: 20px;
-                    box-sizing: border-box;
-                }
-                .container {
-                    max-width: 600px;
-                    width: 100%;
-                    background-color: #ffffff;
-                    border-radius: 1rem;
-                    box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
-                    padding: 2.5rem;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: center;
-                    gap: 1.5rem;
-                }
-                .header {
-                    color: #4f46e5;
-                    text-align: center;
-                }
-                form {
-                    width: 100%;
-                    display: flex;
-                    flex-direction: column;
-                    gap: 1rem;
-                    align-items: center;
-                }
-                form input[type="text"] {
-                    padding: 0.75rem 1rem;
-                    border: 2px solid #cbd5e1;
-                    border-radius: 0.5rem;
-                    font-size: 1rem;
-                    width: 100%;
-                    max-width: 350px;
-                    transition: border-color 0.2s;
-                }
-                form input[type="text"]:focus {
-                    outline: none;
-                    border-color: #4f46e5;
-                    box-shadow: 0 0 0 3px rgba(79, 70, 229, 0.2);
-                }
-                form input[type="submit"] {
-                    background-color: #22c55e;
-                    color: white;
-                    padding: 0.8rem 1.5rem;
-                    border-radius: 0.75rem;
-                    font-size: 1.1rem;
-                    font-weight: 600;
-                    cursor: pointer;
-                    transition: background-color 0.2s, transform 0.1s;
-                    border: none;
-                    outline: none;
-                    box-shadow: 0 5px 15px rgba(34, 197, 94, 0.3);
-                }
-                form input[type="submit"]:hover {
-                    background-color: #16a34a;
-                    transform: translateY(-2px);
-                }
-                .results-section {
-                    width: 100%;
-                    background-color: #eef2ff;
-                    border: 2px solid #a78bfa;
-                    border-radius: 0.75rem;
-                    padding: 1.5rem;
-                    margin-top: 1.5rem;
-                    text-align: left;
-                }
-                .results-section p {
-                    font-size: 1rem;
-                    color: #4c1d95;
-                    margin-bottom: 0.5rem;
-                    word-break: break-word;
-                }
-                .home-link {
-                    margin-top: 1.5rem;
-                    color: #4f46e5;
-                    text-decoration: none;
-                    font-weight: 600;
-                    transition: color 0.2s;
-                }
-                .home-link:hover {
-                    color: #3b82f6;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h2 class="text-2xl font-bold">多支股票即時查詢</h2>
-                    <p class="text-gray-600 mt-1">請輸入股票代碼（用逗號分隔）</p>
-                </div>
-                <form method="post">
-                    <label for="codes" class="sr-only">輸入股票代碼（用逗號分隔）</label>
-                    <input type="text" name="codes" id="codes" placeholder="例如: 2330, 2454" style="width:100%">
-                    <input type="submit" value="查詢">
-                </form>
-                <hr class="w-full border-t border-gray-300 my-4">
-                <div class="results-section">
-                    {% if results %}
-                        {% for line in results %}
-                            <p>{{ line }}</p>
-                        {% endfor %}
-                    {% else %}
-                        <p>輸入股票代碼後，結果將顯示在此。</p>
-                    {% endif %}
-                </div>
-                <a href="/" class="home-link">回首頁</a>
-            </div>
-        </body>
-        </html>
-    ''', results=results)
+
+@app.route('/stock/events')
+def stock_events():
+    codes = list(dict.fromkeys(c.strip() for c in request.args.get('codes', '').split(',') if c.strip()))
+    if not codes or len(codes) > WATCHLIST_MAX_CODES or not all(STOCK_CODE_RE.fullmatch(c) for c in codes):
+        return json_response({'error': 'invalid_codes'}, status=400)
+    # 推播的報價來自背景輪詢：輪詢已達 STOCK_POLL_MAX_CODES 支、容不下新代碼時拒絕訂閱，而不是默默不更新
+    if not _quote_publisher.subscribe(codes, STOCK_POLL_MAX_CODES, watched_stock_codes()):
+        response = json_response({'error': 'poll_full', 'retry_after': STOCK_EVENTS_RETRY_AFTER}, status=503)
+        response.headers['Retry-After'] = str(STOCK_EVENTS_RETRY_AFTER)
+        return response
+    ensure_stock_poller()
+    response = Response(iter_quote_events(codes), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 連線結束時取消訂閱；即使串流尚未開始送出（用戶端立即斷線）也會執行
+    response.call_on_close(lambda: _quote_publisher.unsubscribe(codes))
+    return response
 
 # --- 即時匯率查詢路由 ---
 @app.route('/exchange_rate')
 def exchange_rate():
+    # 可用 ?currency=USD,JPY 只顯示指定貨幣
+    currencies = [c.strip().upper() for c in request.args.get('currency', '').split(',') if c.strip()]
+    # 先記下資料版本再取匯率：期間若剛好更新，頁面內容只會比版本新，下一個請求會重新渲染
+    fetched_at = _rate_state['fetched_at']
     # 呼叫輔助函式獲取匯率數據
-    rates = get_exchange_rates()
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="zh-Hant">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>即時匯率查詢</title>
-            <script src="https://cdn.tailwindcss.com"></script>
-            <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-            <style>
-                body {
-                    font-family: 'Inter', sans-serif;
-                    background-color: #f0f4f8;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    min-height: 100vh;
-                    padding: 20px;
-                    box-sizing: border-box;
-                }
-                .container {
-                    max-width: 600px;
-                    width: 100%;
-                    background-color: #ffffff;
-                    border-radius: 1rem;
-                    box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
-                    padding: 2.5rem;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: center;
-                    gap: 1.5rem;
-                }
-                .header {
-                    color: #4f46e5;
-                    text-align: center;
-                }
-                .rate-list-container {
-                    width: 100%;
-                    max-height: 400px; /* 限制高度並允許滾動 */
-                    overflow-y: auto;
-                    background-color: #eef2ff;
-                    border: 2px solid #a78bfa;
-                    border-radius: 0.75rem;
-                    padding: 1.5rem;
-                    margin-top: 1.5rem;
-                    text-align: left;
-                }
-                .rate-list-container p {
-                    font-size: 1rem;
-                    color: #4c1d95;
-                    margin-bottom: 0.5rem;
-                    word-break: break-word;
-                    padding: 0.25rem 0;
-                    border-bottom: 1px dotted #d1d5db; /* 增加分隔線 */
-                }
-                .rate-list-container p:last-child {
-                    border-bottom: none; /* 最後一行不要分隔線 */
-                }
-                .home-link {
-                    margin-top: 1.5rem;
-                    color: #4f46e5;
-                    text-decoration: none;
-                    font-weight: 600;
-                    transition: color 0.2s;
-                }
-                .home-link:hover {
-                    color: #3b82f6;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h2 class="text-2xl font-bold">即時匯率查詢</h2>
-                    <p class="text-gray-600 mt-1">台灣銀行即時匯率（現金賣出）</p>
-                </div>
-                <div class="rate-list-container">
-                    {% if rates %}
-                        {% for rate_item in rates %}
-                            <p>{{ rate_item }}</p>
-                        {% endfor %}
-                    {% else %}
-                        <p>無法載入匯率資料。</p>
-                    {% endif %}
-                </div>
-                <a href="/" class="home-link">回首頁</a>
-            </div>
-        </body>
-        </html>
-    ''', rates=rates)
+    rates = get_exchange_rates(currencies)
+    if _rate_state['rates'] is None:
+        # 尚未取得匯率表，頁面上是錯誤訊息，不快取
+        response = make_response(render_page('exchange_rate.html', rates=rates, stale_age=None))
+        response.cache_control.no_store = True
+        return response
+    age = exchange_rates_age()
+    stale_age = format_data_age(age) if age >= RATE_STALE_NOTICE_SECONDS else None
+    return cached_page(('exchange_rate', tuple(currencies)), (fetched_at, stale_age),
+                       lambda: render_page('exchange_rate.html', rates=rates, stale_age=stale_age),
+                       last_modified=_rate_state['sampled_at'], max_age=RATE_PAGE_MAX_AGE)
+
+
+# --- 貨幣換算路由 ---
+@app.route('/convert')
+def convert():
+    from_currency = request.args.get('from', '').strip().upper()
+    to_currency = request.args.get('to', 'TWD').strip().upper()
+    kind = request.args.get('type', 'spot')
+    try:
+        amount = float(request.args['amount'])
+    except (KeyError, ValueError):
+        amount = math.nan
+    if not math.isfinite(amount): # float() 也接受 nan / inf，換算結果會是 null
+        return json_response({'error': 'invalid_amount'}, status=400)
+    if kind not in ('cash', 'spot'):
+        return json_response({'error': 'invalid_type'}, status=400)
+
+    try:
+        table = ensure_exchange_rates()
+    except UpstreamBusy as e:
+        return busy_json_response(e)
+    except requests.exceptions.RequestException:
+        return json_response({'error': 'upstream'}, status=502)
+    for currency in (from_currency, to_currency):
+        if currency != 'TWD' and currency not in table:
+            return json_response({'error': 'unknown_currency', 'currency': currency}, status=400)
+
+    try:
+        result, rate = convert_currency(table, amount, from_currency, to_currency, kind)
+    except KeyError as e:
+        return json_response({'error': 'rate_unavailable', 'currency': e.args[0]}, status=422)
+    return json_response({'amount': amount, 'from': from_currency, 'to': to_currency, 'type': kind,
+                          'rate': rate, 'result': round(result, 4)})
+
+
+# --- JSON API 路由 ---
+def json_response(payload, status=200):
+    """
+    輸出精簡的 JSON，並附上依內容計算的 ETag；內容未變時回應 304。
+    """
+    body = json_dumps(payload)
+    response = Response(body, status=status, mimetype='application/json')
+    if status == 200:
+        response.set_etag(hashlib.md5(body).hexdigest())
+        response.make_conditional(request)
+    return response
+
+
+def busy_json_response(e):
+    """上游排隊已滿時的 JSON 回應：503 並以 Retry-After 告知幾秒後再試。"""
+    response = json_response({'error': 'busy', 'retry_after': e.retry_after}, status=503)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def to_number(text):
+    """將「1,085.5」之類的顯示文字轉為數值，無法轉換時回傳 None。"""
+    try:
+        return float(text.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+def stock_quote_json(code, timeout=None):
+    """查詢單一股票並轉為 API 使用的結構；失敗時回傳含 error 欄位的結構。"""
+    try:
+        quote = get_stock_quote(code, timeout=timeout)
+    except UpstreamBusy:
+        return {'code': code, 'error': 'busy'}
+    except requests.exceptions.RequestException:
+        return {'code': code, 'error': 'upstream'}
+    except (AttributeError, IndexError):
+        return {'code': code, 'error': 'parse'}
+    except Exception:
+        return {'code': code, 'error': 'internal'}
+    return quote_json(quote)
+
+
+def quote_json(quote):
+    """將報價資料轉為 API 使用的結構（數值欄位轉為數字）。"""
+    change = to_number(quote['change'])
+    if change is not None and quote['sign'] == '-':
+        change = -change
+    return {
+        'code': quote['code'],
+        'name': quote['title'],
+        'price': to_number(quote['price']),
+        'change': change,
+        'sign': quote['sign'],
+        'stale_age': round(quote['stale_age'], 1) if 'stale_age' in quote else None,
+    }
+
+
+@app.route('/api/invoice', methods=['GET', 'POST'])
+def api_invoice():
+    num = (request.values.get('num') or '').strip()
+    if not INVOICE_NUMBER_RE.fullmatch(num):
+        return json_response({'error': 'invalid_number'}, status=400)
+    try:
+        period = parse_invoice_period((request.values.get('period') or '').strip(), (request.values.get('date') or '').strip())
+    except ValueError:
+        return json_response({'error': 'invalid_period'}, status=400)
+    if period is not None and int(period) > int(current_invoice_period()):
+        return json_response({'error': 'not_drawn', 'period': period}, status=404)
+    try:
+        index = get_invoice_index(period=period)
+    except UpstreamBusy as e:
+        return busy_json_response(e)
+    except requests.exceptions.RequestException:
+        return json_response({'error': 'upstream'}, status=502)
+    if index is None:
+        return json_response({'error': 'unknown_period', 'period': period}, status=404)
+
+    tier = classify_invoice_number(num, index)
+    if period is None:
+        period = _invoice_cache['period']
+    payload = {'num': num, 'period': period, 'latest': period == current_invoice_period(), 'won': tier is not None,
+               'tier': tier, 'prize': None, 'amount': 0}
+    if tier is not None:
+        payload['prize'], payload['amount'] = INVOICE_PRIZES[tier]
+    return json_response(payload)
+
+
+@app.route('/api/stock')
+def api_stock():
+    codes = [c.strip() for c in request.args.get('codes', '').split(',') if c.strip()]
+    if not codes:
+        return json_response({'error': 'missing_codes'}, status=400)
+    if len(codes) > WATCHLIST_MAX_CODES:
+        return json_response({'error': 'too_many_codes', 'max': WATCHLIST_MAX_CODES}, status=400)
+    ensure_stock_poller()
+    quotes = fan_out_stock_codes(codes, stock_quote_json, lambda code: {'code': code, 'error': 'timeout'})
+    if all(q.get('error') == 'busy' for q in quotes):
+        return busy_json_response(UpstreamBusy('yahoo', retry_after=math.ceil(UPSTREAM_QUEUE_TIMEOUT)))
+    return json_response({'quotes': quotes})
+
+
+@app.route('/api/watchlists/<name>', methods=['GET', 'PUT', 'DELETE'])
+def api_watchlist(name):
+    if request.method in ('PUT', 'DELETE'):
+        # 修改或刪除既有清單時以 X-Watchlist-Token 標頭附上建立時取得的權杖
+        codes = [c.strip() for c in (request.values.get('codes') or '').split(',') if c.strip()]
+        try:
+            codes, token = save_watchlist(name, codes if request.method == 'PUT' else [],
+                                          request.headers.get('X-Watchlist-Token'))
+        except PermissionError as e:
+            return json_response({'error': 'forbidden', 'detail': str(e)}, status=403)
+        except ValueError as e:
+            return json_response({'error': 'invalid_watchlist', 'detail': str(e)}, status=400)
+        payload = {'name': name, 'codes': codes}
+        if token:
+            payload['token'] = token
+        return json_response(payload)
+
+    codes = get_watchlist(name)
+    if not codes:
+        return json_response({'error': 'not_found'}, status=404)
+    ensure_stock_poller()
+    quotes = fan_out_stock_codes(codes, stock_quote_json, lambda code: {'code': code, 'error': 'timeout'})
+    return json_response({'name': name, 'codes': codes, 'quotes': quotes})
+
+
+@app.route('/api/rates')
+def api_rates():
+    try:
+        table = ensure_exchange_rates()
+    except UpstreamBusy as e:
+        return busy_json_response(e)
+    except requests.exceptions.RequestException:
+        return json_response({'error': 'upstream'}, status=502)
+
+    rates = {currency: rate._asdict() for currency, rate in table.items()}
+    for rate in rates.values():
+        del rate['currency']
+    return json_response({'fetched_at': _rate_state['fetched_at'], 'verified_at': _rate_state['verified_at'],
+                          'age': round(exchange_rates_age(), 1), 'rates': rates})
+
+
+@app.route('/api/rates/history')
+def api_rates_history():
+    currency = request.args.get('currency', '').strip().upper()
+    kind = request.args.get('type', 'spot_sell')
+    if kind not in RATE_HISTORY_FIELDS:
+        return json_response({'error': 'invalid_type'}, status=400)
+    try:
+        windows = {w: parse_rate_window(w) for w in request.args.get('windows', '1h,1d,7d,30d').split(',') if w}
+    except ValueError:
+        return json_response({'error': 'invalid_window'}, status=400)
+    history = get_rate_history(currency, create=False) if CURRENCY_RE.fullmatch(currency) else None
+    if history is None:
+        return json_response({'error': 'unknown_currency'}, status=404)
+
+    columns = history.columns()
+    times, values = columns['time'], columns[kind]
+    now = time.time()
+    return json_response({
+        'currency': currency,
+        'type': kind,
+        'samples': len(times),
+        'first_at': float(times[0]) if len(times) else None,
+        'last_at': float(times[-1]) if len(times) else None,
+        'windows': {w: rate_window_stats(times, values, now - seconds) for w, seconds in windows.items()},
+    })
 
 
 # 如果以主程式執行，則啟動 Flask 伺服器
@@ -0,0 +1,57 @@
+"""
+解析效能微基準：財政部兌獎頁、Yahoo 股市報價頁（快速片段解析 vs. BeautifulSoup）、
+台灣銀行匯率 CSV。
+
+用法：python bench/bench_parse.py [--quote 報價頁檔案]
+預設使用 bench/fixtures/ 中的擷取檔（可用 capture_fixtures.py 更新為最新的真實回應）。
+"""
+import argparse
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import app  # noqa: E402
+
+
+def read_fixture(name):
+    with open(os.path.join(BENCH_DIR, 'fixtures', name), encoding='utf-8') as f:
+        return f.read()
+
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f'{label:<14} {seconds * 1000:9.3f} ms/次')
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quote', default=os.path.join(BENCH_DIR, 'fixtures', 'yahoo_quote_2330.html'))
+    parser.add_argument('--code', default='2330')
+    args = parser.parse_args()
+
+    with open(args.quote, encoding='utf-8') as f:
+        page = f.read()
+    code = args.code
+    invoice_page = read_fixture('invoice_index.html')
+    rates_csv = read_fixture('bot_rates.csv')
+
+    fast = app.parse_stock_quote_fast(page, code)
+    soup = app.parse_stock_quote_soup(page, code)
+    print(f'報價頁大小：{len(page) / 1024:.0f} KB，BeautifulSoup 解析器：{app.STOCK_HTML_PARSER}')
+    print(f'快速解析結果：{fast}')
+    if fast != soup:
+        print(f'警告：兩種解析結果不一致，BeautifulSoup 結果：{soup}')
+
+    t_soup = bench('yahoo_soup', lambda: app.parse_stock_quote_soup(page, code), 5)
+    t_fast = bench('yahoo_fast', lambda: app.parse_stock_quote_fast(page, code), 200)
+    print(f'{"":<14} 快速解析加速 {t_soup / t_fast:.0f}x')
+    bench('invoice_html', lambda: app.parse_invoice_page(invoice_page), 200)
+    bench('bot_csv', lambda: app.parse_exchange_rates_csv(rates_csv), 2000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+頁面渲染效能比較：預先編譯的模板 vs. 每次請求重新編譯的 render_template_string。
+
+用法：python bench/bench_render.py
+「內嵌」欄位估算舊做法（每頁內嵌整份 CSS）的回應大小，
+「外部」欄位為改用共用樣式表後的回應大小（樣式表由瀏覽器長期快取）。
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import render_template, render_template_string  # noqa: E402
+
+import app  # noqa: E402
+
+# 各頁面的模板與測試用資料
+PAGES = {
+    'home': ('index.html', {}),
+    'invoice': ('invoice.html', {'result': '🎉 恭喜中獎 200 元'}),
+    'stock': ('stock.html', {'results': [f'【台積電 (2330)】：1085 (+{i}.00)' for i in range(20)]}),
+    'exchange_rate': ('exchange_rate.html', {'rates': [f'C{i:02d} : 32.55500' for i in range(19)]}),
+}
+
+
+def main():
+    with open(os.path.join(app.app.static_folder, 'style.css'), encoding='utf-8') as f:
+        css = f.read()
+
+    print(f'{"路由":<14}{"預編譯 (µs)":>12}{"每次編譯 (µs)":>14}{"內嵌 (B)":>10}{"外部 (B)":>10}')
+    with app.app.test_request_context():
+        for route, (name, context) in PAGES.items():
+            source = app.app.jinja_loader.get_source(app.app.jinja_env, name)[0]
+            number = 200
+            t_cached = min(timeit.repeat(lambda: render_template(name, **context), number=number, repeat=3)) / number
+            t_string = min(timeit.repeat(lambda: render_template_string(source, **context), number=number, repeat=3)) / number
+
+            html = render_template(name, **context)
+            link = f'<link href="{app.static_url("style.css")}" rel="stylesheet">'
+            inline = html.replace(link, f'<style>{css}</style>')
+            print(f'{route:<14}{t_cached * 1e6:>12.1f}{t_string * 1e6:>14.1f}'
+                  f'{len(inline.encode()):>10}{len(html.encode()):>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""
+從真實上游擷取最新回應，更新 bench/fixtures/ 供上游替身與解析基準使用。
+
+用法：python bench/capture_fixtures.py（需要網路連線）
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import app  # noqa: E402
+
+SOURCES = {
+    'invoice_index.html': 'https://invoice.etax.nat.gov.tw/index.html',
+    'yahoo_quote_2330.html': 'https://tw.stock.yahoo.com/quote/2330',
+    'bot_rates.csv': 'https://rate.bot.com.tw/xrt/flcsv/0/day',
+}
+
+
+def main():
+    for name, url in SOURCES.items():
+        response = app.http_get(url)
+        response.raise_for_status()
+        path = os.path.join(BENCH_DIR, 'fixtures', name)
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        print(f'{name}: {len(response.content)} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+效能測試共用工具：以 gunicorn 子行程啟動 app、並行送出請求並統計延遲。
+"""
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# 對本機替身測試時關閉 app 的上游速率限制，否則量到的是限制值而不是 app 本身
+NO_RATE_LIMITS = {f'UPSTREAM_RATE_LIMIT_{name}': '0' for name in ('INVOICE', 'YAHOO', 'BOT')}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(env=None, worker_class=None, workers=1, ready_path='/readyz'):
+    """
+    以 gunicorn.conf.py 啟動 app，回傳 (process, port, 啟動秒數)。
+    啟動秒數為啟動子行程到 ready_path 第一次回應 200 的時間（預設 /readyz，即預熱完成）。
+    每次啟動使用全新的暫存資料庫，避免上一次測試留下的資料影響結果。
+    """
+    port = free_port()
+    data_dir = tempfile.mkdtemp(prefix='bench-app-')
+    child_env = dict(os.environ, DATABASE_PATH=os.path.join(data_dir, 'app.db'),
+                     SHARED_CACHE_PATH=os.path.join(data_dir, 'cache.db'), **(env or {}))
+    if worker_class:
+        child_env['WEB_WORKER_CLASS'] = worker_class
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=child_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    proc.data_dir = data_dir
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}{ready_path}', timeout=1) as r:
+                if r.status == 200:
+                    return proc, port, time.perf_counter() - start
+        except OSError:
+            pass
+        if proc.poll() is not None:
+            break
+        time.sleep(0.05)
+    stop_app(proc)
+    raise RuntimeError('gunicorn 未能啟動')
+
+
+def stop_app(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    shutil.rmtree(proc.data_dir, ignore_errors=True)
+
+
+def run_load(send, concurrency, total):
+    """
+    以 concurrency 個並行客戶端呼叫 send(i) 共 total 次，回傳吞吐量與延遲統計。
+    send 丟出例外視為錯誤，不計入延遲統計。
+    """
+    def one(i):
+        start = time.perf_counter()
+        try:
+            send(i)
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(r for r in results if r is not None)
+    stats = {
+        'requests': total,
+        'errors': total - len(latencies),
+        'concurrency': concurrency,
+        'throughput': round(total / elapsed, 2),
+        'p50': None,
+        'p99': None,
+    }
+    if latencies:
+        stats['p50'] = round(statistics.median(latencies), 5)
+        stats['p99'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 5)
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
@@ -0,0 +1,130 @@
+"""
+離線負載測試：以上游替身 (stub_server.py) 取代真實網站，測量 /invoice、/stock、
+/exchange_rate 的吞吐量與 p50/p99 延遲。
+
+用法：python bench/load.py [--concurrency 20] [--requests 400] [--latency 0.05]
+                         [--error-rate 0] [--worker-class gevent] [--preload] [--no-warm]
+                         [--compare 舊結果.json]
+
+結果寫入 bench/results/<commit>.json（可用 --output 指定），內容包含 commit、參數、
+app 啟動到 /readyz 就緒的時間、就緒後各情境第一個請求的延遲與負載統計；
+以 --compare 指定另一次的結果檔即可列出差異，追蹤效能退化。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import NO_RATE_LIMITS, ROOT, git_commit, run_load, start_app, stop_app  # noqa: E402
+from stub_server import start_stub_server  # noqa: E402
+
+# 測試用股票代碼池：請求會從中隨機挑選，部分命中報價快取
+STOCK_CODES = [str(1101 + i) for i in range(200)]
+
+
+def scenarios(base, codes_per_request):
+    def post(path, data):
+        body = urllib.parse.urlencode(data).encode()
+        with urllib.request.urlopen(f'{base}{path}', data=body, timeout=30) as r:
+            r.read()
+
+    def get(path):
+        with urllib.request.urlopen(f'{base}{path}', timeout=30) as r:
+            r.read()
+
+    return {
+        'invoice': lambda i: post('/invoice', {'num': f'{random.randrange(10 ** 8):08d}'}),
+        'stock': lambda i: post('/stock', {'codes': ','.join(random.sample(STOCK_CODES, codes_per_request))}),
+        'exchange_rate': lambda i: get('/exchange_rate'),
+    }
+
+
+def compare(old, new):
+    """列出兩次結果的差異（正值代表變快 / 吞吐量變高）。"""
+    print(f'\n與 {old["commit"]} 比較：')
+    if old.get('startup_seconds') and new.get('startup_seconds'):
+        print(f'啟動時間 {old["startup_seconds"]:.2f}s → {new["startup_seconds"]:.2f}s')
+    print(f'{"情境":<16}{"吞吐量":>10}{"p50":>10}{"p99":>10}')
+    for name, stats in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if not before:
+            continue
+
+        def change(key, higher_is_better):
+            if not before.get(key) or stats.get(key) is None:
+                return '     n/a'
+            ratio = stats[key] / before[key] - 1
+            return f'{(ratio if higher_is_better else -ratio) * 100:+9.1f}%'
+
+        print(f'{name:<16}{change("throughput", True)}{change("p50", False)}{change("p99", False)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=400, help='每個情境送出的請求數')
+    parser.add_argument('--codes', type=int, default=5, help='每個 /stock 請求查詢的代碼數')
+    parser.add_argument('--latency', type=float, default=0.05, help='上游替身的回應延遲（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='上游替身回應 503 的比例')
+    parser.add_argument('--worker-class', default=None, help='gunicorn 工作模式（預設依 gunicorn.conf.py）')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--only', default='invoice,stock,exchange_rate', help='要執行的情境（逗號分隔）')
+    parser.add_argument('--output', default=None, help='結果檔路徑，預設 bench/results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='要比較的舊結果檔')
+    parser.add_argument('--rate-limits', action='store_true', help='保留 app 預設的上游速率限制')
+    parser.add_argument('--preload', action='store_true', help='以 gunicorn preload 模式啟動 (WEB_PRELOAD=1)')
+    parser.add_argument('--no-warm', action='store_true', help='停用啟動時預先抓取資料 (WARM_PREFETCH=0)')
+    args = parser.parse_args()
+
+    stub, _ = start_stub_server(latency=args.latency, jitter=args.latency / 4, error_rate=args.error_rate)
+    env = dict({} if args.rate_limits else NO_RATE_LIMITS, UPSTREAM_STUB_URL=f'http://127.0.0.1:{stub.server_port}',
+               WEB_PRELOAD='1' if args.preload else '0', WARM_PREFETCH='0' if args.no_warm else '1')
+    proc, port, startup = start_app(env=env, worker_class=args.worker_class, workers=args.workers)
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'startup_seconds': round(startup, 3),
+        'first_request_seconds': {},
+        'scenarios': {},
+    }
+    try:
+        all_scenarios = scenarios(f'http://127.0.0.1:{port}', args.codes)
+        print(f'app 啟動時間 {startup:.2f}s；上游延遲 {args.latency}s，並行數 {args.concurrency}')
+        # 就緒後的第一個請求：反映部署 / 擴充時新 worker 的冷啟動延遲
+        for name in args.only.split(','):
+            start = time.perf_counter()
+            all_scenarios[name](0)
+            result['first_request_seconds'][name] = round(time.perf_counter() - start, 4)
+        print('就緒後第一個請求：' + '，'.join(f'{k} {v:.3f}s' for k, v in result['first_request_seconds'].items()))
+        print(f'{"情境":<16}{"req/s":>10}{"p50 (s)":>10}{"p99 (s)":>10}{"錯誤":>8}')
+        for name in args.only.split(','):
+            stats = run_load(all_scenarios[name], args.concurrency, args.requests)
+            result['scenarios'][name] = stats
+            print(f'{name:<16}{stats["throughput"]:>10.1f}{stats["p50"] or 0:>10.3f}'
+                  f'{stats["p99"] or 0:>10.3f}{stats["errors"]:>8}')
+    finally:
+        stop_app(proc)
+        stub.shutdown()
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results', f'{result["commit"]}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'結果已寫入 {os.path.relpath(output, ROOT)}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+慢速上游下的並行負載測試：比較 gunicorn 各種工作模式的擴展性。
+
+用法：python bench/load_slow_upstream.py [--delay 0.5] [--levels 1,10,50] [--modes sync,gthread,gevent]
+
+以上游替身 (stub_server.py) 模擬每次回應都延遲 --delay 秒的 Yahoo 股市，再以單一
+gunicorn worker 分別用各工作模式啟動 app，對 /api/stock 送出不同並行數的請求
+（每個請求使用不同代碼，不會命中報價快取），回報吞吐量與延遲百分位數。
+sync 模式的吞吐量固定約為 1/delay；協程/執行緒模式應隨並行數成長。
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import NO_RATE_LIMITS, run_load, start_app, stop_app  # noqa: E402
+from stub_server import start_stub_server  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--delay', type=float, default=0.5, help='上游每次回應的延遲秒數')
+    parser.add_argument('--levels', default='1,10,50', help='要測試的並行數（逗號分隔）')
+    parser.add_argument('--rounds', type=int, default=3, help='每個並行數送出 levels×rounds 個請求')
+    parser.add_argument('--modes', default='sync,gthread,gevent', help='要比較的 gunicorn 工作模式')
+    args = parser.parse_args()
+
+    stub, _ = start_stub_server(latency=args.delay)
+    levels = [int(x) for x in args.levels.split(',')]
+    modes = [m for m in args.modes.split(',') if m != 'gevent' or importlib.util.find_spec('gevent')]
+    env = {
+        'UPSTREAM_STUB_URL': f'http://127.0.0.1:{stub.server_port}',
+        # 放寬連線池與並行上限，讓測試只反映工作模式本身的差異
+        'STOCK_MAX_WORKERS': '256',
+        'HTTP_HOST_CONCURRENCY': '256',
+        'HTTP_POOL_SIZE': '256',
+        'RATE_REFRESHER': '0',
+        **NO_RATE_LIMITS,
+    }
+
+    print(f'上游延遲 {args.delay}s，單一 worker')
+    print(f'{"模式":<10}{"並行數":>8}{"req/s":>10}{"p50 (s)":>10}{"p99 (s)":>10}')
+    offset = 0
+    for mode in modes:
+        proc, port, _ = start_app(env, worker_class=mode)
+        try:
+            for level in levels:
+                def send(i, base=offset):
+                    url = f'http://127.0.0.1:{port}/api/stock?codes=T{base + i}'
+                    with urllib.request.urlopen(url, timeout=60) as r:
+                        r.read()
+
+                stats = run_load(send, level, level * args.rounds)
+                offset += level * args.rounds
+                print(f'{mode:<10}{level:>8}{stats["throughput"]:>10.1f}{stats["p50"]:>10.2f}{stats["p99"]:>10.2f}')
+        finally:
+            stop_app(proc)
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
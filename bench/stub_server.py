@@ -0,0 +1,137 @@
+"""
+離線上游替身：重播 bench/fixtures/ 中擷取的財政部、Yahoo 股市與台灣銀行回應。
+
+用法：python bench/stub_server.py [--port 8001] [--latency 0.05] [--jitter 0.02]
+                                 [--error-rate 0] [--hang-rate 0] [--hang-seconds 30]
+然後以 UPSTREAM_STUB_URL=http://127.0.0.1:8001 啟動 app，三個上游都會改向替身抓取。
+
+路徑：
+    /invoice/index.html   fixtures/invoice_index.html
+    /quote/<代碼>          fixtures/yahoo_quote_2330.html（代碼 2330 會替換為請求的代碼）
+    /rates/flcsv          fixtures/bot_rates.csv（支援 ETag / If-None-Match 回應 304）
+每個回應先延遲 latency ± jitter 秒；依 error-rate 比例回應 503，依 hang-rate 比例延遲
+hang-seconds 秒才回應，用來模擬上游故障與逾時。
+"""
+import argparse
+import hashlib
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIXTURE_QUOTE_CODE = '2330'
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class StubConfig:
+    """替身的延遲與錯誤注入設定，執行中可直接修改屬性調整。"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, hang_rate=0.0, hang_seconds=30.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.invoice = load_fixture('invoice_index.html')
+        self.quote = load_fixture('yahoo_quote_2330.html')
+        self.rates = load_fixture('bot_rates.csv')
+        self.rates_etag = '"' + hashlib.md5(self.rates).hexdigest() + '"'
+        self.hits = {}
+        self._lock = threading.Lock()
+
+    def count(self, kind):
+        with self._lock:
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            delay = config.latency + random.uniform(-config.jitter, config.jitter)
+            roll = random.random()
+            if roll < config.hang_rate:
+                delay = config.hang_seconds
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.path.startswith('/invoice/'):
+                kind, body, ctype = 'invoice', config.invoice, 'text/html; charset=utf-8'
+            elif self.path.startswith('/quote/'):
+                code = self.path.rsplit('/', 1)[-1].encode('utf-8')
+                kind, ctype = 'quote', 'text/html; charset=utf-8'
+                body = config.quote.replace(FIXTURE_QUOTE_CODE.encode(), code)
+            elif self.path.startswith('/rates/'):
+                kind, body, ctype = 'rates', config.rates, 'text/csv; charset=utf-8'
+            else:
+                self._send(404, b'not found', 'text/plain')
+                return
+            config.count(kind)
+
+            if config.hang_rate <= roll < config.hang_rate + config.error_rate:
+                self._send(503, b'injected error', 'text/plain')
+            elif kind == 'rates' and self.headers.get('If-None-Match') == config.rates_etag:
+                self._send(304, b'', ctype, {'ETag': config.rates_etag})
+            elif kind == 'rates':
+                self._send(200, body, ctype, {'ETag': config.rates_etag})
+            else:
+                self._send(200, body, ctype)
+
+        def _send(self, status, body, ctype, headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # 預設 backlog 只有 5，高並行時會出現 1 秒的 SYN 重送延遲
+
+
+def start_stub_server(port=0, **options):
+    """在背景執行緒啟動替身，回傳 (server, config)；網址為 http://127.0.0.1:{server.server_port}。"""
+    config = StubConfig(**options)
+    server = StubServer(('127.0.0.1', port), make_handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.05, help='每個回應的基本延遲秒數')
+    parser.add_argument('--jitter', type=float, default=0.02, help='延遲的隨機變動範圍（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='回應 503 的比例 (0-1)')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='延遲 hang-seconds 才回應的比例 (0-1)')
+    parser.add_argument('--hang-seconds', type=float, default=30.0)
+    args = parser.parse_args()
+
+    server, _ = start_stub_server(
+        args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        hang_rate=args.hang_rate, hang_seconds=args.hang_seconds,
+    )
+    print(f'上游替身已啟動：UPSTREAM_STUB_URL=http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# gunicorn 設定檔：Procfile 以 `gunicorn -c gunicorn.conf.py app:app` 啟動
+# 所有設定皆可用環境變數覆寫
+import importlib.util
+import os
+
+# 工作模式：
+#   gevent  協程模式，等待上游網站回應時不佔用 OS worker（預設，需安裝 gevent）
+#   gthread 執行緒模式，未安裝 gevent 時的預設值
+#   sync    傳統同步模式，每個 worker 同時只能處理一個請求
+worker_class = os.environ.get('WEB_WORKER_CLASS') or (
+    'gevent' if importlib.util.find_spec('gevent') else 'gthread'
+)
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# gevent：每個 worker 同時處理的連線數上限
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+# gthread：每個 worker 的執行緒數（sync 模式若設定多執行緒會被 gunicorn 自動改成 gthread）
+threads = int(os.environ.get('WEB_THREADS', 32)) if worker_class == 'gthread' else 1
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+
+# 預先載入 (WEB_PRELOAD=1)：master 先匯入 app 與解析函式庫再 fork，新 worker 不必各自匯入，
+# 模組記憶體也以 copy-on-write 共用
+preload_app = os.environ.get('WEB_PRELOAD', '0') == '1'
+if preload_app and worker_class == 'gevent':
+    # gevent worker 在 fork 後才 monkey-patch；預先載入時 app 已在 master 建立鎖與執行緒池，
+    # 必須在匯入 app 之前就 patch，否則這些物件是未 patch 的版本，會卡住整個 worker
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.warm_imports()
+
+
+def post_worker_init(worker):
+    # 每個 worker 啟動後在背景預熱（抓取中獎號碼與匯率表），完成前 /readyz 回應 503
+    import app
+    app.start_warm_up()
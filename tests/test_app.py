@@ -0,0 +1,1332 @@
+"""
+app.py 的單元測試；需要上游資料的路由改向 bench/stub_server.py 的替身抓取，
+個別情境再以 monkeypatch 替換抓取函式。
+
+用法：python -m pytest -q
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+from stub_server import load_fixture, start_stub_server  # noqa: E402
+
+# app 在匯入時讀取環境變數：先啟動替身並把資料庫放到暫存目錄，停用背景執行緒
+_stub, _stub_config = start_stub_server()
+_data_dir = tempfile.mkdtemp(prefix='flask-test-')
+os.environ.update(
+    UPSTREAM_STUB_URL=f'http://127.0.0.1:{_stub.server_port}',
+    DATABASE_PATH=os.path.join(_data_dir, 'app.db'),
+    SHARED_CACHE_PATH=os.path.join(_data_dir, 'cache.db'),
+    RATE_REFRESHER='0',
+    STOCK_POLLER='0',
+    WARM_PREFETCH='0',
+)
+
+import app  # noqa: E402
+
+NUMBERS = {'special': '11111111', 'grand': '22222222', 'first': ['83696362', '12345678', '55555555']}
+PREVIOUS_NUMBERS = {'special': '33333333', 'grand': '44444444', 'first': ['10000001', '20000002', '30000003']}
+INDEX = app.build_invoice_index(NUMBERS)
+
+
+def wait_for(predicate, timeout=1.0):
+    """等待背景執行緒完成：timeout 秒內 predicate() 成立回傳 True。"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture(autouse=True)
+def shared_cache(monkeypatch, tmp_path):
+    """每個測試使用空白的跨 worker 共用快取。"""
+    cache = app.SharedCache(str(tmp_path / 'cache.db'))
+    monkeypatch.setattr(app, '_shared_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    """每個測試使用空白的本機資料庫與中獎號碼快取。"""
+    monkeypatch.setattr(app, 'DATABASE_PATH', str(tmp_path / 'app.db'))
+    monkeypatch.setattr(app, '_db', {'pid': None, 'conn': None})
+    monkeypatch.setattr(app, '_invoice_indexes', {})
+    monkeypatch.setattr(app, '_invoice_cache', dict(app._invoice_cache, period=None, numbers=None, fetched_at=0.0))
+
+
+@pytest.fixture
+def invoice_fetches(monkeypatch, database):
+    """以固定號碼取代財政部網站，回傳每次抓取的期別（上一期頁面為 PREVIOUS_NUMBERS）。"""
+    calls = []
+
+    def fetch(url=None):
+        period = app.current_invoice_period()
+        if url == app.INVOICE_LAST_URL:
+            calls.append(app.previous_invoice_period(period))
+            return calls[-1], PREVIOUS_NUMBERS
+        calls.append(period)
+        return period, NUMBERS
+
+    monkeypatch.setattr(app, 'fetch_invoice_numbers', fetch)
+    return calls
+
+
+# --- 電子發票期別 ---
+@pytest.mark.parametrize('now, expected', [
+    (datetime(2025, 1, 24), '11310'),  # 單數月 25 日前：上一期尚未開獎
+    (datetime(2025, 1, 25), '11312'),
+    (datetime(2025, 2, 10), '11312'),
+    (datetime(2025, 3, 25), '11402'),
+    (datetime(2025, 12, 31), '11410'),
+])
+def test_current_invoice_period(now, expected):
+    assert app.current_invoice_period(now.replace(tzinfo=app.TAIPEI_TZ)) == expected
+
+
+def test_invoice_numbers_cached_per_period(invoice_fetches):
+    current = app.current_invoice_period()
+    assert app.get_invoice_numbers() == NUMBERS
+    assert app.get_invoice_numbers() == NUMBERS
+    assert invoice_fetches.count(current) == 1
+    app.get_invoice_numbers(force=True)
+    assert invoice_fetches.count(current) == 2
+
+
+def test_invoice_rechecks_until_site_updates(monkeypatch, invoice_fetches):
+    monkeypatch.setattr(app, 'fetch_invoice_numbers', lambda url=None: (invoice_fetches.append(url) or '11110', NUMBERS))
+    app.get_invoice_numbers()
+    app.get_invoice_numbers()  # 官網仍是舊期別：間隔內不重抓
+    assert invoice_fetches.count(None) == 1
+    monkeypatch.setattr(app, 'INVOICE_RECHECK_SECONDS', 0)
+    assert app.get_invoice_numbers() == NUMBERS  # 先回傳舊號碼，於背景重新抓取
+    assert wait_for(lambda: invoice_fetches.count(None) == 2)
+
+
+@pytest.mark.parametrize('num, prize', [
+    ('11111111', '1000 萬元'),
+    ('22222222', '200 萬元'),
+    ('83696362', '20 萬元'),
+    ('03696362', '4 萬元'),
+    ('00696362', '1 萬元'),
+    ('00096362', '4000 元'),
+    ('00006362', '1000 元'),
+    ('00000362', '200 元'),
+    ('00000062', None),
+])
+def test_match_invoice_number(num, prize):
+    message = app.match_invoice_number(num, INDEX)
+    assert (prize in message) if prize else '沒中獎' in message
+
+
+@pytest.mark.parametrize('num, tier', [
+    ('11111111', 'special'),
+    ('22222222', 'grand'),
+    ('83696362', 'first'),
+    ('03696362', 'second'),
+    ('00000362', 'sixth'),
+    ('00000062', None),
+    ('21111111', None),  # 特別獎需 8 碼全中
+])
+def test_classify_invoice_number(num, tier):
+    assert app.classify_invoice_number(num, INDEX) == tier
+
+
+def test_bulk_invoice_lines():
+    lines = [b'12345678\n', b'AB-83696362\n', b'\n', b'AB-1234567\n', b'00000062\n']
+    output = ''.join(app.iter_bulk_invoice_lines(lines, INDEX, chunk_lines=2)).splitlines()
+    assert output == [
+        '發票號碼,獎別,獎金',
+        '12345678,頭獎,200000',
+        '83696362,頭獎,200000',
+        'AB-1234567,格式錯誤,0',
+        '00000062,未中獎,0',
+        '合計,共 3 張 中獎 2 張,400000',
+    ]
+
+
+@pytest.mark.parametrize('digits, expected', [
+    ('20250115', True),
+    ('20240229', True),   # 閏年
+    ('20250229', False),
+    ('21000229', False),  # 整百年不閏
+    ('20251301', False),
+    ('20250100', False),
+    ('19101231', False),  # 民國元年以前
+    ('83696362', False),
+])
+def test_looks_like_date(digits, expected):
+    assert app._looks_like_date(digits) is expected
+
+
+@pytest.mark.parametrize('fields, expected', [
+    (['12345678'], '12345678'),
+    (['AB-83696362'], '83696362'),
+    (['ab 83696362'], '83696362'),
+    (['20250115', 'AB83696362'], '83696362'),  # 帶字軌的欄位優先於日期
+    (['20250115', '12345362'], '12345362'),    # 純數字欄位中略過像日期的
+    (['0983696362'], None),                    # 較長的數字不截斷
+    (['AB-1234567', '2025-01-01'], None),
+    (['x12345678'], None),
+    ([], None),
+])
+def test_find_bulk_invoice_number(fields, expected):
+    assert app.find_bulk_invoice_number(fields) == expected
+
+
+def test_bulk_invoice_output_is_well_formed_csv():
+    lines = ['20250115,AB83696362\n', 'AB-1234567,2025-01-01\n', '=HYPERLINK("x")1\n', '\n', '12345678\n']
+    rows = list(csv.reader(io.StringIO(''.join(app.iter_bulk_invoice_lines([line.encode() for line in lines], INDEX)))))
+    assert rows[0] == ['發票號碼', '獎別', '獎金']
+    assert rows[1] == ['83696362', '頭獎', '200000']
+    assert rows[2] == ['AB-1234567,2025-01-01', '格式錯誤', '0']
+    assert rows[3][0].startswith("'=")
+    assert rows[4] == ['12345678', '頭獎', '200000']
+    assert rows[-1] == ['合計', '共 2 張 中獎 2 張', '400000']
+    assert all(len(row) == 3 for row in rows)
+
+
+@pytest.mark.parametrize('upload', [False, True])
+def test_bulk_invoice_route(client, invoice_fetches, upload):
+    body = b'83696362\n00000362\n'
+    data = {'file': (io.BytesIO(body), 'nums.txt')} if upload else {'nums': body.decode()}
+    response = client.post('/invoice/bulk', data=data)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert response.get_data(as_text=True).splitlines()[-1] == '合計,共 2 張 中獎 2 張,200200'
+
+
+@pytest.mark.parametrize('period, expected', [('11402', '11312'), ('11412', '11410'), ('10004', '10002')])
+def test_previous_invoice_period(period, expected):
+    assert app.previous_invoice_period(period) == expected
+
+
+@pytest.mark.parametrize('period, day, expected', [
+    ('11402', '', '11402'),
+    ('', '2025-01-15', '11402'),
+    ('', '2025-12-31', '11412'),
+    ('', '114/03/01', '11404'),  # 民國年
+    ('', '', None),
+])
+def test_parse_invoice_period(period, day, expected):
+    assert app.parse_invoice_period(period, day) == expected
+
+
+@pytest.mark.parametrize('period, day', [('11401', ''), ('abc', ''), ('', '2025-13-01'), ('', '2025-02-30'), ('', '1/15')])
+def test_parse_invoice_period_rejects(period, day):
+    with pytest.raises(ValueError):
+        app.parse_invoice_period(period, day)
+
+
+def test_invoice_periods_persist_in_database(monkeypatch, invoice_fetches):
+    current = app.current_invoice_period()
+    previous = app.previous_invoice_period(current)
+    app.get_invoice_numbers()
+    assert invoice_fetches == [current, previous]  # 資料庫沒有上一期時順便抓取
+
+    # 模擬重新啟動：清空記憶體，由資料庫載入，不需連網
+    monkeypatch.setattr(app, '_invoice_cache', dict(app._invoice_cache, period=None, numbers=None, fetched_at=0.0))
+    monkeypatch.setattr(app, '_invoice_indexes', {})
+    assert app.get_invoice_numbers() == NUMBERS
+    assert app.get_invoice_index(period=previous) == app.build_invoice_index(PREVIOUS_NUMBERS)
+    assert len(invoice_fetches) == 2
+
+
+def test_save_invoice_period_is_atomic(database):
+    app.save_invoice_period('11402', NUMBERS)
+    assert app.db_execute('PRAGMA journal_mode') == [('wal',)]
+    app.db_execute("CREATE TRIGGER fail BEFORE INSERT ON invoice_suffixes BEGIN SELECT RAISE(ABORT, 'boom'); END")
+    with pytest.raises(app.sqlite3.IntegrityError):
+        app.save_invoice_period('11402', PREVIOUS_NUMBERS)
+    # 末碼寫入失敗時號碼與舊末碼都保留，不會只剩一半
+    assert app.load_latest_invoice_period()[1] == NUMBERS
+    assert app.load_invoice_index('11402') == app.build_invoice_index(NUMBERS)
+
+
+def test_database_write_does_not_wait_long_for_lock(database):
+    app.db_execute('SELECT 1')
+    other = app.sqlite3.connect(app.DATABASE_PATH, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')  # 另一個 worker 正在寫入
+    try:
+        start = time.monotonic()
+        with pytest.raises(app.sqlite3.OperationalError):
+            app.save_invoice_period('11402', NUMBERS)
+        assert time.monotonic() - start < 1
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+
+
+def test_check_invoice_number_by_period(invoice_fetches):
+    current = app.current_invoice_period()
+    previous = app.previous_invoice_period(current)
+    assert '沒中獎' in app.check_invoice_number('10000001', current)
+    assert '20 萬元' in app.check_invoice_number('10000001', previous)
+    assert '尚未開獎' in app.check_invoice_number('10000001', str(int(current) + 100))
+    assert '查無' in app.check_invoice_number('10000001', app.previous_invoice_period(previous))
+
+
+def test_admin_refresh_requires_token(client, monkeypatch, invoice_fetches):
+    assert client.post('/admin/invoice/refresh').status_code == 403  # 未設定權杖時停用
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    for wrong in ('wrong', 'secret2', '密碼'):  # 長度不同或非 ASCII 也不會出錯
+        assert client.post('/admin/invoice/refresh', headers={'X-Admin-Token': wrong}).status_code == 403
+    response = client.post('/admin/invoice/refresh', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    assert response.get_json()['period'] == app.current_invoice_period()
+    assert invoice_fetches.count(app.current_invoice_period()) == 1
+
+
+# --- 股票並行查詢 ---
+def _sleepy_fetch(delays):
+    def fetch(code, timeout):
+        time.sleep(delays[code])
+        return code
+    return fetch
+
+
+def test_stock_details_keep_input_order(monkeypatch):
+    monkeypatch.setattr(app, 'get_stock_details', _sleepy_fetch({'a': 0.2, 'b': 0, 'c': 0.1}))
+    assert app.get_multiple_stock_details(['a', 'b', 'c']) == ['a', 'b', 'c']
+
+
+def test_stock_details_give_up_on_slow_codes(monkeypatch):
+    monkeypatch.setattr(app, 'get_stock_details', _sleepy_fetch({'fast': 0, 'slow': 1}))
+    monkeypatch.setattr(app, 'STOCK_CODE_TIMEOUT', 0.2)
+    start = time.monotonic()
+    fast, slow = app.get_multiple_stock_details(['fast', 'slow'])
+    assert fast == 'fast' and '逾時' in slow
+    assert time.monotonic() - start < 0.8
+
+
+def test_stock_details_budget_covers_whole_request(monkeypatch):
+    monkeypatch.setattr(app, 'get_stock_details', _sleepy_fetch({'a': 0.5, 'b': 0.5}))
+    monkeypatch.setattr(app, 'STOCK_REQUEST_BUDGET', 0.2)
+    start = time.monotonic()
+    assert all('逾時' in r for r in app.get_multiple_stock_details(['a', 'b']))
+    assert time.monotonic() - start < 0.45
+
+
+def test_stock_details_limit_codes_in_flight(monkeypatch):
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def fetch(code, timeout=None):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return code
+
+    monkeypatch.setattr(app, 'get_stock_details', fetch)
+    monkeypatch.setattr(app, 'STOCK_MAX_WORKERS', 2)
+    codes = [str(i) for i in range(6)]
+    assert app.get_multiple_stock_details(codes) == codes
+    assert peak[0] == 2
+
+
+def test_stock_routes_cap_codes(client, monkeypatch):
+    monkeypatch.setattr(app, 'WATCHLIST_MAX_CODES', 2)
+    monkeypatch.setattr(app, 'get_stock_details', lambda code, timeout=None: pytest.fail('不應查詢'))
+    codes = '2330,2317,1101'
+    assert '每次最多查詢 2 支股票' in client.post('/stock', data={'codes': codes}).get_data(as_text=True)
+    assert '每次最多查詢 2 支股票' in client.get(f'/stock/stream?codes={codes}').get_data(as_text=True)
+    response = client.get(f'/api/stock?codes={codes}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'too_many_codes', 'max': 2}
+
+
+def test_fan_out_yields_in_completion_order():
+    codes = ['a', 'b', 'c']
+    fetch = _sleepy_fetch({'a': 0.2, 'b': 0, 'c': 0.1})
+    assert list(app.iter_stock_fan_out(codes, fetch, lambda code: 'timeout')) == [(1, 'b'), (2, 'c'), (0, 'a')]
+    # window=1 時一次只查一支，完成順序即輸入順序
+    assert list(app.iter_stock_fan_out(codes, fetch, lambda code: 'timeout', window=1)) == [
+        (0, 'a'), (1, 'b'), (2, 'c')]
+
+
+def test_fan_out_gives_up_on_slow_codes(monkeypatch):
+    monkeypatch.setattr(app, 'STOCK_CODE_TIMEOUT', 0.2)
+    start = time.monotonic()
+    results = dict(app.iter_stock_fan_out(['fast', 'slow'], _sleepy_fetch({'fast': 0, 'slow': 1}), lambda code: 'timeout'))
+    assert results == {0: 'fast', 1: 'timeout'}
+    assert time.monotonic() - start < 0.8
+
+
+def test_fan_out_budget_cancels_queued_codes(monkeypatch):
+    monkeypatch.setattr(app, 'STOCK_CODE_TIMEOUT', 5)
+    codes = ['a', 'b', 'c']
+    start = time.monotonic()
+    results = dict(app.iter_stock_fan_out(codes, _sleepy_fetch(dict.fromkeys(codes, 0.5)), lambda code: 'timeout',
+                                          window=1, budget=0.2))
+    assert results == {0: 'timeout', 1: 'timeout', 2: 'timeout'}
+    assert time.monotonic() - start < 0.45
+
+
+def test_stock_stream_route(client, monkeypatch):
+    monkeypatch.setattr(app, 'get_stock_details', lambda code, timeout=None: f'line-{code}')
+    response = client.get('/stock/stream?codes=2330,2317')
+    assert response.is_streamed
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    body = response.get_data(as_text=True)
+    assert 'line-2330' in body and 'line-2317' in body
+
+
+# --- 快取與請求合併 ---
+def test_ttl_cache_expires_and_evicts_lru():
+    cache = app.TTLCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # a 變為最近使用
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    time.sleep(0.06)
+    assert cache.get('a') is None
+
+
+def test_single_flight_shares_result_and_errors():
+    flight = app.SingleFlight()
+    calls = []
+    gate = threading.Event()
+
+    def slow():
+        calls.append(1)
+        gate.wait(1)
+        return 'ok'
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(flight.do, 'k', slow) for _ in range(4)]
+        time.sleep(0.05)
+        gate.set()
+        assert [f.result() for f in futures] == ['ok'] * 4
+    assert len(calls) == 1
+
+    with pytest.raises(ZeroDivisionError):
+        flight.do('k', lambda: 1 / 0)
+    assert flight.do('k', lambda: 'again') == 'again'  # 失敗後不殘留
+
+
+def test_stock_quote_cached_within_ttl(monkeypatch):
+    calls = []
+
+    def fetch(code, timeout=10):
+        calls.append(code)
+        return {'code': code, 'title': code, 'price': '1', 'change': '0', 'sign': ''}
+
+    monkeypatch.setattr(app, 'fetch_stock_quote', fetch)
+    monkeypatch.setattr(app, '_quote_cache', app.TTLCache(ttl=60))
+    assert app.get_stock_quote('2330')['code'] == '2330'
+    assert app.get_stock_quote('2330')['code'] == '2330'
+    assert calls == ['2330']
+
+
+# --- 報價頁解析 ---
+def _quote_page(title='台積電 (2330) - Yahoo奇摩股市', trend='up', price='1,085', change='15.00'):
+    return (
+        f'<html><head><title>{title}</title></head><body>'
+        '<div id="main-0-QuoteHeader-Proxy"><div class="D(f) Ai(fe) Mb(4px)">'
+        f'<span class="Fz(32px) Fw(b) Lh(1) C($c-trend-{trend})">{price}</span>'
+        f'<span class="Fz(20px) Fw(b) Lh(1.2) C($c-trend-{trend})">{change}</span>'
+        '</div></div><div id="main-1-QuoteOverview-Proxy"><span class="C($c-trend-down)">x</span></div>'
+        '</body></html>'
+    )
+
+
+@pytest.mark.parametrize('page', [
+    _quote_page(),
+    _quote_page(trend='down'),
+    _quote_page(trend='flat'),
+    _quote_page(title='聯發科 - Yahoo奇摩股市', price='1,2&amp;0'),
+])
+def test_fast_parser_matches_soup(page):
+    fast = app.parse_stock_quote_fast(page, '2330')
+    assert fast is not None
+    assert fast == app.parse_stock_quote_soup(page, '2330')
+
+
+@pytest.mark.parametrize('page', [
+    _quote_page(price='<b>1,085</b>'),  # 元素內有子標籤
+    '<html><head><title>台積電 (2330) - Yahoo奇摩股市</title></head><body></body></html>',
+])
+def test_fast_parser_falls_back_to_soup(page):
+    assert app.parse_stock_quote_fast(page, '2330') is None
+    assert app.parse_stock_quote(page, '2330') == app.parse_stock_quote_soup(page, '2330')
+
+
+def test_find_class_tag_requires_whole_class_name():
+    page = '<p class="Fz(32px)x">a</p><p title="Fz(32px)">b</p><p class="A Fz(32px)">c</p>'
+    assert page[app._find_class_tag(page, 'Fz(32px)') + 1] == 'c'
+    assert app._find_class_tag(page, 'Fz(20px)') == -1
+
+
+@pytest.mark.parametrize('page', ['<span class="Fz(32px)', 'Fz(32px)', ''])
+def test_find_class_tag_at_end_of_page(page):
+    assert app._find_class_tag(page, 'Fz(32px)') == -1  # 截斷的頁面不會超出範圍
+
+
+# --- 匯率 ---
+RATE_CSV = (
+    '幣別,匯率,現金,即期,遠期10天,遠期30天,遠期60天,遠期90天,遠期120天,遠期150天,遠期180天,匯率,現金,即期\n'
+    'USD,本行買入,30.5,30.8,0,0,0,0,0,0,0,本行賣出,31.2,30.9\n'
+    'JPY,本行買入,0.2,0.21,0,0,0,0,0,0,0,本行賣出,0.22,0.215\n'
+)
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.encoding = None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise app.requests.HTTPError(str(self.status_code))
+
+
+def test_parse_exchange_rates_csv():
+    assert app.parse_exchange_rates_csv(RATE_CSV) == {
+        'USD': app.ExchangeRate('USD', 30.5, 31.2, 30.8, 30.9),
+        'JPY': app.ExchangeRate('JPY', 0.2, 0.22, 0.21, 0.215),
+    }
+
+
+def test_refresh_exchange_rates_uses_conditional_get(monkeypatch):
+    sent = []
+
+    def get(url, headers=None, **kwargs):
+        sent.append(dict(headers or {}))
+        if headers and headers.get('If-None-Match') == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, RATE_CSV, {'ETag': '"v1"', 'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT'})
+
+    monkeypatch.setattr(app, 'http_get', get)
+    monkeypatch.setattr(app, '_rate_state', dict(app._rate_state, rates=None, etag=None, last_modified=None))
+    monkeypatch.setattr(app, 'RATE_REFRESH_INTERVAL', 0)  # 共用快取中的匯率表一律視為過期
+    assert app.refresh_exchange_rates()
+    assert not app.refresh_exchange_rates()  # 304：沿用記憶體中的匯率表
+    assert sent[1] == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Wed, 01 Jan 2025 00:00:00 GMT'}
+    assert app.get_exchange_rates(['JPY', 'EUR']) == ['JPY : 0.22000']
+
+
+def test_stock_quote_url_is_configurable(monkeypatch):
+    urls = []
+    monkeypatch.setattr(app, 'STOCK_QUOTE_URL', 'http://127.0.0.1:9/quote/{code}')
+    monkeypatch.setattr(app, 'http_get', lambda url, **kwargs: urls.append(url) or FakeResponse(200, _quote_page()))
+    assert app.fetch_stock_quote('2330')['price'] == '1,085'
+    assert urls == ['http://127.0.0.1:9/quote/2330']
+
+
+# --- 共用 HTTP 連線 ---
+@pytest.fixture
+def session_gets(monkeypatch):
+    """以假的 Session.get 取代網路請求，回傳每次呼叫的 (url, timeout)。"""
+    calls = []
+
+    def get(url, timeout=None, **kwargs):
+        calls.append((url, timeout))
+        time.sleep(0.05)
+        return FakeResponse()
+
+    monkeypatch.setattr(app._http_session, 'get', get)
+    return calls
+
+
+def test_http_get_default_timeouts(session_gets):
+    app.http_get('http://example.test/a')
+    app.http_get('http://example.test/b', timeout=1)
+    app.http_get('http://example.test/c', timeout=(1, 2))
+    assert [t for _, t in session_gets] == [
+        (app.HTTP_CONNECT_TIMEOUT, app.HTTP_READ_TIMEOUT), (1, 1), (1, 2)]
+
+
+def test_http_get_limits_requests_per_host(monkeypatch, session_gets):
+    monkeypatch.setattr(app, 'HTTP_HOST_CONCURRENCY', 1)
+    monkeypatch.setattr(app, '_http_host_slots', {})
+    start = time.monotonic()
+    with ThreadPoolExecutor(3) as pool:
+        list(pool.map(app.http_get, ['http://one.test/', 'http://one.test/', 'http://two.test/']))
+    assert time.monotonic() - start >= 0.1  # 同一主機的兩個請求依序進行
+    assert set(app._http_host_slots) == {'one.test', 'two.test'}
+
+
+def test_http_get_sheds_when_host_slots_stay_busy(monkeypatch):
+    monkeypatch.setattr(app, 'HTTP_HOST_CONCURRENCY', 1)
+    monkeypatch.setattr(app, '_http_host_slots', {})
+    monkeypatch.setattr(app._http_session, 'get', lambda url, **kwargs: time.sleep(0.5) or FakeResponse())
+    with ThreadPoolExecutor(1) as pool:
+        stuck = pool.submit(app.http_get, 'http://stuck.test/', upstream='test-slots')
+        time.sleep(0.05)
+        start = time.monotonic()
+        with pytest.raises(app.UpstreamBusy):
+            app.http_get('http://stuck.test/', timeout=0.1, upstream='test-slots')
+        assert time.monotonic() - start < 0.4  # 只等一個連線逾時
+        assert stuck.result().status_code == 200
+    assert 'upstream_shed_total{upstream="test-slots",reason="host_slots"} 1' in app.render_metrics()
+
+
+def test_http_session_retries_transient_errors():
+    retry = app._http_session.get_adapter('https://example.test/').max_retries
+    assert retry.total == app.HTTP_RETRIES
+    assert 503 in retry.status_forcelist and 'POST' not in retry.allowed_methods
+    assert retry.backoff_jitter == app.HTTP_BACKOFF  # 需要 urllib3 2.x（列於 requirements.txt）
+
+
+# --- 頁面 ---
+def test_pages_link_versioned_stylesheet(client):
+    body = client.get('/').get_data(as_text=True)
+    with app.app.test_request_context():
+        url = app.static_url('style.css')
+    assert '?v=' in url and url in body
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.max_age == 365 * 24 * 3600
+
+
+def test_stock_stream_form_omits_token(client):
+    page = client.get('/stock').get_data(as_text=True)
+    stream_form = page[page.index('<form action="/stock/stream"'):]
+    stream_form = stream_form[:stream_form.index('</form>')]
+    assert 'method="get"' in stream_form and 'name="codes"' in stream_form
+    assert 'name="token"' not in stream_form and 'formmethod' not in page  # 權杖不會出現在網址
+
+
+def test_invoice_page_shows_result(client, invoice_fetches):
+    response = client.post('/invoice', data={'num': '83696362'})
+    assert response.status_code == 200
+    assert '20 萬元' in response.get_data(as_text=True)
+
+
+# --- JSON API ---
+@pytest.fixture
+def stock_quotes(monkeypatch):
+    """以固定報價取代 Yahoo 股市，回傳每次抓取的代碼。"""
+    calls = []
+
+    def fetch(code, timeout=None):
+        calls.append(code)
+        if code == 'bad':
+            raise app.requests.ConnectionError('down')
+        return {'code': code, 'title': f'測試 ({code})', 'price': '1,085.5', 'change': '15.00', 'sign': '-'}
+
+    monkeypatch.setattr(app, 'fetch_stock_quote', fetch)
+    monkeypatch.setattr(app, '_quote_cache', app.TTLCache(ttl=60))
+    return calls
+
+
+def test_api_invoice_etag(client, invoice_fetches):
+    response = client.get('/api/invoice?num=00000362')
+    assert response.get_json() == {'num': '00000362', 'period': app.current_invoice_period(), 'latest': True,
+                                   'won': True, 'tier': 'sixth', 'prize': '六獎', 'amount': 200}
+    again = client.get('/api/invoice?num=00000362', headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+
+
+def test_api_invoice_rejects_bad_number(client):
+    response = client.get('/api/invoice?num=1234')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'invalid_number'}
+
+
+def test_api_stock(client, stock_quotes):
+    quotes = client.get('/api/stock?codes=2330, bad').get_json()['quotes']
+    assert quotes == [
+        {'code': '2330', 'name': '測試 (2330)', 'price': 1085.5, 'change': -15.0, 'sign': '-', 'stale_age': None},
+        {'code': 'bad', 'error': 'upstream'},
+    ]
+    assert client.get('/api/stock?codes=').status_code == 400
+
+
+# --- 貨幣換算 ---
+TABLE = {
+    'USD': app.ExchangeRate('USD', 30.0, 31.0, 30.5, 30.7),
+    'JPY': app.ExchangeRate('JPY', 0.2, 0.25, None, 0.21),
+}
+
+
+@pytest.fixture
+def bot_rates(monkeypatch):
+    """以 RATE_CSV 取代台灣銀行匯率下載。"""
+    monkeypatch.setattr(app, 'http_get', lambda url, **kwargs: FakeResponse(200, RATE_CSV))
+    monkeypatch.setattr(app, '_rate_state', dict(app._rate_state, rates=None, etag=None, last_modified=None))
+
+
+@pytest.mark.parametrize('amount, source, target, kind, expected', [
+    (100, 'USD', 'TWD', 'cash', 3000.0),
+    (310, 'TWD', 'USD', 'cash', 10.0),
+    (1, 'USD', 'JPY', 'cash', 120.0),
+    (100, 'TWD', 'TWD', 'spot', 100.0),
+])
+def test_convert_currency(amount, source, target, kind, expected):
+    result, _ = app.convert_currency(TABLE, amount, source, target, kind)
+    assert result == pytest.approx(expected)
+
+
+def test_convert_currency_missing_rate():
+    with pytest.raises(KeyError):
+        app.convert_currency(TABLE, 1, 'JPY', 'TWD', 'spot')
+
+
+def test_convert_route(client, bot_rates):
+    response = client.get('/convert?amount=100&from=USD&to=TWD&type=cash')
+    assert response.get_json() == {'amount': 100.0, 'from': 'USD', 'to': 'TWD', 'type': 'cash',
+                                   'rate': 30.5, 'result': 3050.0}
+
+
+@pytest.mark.parametrize('query, status, error', [
+    ('amount=abc&from=USD', 400, 'invalid_amount'),
+    ('amount=nan&from=USD', 400, 'invalid_amount'),
+    ('amount=inf&from=USD', 400, 'invalid_amount'),
+    ('amount=-Infinity&from=USD', 400, 'invalid_amount'),
+    ('from=USD', 400, 'invalid_amount'),
+    ('amount=1&from=USD&type=wire', 400, 'invalid_type'),
+    ('amount=1&from=XYZ', 400, 'unknown_currency'),
+])
+def test_convert_rejects_bad_input(client, bot_rates, query, status, error):
+    response = client.get(f'/convert?{query}')
+    assert response.status_code == status
+    assert response.get_json()['error'] == error
+
+
+def test_api_rates(client, bot_rates):
+    rates = client.get('/api/rates').get_json()['rates']
+    assert rates['USD'] == {'cash_buy': 30.5, 'cash_sell': 31.2, 'spot_buy': 30.8, 'spot_sell': 30.9}
+
+
+# --- 監控指標 ---
+def test_metrics_text_format(monkeypatch):
+    monkeypatch.setattr(app, '_metrics_registry', [])
+    hits = app.Counter('test_hits_total', '測試計數', ('kind',))
+    hits.inc('a')
+    hits.inc('a', amount=2)
+    seconds = app.Histogram('test_seconds', '測試時間', buckets=(0.1, 1))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    assert app.render_metrics().splitlines() == [
+        '# HELP test_hits_total 測試計數',
+        '# TYPE test_hits_total counter',
+        'test_hits_total{kind="a"} 3',
+        '# HELP test_seconds 測試時間',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 2',
+        'test_seconds_sum 0.55',
+        'test_seconds_count 2',
+    ]
+
+
+def test_metrics_route_records_requests(client):
+    client.get('/')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{route="/",method="GET"}' in body
+    assert 'http_requests_in_flight{route="/"} 0' in body
+
+
+def test_http_get_counts_upstream_failures(monkeypatch):
+    def get(url, **kwargs):
+        raise app.requests.Timeout('slow')
+
+    monkeypatch.setattr(app._http_session, 'get', get)
+    with pytest.raises(app.requests.Timeout):
+        app.http_get('http://example.test/', upstream='test-timeout')
+    body = app.render_metrics()
+    assert 'upstream_fetch_timeouts_total{upstream="test-timeout"} 1' in body
+    assert 'upstream_fetch_duration_seconds_count{upstream="test-timeout"} 1' in body
+
+
+# --- 離線上游替身 ---
+def test_stub_invoice_page_round_trip(client, database):
+    numbers = app.get_invoice_numbers()
+    assert len(numbers['first']) == 3
+    response = client.post('/invoice/bulk', data={'nums': f"20250115,AB{numbers['first'][0]}\n"})
+    assert response.get_data(as_text=True).splitlines()[1] == f"{numbers['first'][0]},頭獎,200000"
+
+
+def test_fast_parser_matches_soup_on_captured_page():
+    page = load_fixture('yahoo_quote_2330.html').decode('utf-8')
+    fast = app.parse_stock_quote_fast(page, '2330')
+    assert fast is not None and fast['price'] != 'N/A'
+    assert fast == app.parse_stock_quote_soup(page, '2330')
+
+
+def test_stub_rates_conditional_get(client, monkeypatch):
+    monkeypatch.setattr(app, '_rate_state', dict(app._rate_state, rates=None, etag=None, last_modified=None))
+    monkeypatch.setattr(app, 'RATE_REFRESH_INTERVAL', 0)
+    before = _stub_config.hits.get('rates', 0)
+    assert app.refresh_exchange_rates()
+    assert not app.refresh_exchange_rates()  # 替身以 ETag 回應 304
+    assert _stub_config.hits['rates'] == before + 2
+    response = client.get('/convert?amount=100&from=USD&to=TWD')
+    assert response.status_code == 200
+    assert response.get_json()['result'] > 0
+
+
+# --- 過期資料與斷路器 ---
+def test_circuit_breaker_opens_and_probes():
+    breaker = app.CircuitBreaker('test', failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()        # 半開：只放行一個試探請求
+    assert not breaker.allow()
+    breaker.record_failure()      # 試探失敗立即重新開啟
+    assert breaker.state == 'open'
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow() and breaker.allow()
+
+
+def test_http_get_short_circuits_open_upstream(monkeypatch, session_gets):
+    breaker = app._circuit_breaker('test-open')
+    monkeypatch.setattr(breaker, 'failures', breaker.failure_threshold - 1)
+    breaker.record_failure()
+    with pytest.raises(app.UpstreamUnavailable):
+        app.http_get('http://example.test/', upstream='test-open')
+    assert session_gets == []
+    assert 'upstream_short_circuits_total{upstream="test-open"} 1' in app.render_metrics()
+
+
+def test_open_breaker_rejects_before_rate_limit(monkeypatch, session_gets):
+    bucket = app.TokenBucket('test-limited', rate=1, burst=1, max_waiters=0)
+    bucket.acquire()  # 配額已用完：再取得會立即拋出 UpstreamBusy
+    monkeypatch.setattr(app, '_rate_limiters', {'test-limited': bucket})
+    breaker = app._circuit_breaker('test-limited')
+    monkeypatch.setattr(breaker, 'reset_seconds', 0.05)
+    monkeypatch.setattr(breaker, 'failures', breaker.failure_threshold - 1)
+    breaker.record_failure()
+    with pytest.raises(app.UpstreamUnavailable):  # 開啟中不排隊等配額
+        app.http_get('http://example.test/', upstream='test-limited')
+
+    time.sleep(0.06)
+    with pytest.raises(app.UpstreamBusy):  # 可以試探時先取得配額，試探名額不會被佔住
+        app.http_get('http://example.test/', upstream='test-limited')
+    assert breaker.state == 'open' and breaker.allow()
+    assert session_gets == []
+
+
+@pytest.fixture
+def expired_quote(monkeypatch, stock_quotes):
+    """先抓一次 2330 並讓快取過期；斷路器改用全新的一組。"""
+    monkeypatch.setattr(app, '_circuit_breakers', {})
+    monkeypatch.setattr(app, '_quote_cache', app.TTLCache(ttl=0.05))
+    app.get_stock_quote('2330')
+    time.sleep(0.06)
+    return stock_quotes
+
+
+def test_expired_quote_refetched_while_upstream_healthy(expired_quote):
+    assert 'stale_age' not in app.get_stock_quote('2330')
+    assert len(expired_quote) == 2  # 同步抓取，不沿用舊報價
+
+
+def test_stale_quote_served_when_fetch_fails(monkeypatch, expired_quote):
+    def timeout(code, timeout=None):
+        raise app.requests.Timeout('slow')
+    monkeypatch.setattr(app, 'fetch_stock_quote', timeout)
+    assert app.get_stock_quote('2330')['stale_age'] >= 0.05
+
+
+def test_stale_quote_served_while_breaker_open(monkeypatch, expired_quote):
+    breaker = app._circuit_breaker('yahoo')
+    monkeypatch.setattr(breaker, 'failures', breaker.failure_threshold - 1)
+    breaker.record_failure()
+    quote = app.get_stock_quote('2330')
+    assert quote['stale_age'] >= 0.05
+    assert wait_for(lambda: len(expired_quote) == 2)  # 背景更新
+    assert 'stale_age' not in app.get_stock_quote('2330')
+
+
+def test_expired_rates_refreshed_in_request(shared_cache, monkeypatch, bot_rates):
+    monkeypatch.setattr(app, '_circuit_breakers', {})
+    table = app.ensure_exchange_rates()
+    shared_cache._execute('DELETE FROM shared_cache')
+    calls = []
+    monkeypatch.setattr(app, 'http_get', lambda url, **kwargs: calls.append(url) or FakeResponse(304, ''))
+    app._rate_state['checked_at'] = 0
+    assert app.ensure_exchange_rates() is table
+    assert calls == [app.RATE_URL]  # 上游正常時同步確認
+
+    def down(url, **kwargs):
+        raise app.requests.ConnectionError('down')
+    monkeypatch.setattr(app, 'http_get', down)
+    app._rate_state['checked_at'] = 0
+    assert app.ensure_exchange_rates() is table  # 抓取失敗時沿用手上的匯率表
+
+
+def test_stale_quote_notice():
+    quote = {'title': '台積電 (2330)', 'price': '1,085', 'change': '15.00', 'sign': '+'}
+    assert app.format_stock_quote(quote) == '【台積電 (2330)】：1,085 (+15.00)'
+    assert app.format_stock_quote(dict(quote, stale_age=125)).endswith('（2 分鐘前的報價，暫時無法更新）')
+
+
+# --- 觀察清單與共用報價輪詢 ---
+@pytest.mark.parametrize('now, expected', [
+    (datetime(2025, 1, 6, 9, 0), True),     # 週一開盤
+    (datetime(2025, 1, 6, 13, 30), False),  # 收盤
+    (datetime(2025, 1, 6, 8, 59), False),
+    (datetime(2025, 1, 4, 10, 0), False),   # 週六
+])
+def test_taiwan_market_open(now, expected):
+    assert app.taiwan_market_open(now.replace(tzinfo=app.TAIPEI_TZ)) == expected
+
+
+@pytest.mark.parametrize('now, seconds', [
+    (datetime(2025, 1, 6, 10, 0), 0),             # 開盤中
+    (datetime(2025, 1, 6, 8, 30), 1800),
+    (datetime(2025, 1, 6, 14, 0), 19 * 3600),      # 收盤後等到隔天
+    (datetime(2025, 1, 10, 14, 0), 67 * 3600),     # 週五收盤後等到週一
+])
+def test_seconds_until_market_open(now, seconds):
+    assert app.seconds_until_market_open(now.replace(tzinfo=app.TAIPEI_TZ)) == seconds
+
+
+def test_watchlist_api(client, database):
+    assert client.get('/api/watchlists/mine').status_code == 404
+    created = client.put('/api/watchlists/mine', data={'codes': '2330,2317,2330'}).get_json()
+    token = created.pop('token')
+    assert created == {'name': 'mine', 'codes': ['2330', '2317']}
+    assert app.get_watchlist('mine') == ['2317', '2330']
+    assert client.put('/api/watchlists/mine', data={'codes': '23 30'}).status_code == 400
+
+    # 修改或刪除需附上建立時取得的權杖
+    for headers in ({}, {'X-Watchlist-Token': 'wrong'}):
+        assert client.put('/api/watchlists/mine', data={'codes': '1101'}, headers=headers).status_code == 403
+        assert client.delete('/api/watchlists/mine', headers=headers).status_code == 403
+    updated = client.put('/api/watchlists/mine', data={'codes': '1101'}, headers={'X-Watchlist-Token': token})
+    assert updated.get_json() == {'name': 'mine', 'codes': ['1101']}
+    assert client.delete('/api/watchlists/mine', headers={'X-Watchlist-Token': token}).status_code == 200
+    assert app.get_watchlist('mine') == []
+
+
+def test_watchlists_share_code_and_list_caps(monkeypatch, database):
+    monkeypatch.setattr(app, 'STOCK_POLL_MAX_CODES', 2)
+    monkeypatch.setattr(app, 'WATCHLIST_MAX_LISTS', 2)
+    app.save_watchlist('a', ['2330', '2317'])
+    app.save_watchlist('b', ['2330'])  # 已在輪詢中的代碼不佔新名額
+    with pytest.raises(ValueError):
+        app.save_watchlist('c', ['1101'])
+    monkeypatch.setattr(app, 'STOCK_POLL_MAX_CODES', 50)
+    with pytest.raises(ValueError):
+        app.save_watchlist('c', ['2330'])
+
+
+def test_poller_serves_watched_codes_from_snapshot(monkeypatch, database, stock_quotes):
+    monkeypatch.setattr(app, '_quote_snapshot', {})
+    app.save_watchlist('a', ['2330', '2317'])
+    app.save_watchlist('b', ['2330'])
+    threads = []
+    fetch = app.fetch_stock_quote
+    monkeypatch.setattr(app, 'fetch_stock_quote',
+                        lambda code, timeout=None: threads.append(threading.current_thread().name) or fetch(code, timeout))
+    app.poll_watched_quotes()
+    assert sorted(stock_quotes) == ['2317', '2330']  # 相異代碼各抓一次
+    assert all(name.startswith('stock-poll') for name in threads)  # 不佔用使用者查詢的執行緒池
+    monkeypatch.setattr(app, '_quote_cache', app.TTLCache(ttl=60))
+    assert app.get_stock_quote('2330')['code'] == '2330'
+    assert len(stock_quotes) == 2
+
+
+# --- 即時推播 (SSE) ---
+def _quote(code='2330', price='1,085'):
+    return {'code': code, 'title': f'測試 ({code})', 'price': price, 'change': '15.00', 'sign': '+'}
+
+
+def test_quote_publisher_only_notifies_changes():
+    publisher = app.QuotePublisher()
+    publisher.publish('2330', _quote())
+    version, changed = publisher.wait(['2330'], 0, 0)
+    assert changed == [_quote()]
+    publisher.publish('2330', _quote())  # 價格未變：不遞增版本
+    assert publisher.wait(['2330'], version, 0.05) == (version, [])
+
+
+def test_quote_publisher_wakes_subscribers():
+    publisher = app.QuotePublisher()
+    publisher.subscribe(['2330'])
+    threading.Timer(0.05, publisher.publish, ('2330', _quote())).start()
+    start = time.monotonic()
+    assert publisher.wait(['2330'], 0, 2)[1] == [_quote()]
+    assert time.monotonic() - start < 1
+    publisher.unsubscribe(['2330'])
+    assert publisher.subscribed_codes() == []
+
+
+def test_quote_publisher_batches_wakeups(monkeypatch):
+    publisher = app.QuotePublisher()
+    publisher.subscribe(['2330', '2317'])
+    wakeups = []
+    notify_all = publisher._cond.notify_all
+    monkeypatch.setattr(publisher._cond, 'notify_all', lambda: wakeups.append(1) or notify_all())
+    publisher.publish_many([('2330', _quote('2330')), ('2317', _quote('2317')), ('1101', _quote('1101'))])
+    assert wakeups == [1]
+    assert [q['code'] for q in publisher.wait(['2330', '2317'], 0, 0)[1]] == ['2330', '2317']
+    publisher.publish_many([('1101', _quote('1101', price='1'))])  # 無人訂閱的代碼不喚醒
+    assert wakeups == [1]
+
+
+def test_quote_events_stream(monkeypatch, stock_quotes):
+    publisher = app.QuotePublisher()
+    monkeypatch.setattr(app, '_quote_publisher', publisher)
+    monkeypatch.setattr(app, 'STOCK_EVENTS_HEARTBEAT', 0.05)
+    events = app.iter_quote_events(['2330'])
+    assert next(events) == b'retry: 5000\n\n'
+    first = next(events)  # 尚無快照的代碼先在背景抓取
+    assert first.startswith(b'event: quote\ndata: ')
+    assert json.loads(first.split(b'data: ')[1])['name'] == '測試 (2330)'
+    assert next(events) == b': keep-alive\n\n'
+    publisher.publish('2330', _quote(price='1,090'))
+    update = json.loads(next(events).split(b'data: ')[1])
+    assert update['price'] == 1090 and 'name' not in update  # 名稱只送一次
+    events.close()
+
+
+def test_poller_includes_subscribed_codes(monkeypatch, database, stock_quotes):
+    publisher = app.QuotePublisher()
+    publisher.subscribe(['2317'])
+    monkeypatch.setattr(app, '_quote_publisher', publisher)
+    monkeypatch.setattr(app, '_quote_snapshot', {})
+    app.poll_watched_quotes()
+    assert stock_quotes == ['2317']
+    assert publisher.wait(['2317'], 0, 0)[1][0]['code'] == '2317'
+
+
+def test_quote_publisher_subscribe_limit():
+    publisher = app.QuotePublisher()
+    assert publisher.subscribe(['2330'], limit=2, watched=['1101'])
+    assert publisher.subscribe(['2330', '1101'], limit=2, watched=['1101'])  # 已在輪詢中的代碼不佔名額
+    assert not publisher.subscribe(['2317'], limit=2, watched=['1101'])
+    assert sorted(publisher.subscribed_codes()) == ['1101', '2330']
+
+
+def test_stock_events_subscription(client, monkeypatch, database):
+    publisher = app.QuotePublisher()
+    monkeypatch.setattr(app, '_quote_publisher', publisher)
+    monkeypatch.setattr(app, 'STOCK_POLL_MAX_CODES', 1)
+    response = client.get('/stock/events?codes=2330', buffered=False)
+    assert response.status_code == 200 and publisher.subscribed_codes() == ['2330']
+
+    full = client.get('/stock/events?codes=2317')  # 輪詢已滿：拒絕而不是默默不更新
+    assert full.status_code == 503 and full.headers['Retry-After'] == str(app.STOCK_EVENTS_RETRY_AFTER)
+    assert full.get_json()['error'] == 'poll_full'
+    with pytest.raises(ValueError):
+        app.save_watchlist('mine', ['2317'])  # 推播訂閱的代碼也計入觀察清單總數
+
+    response.close()  # 連線結束即取消訂閱
+    assert publisher.subscribed_codes() == []
+
+
+@pytest.mark.parametrize('codes', ['', '2330,bad code', ','.join(map(str, range(51)))])
+def test_stock_events_rejects_invalid_codes(client, codes):
+    response = client.get(f'/stock/events?codes={codes}')
+    assert response.status_code == 400
+
+
+# --- 匯率歷史 ---
+@pytest.fixture(params=['numpy', 'array'])
+def stats_backend(request, monkeypatch):
+    """分別以 numpy（requirements.txt 的相依套件）與沒有 numpy 時的 array 計算統計。"""
+    if request.param == 'array':
+        monkeypatch.setattr(app, 'HAS_NUMPY', False)
+    else:
+        assert app.HAS_NUMPY
+
+
+def test_rate_history_wraps_around(tmp_path, stats_backend):
+    path = str(tmp_path / 'USD.bin')
+    history = app.RateHistory(4, path)
+    for t in range(6):
+        assert history.append(100 + t, [t, None, t, t])
+    assert not history.append(103, [0, 0, 0, 0])  # 不晚於最後一筆的樣本略過
+
+    columns = app.RateHistory(4, path).columns()  # 重新開啟映射檔仍保留
+    assert list(columns['time']) == [102, 103, 104, 105]
+    assert list(columns['cash_buy']) == [2, 3, 4, 5]
+    assert all(v != v for v in columns['cash_sell'])  # 缺值為 NaN
+
+    stats = app.rate_window_stats(columns['time'], columns['cash_buy'], 103.5)
+    assert (stats['samples'], stats['min'], stats['max'], stats['avg']) == (2, 4, 5, 4.5)
+    assert stats['change_pct'] == 25.0
+    assert app.rate_window_stats(columns['time'], columns['cash_sell'], 0)['samples'] == 0
+
+
+@pytest.mark.parametrize('text, seconds', [('30m', 1800), ('12h', 43200), ('7d', 604800), ('4w', 2419200)])
+def test_parse_rate_window(text, seconds):
+    assert app.parse_rate_window(text) == seconds
+
+
+@pytest.mark.parametrize('text', ['0d', '1y', 'd', '-1h'])
+def test_parse_rate_window_rejects(text):
+    with pytest.raises(ValueError):
+        app.parse_rate_window(text)
+
+
+def test_api_rates_history(client, monkeypatch):
+    monkeypatch.setattr(app, '_rate_histories', {})
+    now = time.time()
+    app.record_rate_history(TABLE, now - 7200)
+    app.record_rate_history({'USD': TABLE['USD']._replace(spot_sell=31.4)}, now - 60)
+    body = client.get('/api/rates/history?currency=usd&windows=1h,1d').get_json()
+    assert body['samples'] == 2
+    assert body['windows']['1h']['samples'] == 1
+    assert body['windows']['1d'] == {'samples': 2, 'min': 30.7, 'max': 31.4, 'avg': 31.05,
+                                     'first': 30.7, 'last': 31.4, 'change_pct': 2.2801}
+    assert client.get('/api/rates/history?currency=EUR').status_code == 404
+    assert client.get('/api/rates/history?currency=USD&windows=1y').status_code == 400
+
+
+# --- 上游速率限制 ---
+def test_token_bucket_waits_for_next_token():
+    bucket = app.TokenBucket('test', rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert 0.01 <= time.monotonic() - start < 0.5
+
+
+@pytest.mark.parametrize('options, reason', [({'max_wait': 0.5}, 'wait_too_long'), ({'max_waiters': 0}, 'queue_full')])
+def test_token_bucket_sheds_load(options, reason):
+    bucket = app.TokenBucket(f'test-{reason}', rate=1, burst=1, **options)
+    bucket.acquire()
+    with pytest.raises(app.UpstreamBusy) as e:
+        bucket.acquire()
+    assert e.value.retry_after == 1
+    assert f'upstream="test-{reason}",reason="{reason}"' in app.render_metrics()
+
+
+@pytest.mark.parametrize('text, expected', [('2:5', (2.0, 5.0)), ('10', (10.0, 10.0)), ('0.5', (0.5, 1.0)), ('0', None), ('', None)])
+def test_parse_rate_limit(text, expected):
+    assert app._parse_rate_limit(text) == expected
+
+
+def test_api_busy_upstream_returns_retry_after(client, monkeypatch):
+    bucket = app.TokenBucket('bot', rate=0.5, burst=1, max_waiters=0)
+    bucket.acquire()
+    monkeypatch.setattr(app, '_rate_limiters', {'bot': bucket})
+    monkeypatch.setattr(app, '_rate_state', dict(app._rate_state, rates=None, etag=None, last_modified=None))
+    response = client.get('/api/rates')
+    assert response.status_code == 503
+    assert response.get_json() == {'error': 'busy', 'retry_after': 2}
+    assert response.headers['Retry-After'] == '2'
+
+
+# --- 跨 worker 共用快取 ---
+def _lease_held_by_other_worker(cache, name):
+    cache._execute('INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)',
+                   (name, os.getpid() + 1, time.time() + 60))
+
+
+def test_shared_cache_round_trip(shared_cache):
+    shared_cache.set('a', {'x': [1, 2]}, ttl=60, stored_at=time.time() - 5)
+    value, age = shared_cache.get('a')
+    assert value == {'x': [1, 2]} and 5 <= age < 6
+    assert shared_cache.get('missing') is None
+    assert set(shared_cache.get_many(['a', 'missing'])) == {'a'}
+
+
+def test_shared_cache_lease(shared_cache):
+    assert shared_cache.acquire_lease('mine', 60)
+    assert shared_cache.acquire_lease('mine', 60)  # 同一行程可續約
+    _lease_held_by_other_worker(shared_cache, 'theirs')
+    assert not shared_cache.acquire_lease('theirs', 60)
+    shared_cache.release_lease('theirs')  # 只能釋放自己的租約
+    assert not shared_cache.acquire_lease('theirs', 60)
+
+
+def test_shared_cache_set_releases_lease(shared_cache):
+    assert shared_cache.acquire_lease('quote:2330', 60)
+    shared_cache.set('quote:2330', _quote(), ttl=60, release='quote:2330')
+    assert shared_cache.get('quote:2330')[0] == _quote()
+    _lease_held_by_other_worker(shared_cache, 'mine')
+    shared_cache.set('mine', 1, ttl=60, release='mine')  # 別人的租約不受影響
+    with shared_cache._lock:
+        owner = shared_cache._connection().execute('SELECT owner FROM leases WHERE name = ?', ('mine',)).fetchone()[0]
+    assert owner != os.getpid()
+
+
+def test_rate_refresher_backs_off_while_other_worker_fetches(shared_cache, monkeypatch, bot_rates):
+    app.ensure_exchange_rates()
+    monkeypatch.setattr(app, 'RATE_REFRESH_INTERVAL', 0)
+    shared_cache._execute('DELETE FROM shared_cache')
+    _lease_held_by_other_worker(shared_cache, 'rates')
+    monkeypatch.setattr(app, 'http_get', lambda url, **kwargs: pytest.fail('不應抓取'))
+    app._rate_state['checked_at'] = 0
+    assert not app.refresh_exchange_rates()
+    assert app._rate_state['checked_at'] > time.time() - 1  # 下次檢查延後，定時更新不會空轉
+
+
+def test_quote_from_other_worker(shared_cache, stock_quotes):
+    shared_cache.set('quote:2330', _quote(), ttl=60)
+    assert app.get_stock_quote('2330') == _quote()
+    assert stock_quotes == []
+
+
+def test_quote_waits_for_lease_holder(shared_cache, stock_quotes):
+    _lease_held_by_other_worker(shared_cache, 'quote:2330')
+    threading.Timer(0.1, shared_cache.set, ('quote:2330', _quote(), 60)).start()
+    assert app.get_stock_quote('2330') == _quote()
+    assert stock_quotes == []
+
+
+# --- 啟動預熱與就緒檢查 ---
+@pytest.fixture
+def warm_state(monkeypatch):
+    state = dict(app._warm_state, pid=None, steps={})
+    monkeypatch.setattr(app, '_warm_state', state)
+    return state
+
+
+def test_readyz_after_warm_up(client, warm_state):
+    response = client.get('/readyz')
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert wait_for(lambda: warm_state['ready'])
+    body = client.get('/readyz').get_json()
+    assert body['ready'] and not body['degraded']
+    assert set(body['steps']) == {'imports'}
+
+
+def test_warm_up_prefetches_upstreams(client, monkeypatch, warm_state, invoice_fetches, bot_rates):
+    monkeypatch.setattr(app, 'WARM_PREFETCH', True)
+    app.start_warm_up()
+    assert wait_for(lambda: warm_state['ready'])
+    assert set(warm_state['steps']) == {'imports', 'invoice', 'rates'}
+    assert client.get('/readyz').status_code == 200
+
+
+def test_warm_up_gives_up_on_failing_upstream(client, monkeypatch, warm_state, database):
+    def down(url=None):
+        raise app.requests.ConnectionError('down')
+
+    monkeypatch.setattr(app, 'WARM_PREFETCH', True)
+    monkeypatch.setattr(app, 'WARM_STARTUP_TIMEOUT', 0)
+    monkeypatch.setattr(app, 'fetch_invoice_numbers', down)
+    monkeypatch.setattr(app, 'ensure_exchange_rates', lambda: {})
+    app.start_warm_up()
+    assert wait_for(lambda: warm_state['ready'])
+    assert warm_state['degraded'] and warm_state['steps']['invoice'] == 'error: down'
+    assert client.get('/readyz').get_json()['degraded']
+
+
+# --- 頁面快取、HTTP 快取標頭與壓縮 ---
+@pytest.fixture
+def renders(monkeypatch):
+    """清空頁面快取並記錄每次實際渲染的模板。"""
+    calls = []
+    render_template = app.render_template
+    monkeypatch.setattr(app, '_page_cache', app.TTLCache(maxsize=256, ttl=3600))
+    monkeypatch.setattr(app, 'render_template', lambda name, **context: calls.append(name) or render_template(name, **context))
+    return calls
+
+
+def test_static_page_rendered_once_and_revalidated(client, renders):
+    first = client.get('/invoice')
+    assert first.cache_control.public and first.cache_control.max_age == app.PAGE_MAX_AGE
+    assert first.last_modified is not None
+    again = client.get('/invoice', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert renders == ['invoice.html']
+
+
+def test_rate_page_cached_per_data_version(client, monkeypatch, renders, bot_rates):
+    app.ensure_exchange_rates()
+    monkeypatch.setattr(app, 'refresh_in_background', lambda key, fn: None)
+    assert client.get('/exchange_rate').cache_control.max_age == app.RATE_PAGE_MAX_AGE
+    client.get('/exchange_rate')
+    assert renders == ['exchange_rate.html']
+    monkeypatch.setitem(app._rate_state, 'fetched_at', time.time() + 1)  # 匯率表更新後重新渲染
+    client.get('/exchange_rate')
+    assert renders == ['exchange_rate.html'] * 2
+
+
+def test_rate_page_without_data_is_not_cached(client, monkeypatch, renders):
+    def down(url, **kwargs):
+        raise app.requests.ConnectionError('down')
+
+    monkeypatch.setattr(app, 'http_get', down)
+    monkeypatch.setattr(app, '_rate_state', dict(app._rate_state, rates=None, etag=None, last_modified=None))
+    response = client.get('/exchange_rate')
+    assert response.cache_control.no_store and 'ETag' not in response.headers
+
+
+def test_gzip_response_with_weak_etag(client, monkeypatch):
+    monkeypatch.setattr(app, 'COMPRESS_MIN_SIZE', 0)
+    monkeypatch.setattr(app, 'COMPRESS_ENCODINGS', ('gzip',))
+    plain = client.get('/')
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert gzip.decompress(response.data) == plain.data
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    again = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+
+
+def test_small_and_streamed_responses_not_compressed(client, monkeypatch):
+    monkeypatch.setattr(app, 'get_stock_details', lambda code, timeout=None: 'x' * 2000)
+    assert 'Content-Encoding' not in client.get('/readyz', headers={'Accept-Encoding': 'gzip'}).headers
+    monkeypatch.setattr(app, 'COMPRESS_MIN_SIZE', 0)
+    response = client.get('/stock/stream?codes=2330', headers={'Accept-Encoding': 'gzip'})
+    assert response.is_streamed and 'Content-Encoding' not in response.headers
+
+
+# --- Server-Timing 與取樣分析 ---
+def test_request_timing_header():
+    timing = app.RequestTiming()
+    timing.add('fetch', 0.01)
+    timing.add('fetch', 0.02)
+    timing.add('parse', 0.0005)
+    assert timing.header(0.1) == 'fetch;dur=30.0, parse;dur=0.5, total;dur=100.0'
+
+
+def test_server_timing_includes_fan_out_phases(client, monkeypatch):
+    monkeypatch.setattr(app, '_quote_cache', app.TTLCache(ttl=60))
+    header = client.get('/api/stock?codes=2330,2317').headers['Server-Timing']
+    phases = dict(item.split(';dur=') for item in header.split(', '))
+    assert {'fetch', 'parse', 'total'} <= set(phases)
+    assert float(phases['fetch']) > 0
+
+
+def test_server_timing_render_phase(client, renders):
+    assert 'render;dur=' in client.get('/').headers['Server-Timing']
+    assert 'render;dur=' not in client.get('/').headers['Server-Timing']  # 已快取的頁面不再渲染
+
+
+def test_admin_profile(client, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr(app, '_profile_state', dict(app._profile_state, rate=0, stats=None, requests=0, routes={}))
+    admin = {'X-Admin-Token': 'secret'}
+    assert client.post('/admin/profile', data={'rate': '2'}, headers=admin).status_code == 400
+    assert client.post('/admin/profile', data={'rate': '1'}, headers=admin).get_json() == {'rate': 1.0, 'requests': 0}
+    client.get('/')
+    report = client.get('/admin/profile?sort=tottime&limit=5', headers=admin).get_data(as_text=True)
+    assert '  /: 1' in report and 'tottime' in report
+    assert client.get('/admin/profile?sort=bogus', headers=admin).status_code == 400
+    assert client.delete('/admin/profile', headers=admin).get_json()['requests'] == 0
+    assert client.get('/admin/profile').status_code == 403